@@ -0,0 +1,224 @@
+"""
+Microbenchmark: request serialization with the precompiled templates of
+canada_post.service.request against the lxml tree builders GetRates and
+CreateShipment used before (reproduced below as legacy_*).
+
+Also checks that both produce the same documents: byte-identical in PROD,
+and the same but for whitespace in DEV, where the lxml builders pretty
+printed the request and the templates don't.
+
+    python benchmarks/bench_request_xml.py [number]
+"""
+from __future__ import print_function
+import sys
+import timeit
+from lxml import etree
+
+from canada_post import Auth, DEV, PROD
+from canada_post.compat import text_type
+from canada_post.service import Service, Option
+from canada_post.service.contract_shipping import CreateShipment
+from canada_post.service.rating import GetRates
+from canada_post.util.address import Origin, Destination
+from canada_post.util.parcel import Parcel, Item
+
+
+def legacy_rates_request(auth, parcel, origin, destination):
+    request_tree = etree.Element(
+        'mailing-scenario', xmlns="http://www.canadapost.ca/ws/ship/rate-v2")
+    def add_child(child_name, parent=request_tree):
+        return etree.SubElement(parent, child_name)
+    add_child("customer-number").text = text_type(auth.customer_number)
+    if auth.contract_number:
+        add_child("contract-id").text = text_type(auth.contract_number)
+    par_chars = add_child("parcel-characteristics")
+    add_child("weight", par_chars).text = text_type(parcel.weight)
+    if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
+        dims = add_child("dimensions", par_chars)
+        add_child("length", dims).text = text_type(parcel.length)
+        add_child("width", dims).text = text_type(parcel.width)
+        add_child("height", dims).text = text_type(parcel.height)
+    add_child("origin-postal-code").text = origin.postal_code
+    dest = add_child("destination")
+    if destination.country_code == "CA":
+        doms = add_child("domestic", dest)
+        add_child("postal-code", doms).text = destination.postal_code
+    elif destination.country_code == "US":
+        us = add_child("united-states", dest)
+        add_child("zip-code", us).text = destination.postal_code
+    else:
+        intr = add_child("international", dest)
+        add_child("country-code", intr).text = destination.country_code
+    return etree.tostring(request_tree, pretty_print=auth.debug)
+
+
+def legacy_address_detail(parent, address, add_child):
+    addr_detail = add_child("address-details", parent)
+    add_child("address-line-1", addr_detail).text = address.address1
+    add_child("address-line-2", addr_detail).text = address.address2
+    add_child("city", addr_detail).text = address.city
+    if address.province:
+        add_child("prov-state", addr_detail).text = address.province
+    add_child("country-code", addr_detail).text = address.country_code
+    if address.postal_code:
+        add_child("postal-zip-code",
+                  addr_detail).text = text_type(address.postal_code)
+    return addr_detail
+
+
+def legacy_shipment_request(auth, parcel, origin, destination, service, group,
+                            options=None):
+    shipment = etree.Element(
+        "shipment", xmlns="http://www.canadapost.ca/ws/shipment-v7")
+    def add_child(child_name, parent=shipment):
+        return etree.SubElement(parent, child_name)
+    add_child("group-id").text = group
+    add_child("requested-shipping-point").text = text_type(origin.postal_code)
+    delivery_spec = add_child("delivery-spec")
+    add_child("service-code", delivery_spec).text = service.code
+    sender = add_child("sender", delivery_spec)
+    if origin.name:
+        add_child("name", sender).text = origin.name
+    add_child("company", sender).text = origin.company
+    add_child("contact-phone", sender).text = origin.phone
+    legacy_address_detail(sender, origin, add_child)
+    dest = add_child("destination", delivery_spec)
+    if destination.name:
+        add_child("name", dest).text = destination.name
+    if destination.company:
+        add_child("company", dest).text = destination.company
+    # the original builder put this under <shipment>, the schema wants it
+    # here (and so do the templates)
+    if destination.extra:
+        add_child("additional-address-info", dest).text = destination.extra
+    if destination.phone:
+        add_child("client-voice-number", dest).text = destination.phone
+    legacy_address_detail(dest, destination, add_child)
+    if destination.country_code != 'CA':
+        customs = add_child('customs', delivery_spec)
+        add_child('currency', customs).text = 'CAD'
+        add_child('reason-for-export', customs).text = 'SOG'
+        sku_list = add_child('sku-list', customs)
+        for item in parcel.items:
+            item_elem = add_child('item', sku_list)
+            add_child('customs-number-of-units',
+                      item_elem).text = text_type(item.amount)
+            add_child('customs-description', item_elem).text = item.description
+            add_child('unit-weight', item_elem).text = text_type(item.weight)
+            add_child('customs-value-per-unit',
+                      item_elem).text = text_type(item.price)
+    if options is not None:
+        options_elem = add_child("options", delivery_spec)
+        for option in options:
+            options_elem.append(option.make_xml())
+    parcel_chars = add_child("parcel-characteristics", delivery_spec)
+    add_child("weight", parcel_chars).text = text_type(parcel.weight)
+    if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
+        dims = add_child("dimensions", parcel_chars)
+        add_child("length", dims).text = text_type(parcel.length)
+        add_child("width", dims).text = text_type(parcel.width)
+        add_child("height", dims).text = text_type(parcel.height)
+    add_child("unpackaged", parcel_chars).text = ("true" if parcel.unpackaged
+                                                  else "false")
+    print_preferences = add_child("print-preferences", delivery_spec)
+    add_child("output-format", print_preferences).text = "4x6"
+    preferences = add_child("preferences", delivery_spec)
+    add_child("show-packing-instructions", preferences).text = "false"
+    add_child("show-postage-rate", preferences).text = "false"
+    add_child("show-insured-value", preferences).text = "false"
+    settlement = add_child("settlement-info", delivery_spec)
+    add_child("contract-id", settlement).text = auth.contract_number
+    add_child("intended-method-of-payment", settlement).text = "Account"
+    return etree.tostring(shipment, pretty_print=auth.debug)
+
+
+AUTH = Auth("0001234567", "user", "pass", "0040000000", PROD)
+DEV_AUTH = Auth("0001234567", "user", "pass", "0040000000", DEV)
+ORIGIN = Origin(postal_code="h2b 1a0", name=u"Jos\xe9 & Sons", company="ACME",
+                phone="514 555 1234", address="1234 Main street suite 5",
+                city=u"Montr\xe9al", province="QC")
+DESTINATIONS = [
+    Destination(country_code="CA", postal_code="K1K 4T3", name="Jane Doe",
+                address="23 Elgin street", city="Ottawa", province="ON",
+                phone="613 555 1234"),
+    Destination(country_code="US", postal_code="90210", name="John <Doe>",
+                company="Doe Inc.", address="1 Rodeo drive",
+                city="Beverly Hills", province="CA", phone="555 1234",
+                extra="Leave at the door"),
+    Destination(country_code="FR", postal_code="", name="Pierre",
+                address="3 rue de Rivoli", city="Paris",
+                phone="33 1 23 45 67 89"),
+]
+PARCELS = [
+    Parcel(weight=2, length=30, width=20, height=10,
+           items=[Item(2, "T-shirt", 0.2, 15), Item(1, u"Caf\xe9", 1, 12.5)]),
+    Parcel(weight=0.75, unpackaged=True,
+           items=[Item(1, "Book", 0.75, 30)]),
+]
+SERVICE = Service(data={'code': 'DOM.EP'})
+OPTIONS = [None, [], [Option('SO'), Option('COV', amount='100.00')]]
+
+
+def scenarios():
+    for parcel in PARCELS:
+        for destination in DESTINATIONS:
+            for options in OPTIONS:
+                yield parcel, ORIGIN, destination, options
+
+
+def compact(document):
+    """
+    document without the whitespace pretty printing adds
+    """
+    parser = etree.XMLParser(remove_blank_text=True)
+    return etree.tostring(etree.fromstring(document, parser))
+
+
+def check():
+    count = 0
+    for auth in (AUTH, DEV_AUTH):
+        # DEV requests used to be sent pretty printed
+        same = (lambda new, old: new == old) if auth is AUTH else \
+            (lambda new, old: new == compact(old))
+        get_rates = GetRates(auth)
+        create_shipment = CreateShipment(auth)
+        for parcel, origin, destination, options in scenarios():
+            new = get_rates.prepare_request(parcel, origin,
+                                            destination)['data']
+            old = legacy_rates_request(auth, parcel, origin, destination)
+            assert same(new, old), (new, old)
+            new = create_shipment.prepare_request(parcel, origin,
+                                                  destination, SERVICE,
+                                                  "group-1", options)['data']
+            old = legacy_shipment_request(auth, parcel, origin, destination,
+                                          SERVICE, "group-1", options)
+            assert same(new, old), (new, old)
+            count += 1
+    print("{0} scenarios: template output is byte-identical in PROD, and "
+          "in DEV but for pretty printing".format(count))
+
+
+def bench(number):
+    get_rates = GetRates(AUTH)
+    create_shipment = CreateShipment(AUTH)
+    parcel, origin, destination = PARCELS[0], ORIGIN, DESTINATIONS[1]
+    options = OPTIONS[-1]
+    cases = [
+        ("GetRates legacy", lambda: legacy_rates_request(
+            AUTH, parcel, origin, destination)),
+        ("GetRates template", lambda: get_rates.prepare_request(
+            parcel, origin, destination)),
+        ("CreateShipment legacy", lambda: legacy_shipment_request(
+            AUTH, parcel, origin, destination, SERVICE, "group-1", options)),
+        ("CreateShipment template", lambda: create_shipment.prepare_request(
+            parcel, origin, destination, SERVICE, "group-1", options)),
+    ]
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        print("{0:<26} {1:8.2f} us/request".format(
+            name, best / number * 1e6))
+
+
+if __name__ == '__main__':
+    check()
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
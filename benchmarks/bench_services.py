@@ -0,0 +1,248 @@
+"""
+Service benchmark: every CanadaPostAPI service against the gateway simulator
+(benchmarks/gateway.py), under sequential, threaded and asyncio load.
+
+Reports the throughput and the p50/p99 latency of each service in each mode,
+then the cost of building the request documents and parsing the recorded
+responses on their own, without any I/O.
+
+    python benchmarks/bench_services.py [--requests 200] [--threads 16]
+        [--latency 0.02] [--error-rate 0.01] [--modes sequential,threaded]
+
+Requires python 3; asyncio load also needs aiohttp.
+"""
+from __future__ import print_function
+import argparse
+import io
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+from canada_post import Auth
+from canada_post.api import CanadaPostAPI
+from canada_post.instrument import Histogram
+from canada_post.service.contract_shipping import (CreateShipment,
+                                                   TransmitShipments,
+                                                   GetManifest)
+from canada_post.service.rating import GetRates
+from canada_post.transport import Transport
+from canada_post.util.address import Origin, Destination
+from canada_post.util.parcel import Parcel
+
+from gateway import Gateway, load_payload
+
+CREDENTIALS = ("1234567", "user", "password", "42")
+PARCEL = Parcel(weight=2, length=10, width=6, height=3)
+ORIGIN = Origin(postal_code="H2B1A0", company="ACME", phone="555-555-5555",
+                address="123 Main st", city="Montreal", province="QC")
+DESTINATION = Destination(country_code="CA", postal_code="K1K4T3",
+                          name="John Doe", address="456 Elm st",
+                          city="Ottawa", province="ON")
+GROUP = "bobo"
+
+
+class Recorded(object):
+    """
+    A recorded response, for the services' process_response
+    """
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {}
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        pass
+
+
+class Fixtures(object):
+    """
+    Objects the services take, parsed from the recorded payloads
+    """
+    def __init__(self, auth):
+        self.service = GetRates(auth).process_response(
+            Recorded(load_payload('rates.xml')))[0]
+        self.shipment = CreateShipment(auth).process_response(
+            Recorded(load_payload('shipment.xml')))
+        self.manifest_link = TransmitShipments(auth).process_response(
+            Recorded(load_payload('manifests.xml')))[0]
+        self.manifest = GetManifest(auth).process_response(
+            Recorded(load_payload('manifest.xml')))
+
+
+# service name -> call; the calls return awaitables on AsyncCanadaPostAPI
+CALLS = [
+    ('get_rates', lambda api, f: api.get_rates(PARCEL, ORIGIN, DESTINATION)),
+    ('create_shipment', lambda api, f: api.create_shipment(
+        PARCEL, ORIGIN, DESTINATION, f.service, GROUP)),
+    ('get_shipment', lambda api, f: api.get_shipment(f.shipment.id)),
+    ('void_shipment', lambda api, f: api.void_shipment(f.shipment)),
+    ('transmit_shipments', lambda api, f: api.transmit_shipments(
+        ORIGIN, [GROUP])),
+    ('get_manifest', lambda api, f: api.get_manifest(f.manifest_link)),
+    ('get_manifest_shipments',
+     lambda api, f: api.get_manifest_shipments(f.manifest)),
+    ('get_groups', lambda api, f: api.get_groups()),
+    ('get_artifact', lambda api, f: api.get_artifact(f.shipment,
+                                                      sink=io.BytesIO())),
+]
+
+
+class Result(object):
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def record(self, started, error):
+        self.latency.record(time.time() - started)
+        if error:
+            with self._lock:
+                self.errors += 1
+
+
+def run_sync(api, fixtures, call, number, threads):
+    result = Result()
+    def one(_):
+        started = time.time()
+        try:
+            call(api, fixtures)
+        except Exception:
+            result.record(started, True)
+        else:
+            result.record(started, False)
+    started = time.time()
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(one, range(number)))
+    else:
+        for i in range(number):
+            one(i)
+    result.elapsed = time.time() - started
+    return result
+
+
+def run_async(gateway, fixtures, number, concurrency):
+    import asyncio
+    from canada_post.aio import AsyncCanadaPostAPI, AsyncTransport
+
+    async def one(api, call, result):
+        started = time.time()
+        try:
+            await call(api, fixtures)
+        except Exception:
+            result.record(started, True)
+        else:
+            result.record(started, False)
+
+    async def run():
+        results = []
+        transport = AsyncTransport(max_concurrency=concurrency)
+        async with AsyncCanadaPostAPI(*CREDENTIALS, transport=transport,
+                                      gateway=gateway.url) as api:
+            for name, call in CALLS:
+                result = Result()
+                started = time.time()
+                await asyncio.gather(*[one(api, call, result)
+                                       for i in range(number)])
+                result.elapsed = time.time() - started
+                results.append((name, result))
+        return results
+
+    return asyncio.run(run())
+
+
+def report(mode, name, result, number):
+    print("{0:<11} {1:<23} {2:9.1f} req/s  p50 {3:8.2f} ms  p99 {4:8.2f} ms"
+          "  {5} errors".format(mode, name, number / result.elapsed,
+                                result.latency.percentile(50) * 1000,
+                                result.latency.percentile(99) * 1000,
+                                result.errors))
+
+
+def bench_load(gateway, modes, number, threads):
+    for mode in modes:
+        if mode == 'async':
+            try:
+                results = run_async(gateway, Fixtures(Auth(*CREDENTIALS)),
+                                    number, threads)
+            except ImportError as error:
+                print("async: skipped ({0})".format(error))
+                continue
+            for name, result in results:
+                report(mode, name, result, number)
+            continue
+        workers = threads if mode == 'threaded' else 1
+        api = CanadaPostAPI(*CREDENTIALS, gateway=gateway.url,
+                            transport=Transport(pool_maxsize=workers))
+        fixtures = Fixtures(api.auth)
+        for name, call in CALLS:
+            result = run_sync(api, fixtures, call, number, workers)
+            report(mode, name, result, number)
+        api.close()
+
+
+def bench_xml(number):
+    api = CanadaPostAPI(*CREDENTIALS)
+    fixtures = Fixtures(api.auth)
+    build = [
+        ('get_rates', lambda: api.get_rates.prepare_request(
+            PARCEL, ORIGIN, DESTINATION)),
+        ('create_shipment', lambda: api.create_shipment.prepare_request(
+            PARCEL, ORIGIN, DESTINATION, fixtures.service, GROUP)),
+        ('transmit_shipments', lambda: api.transmit_shipments
+         .prepare_request(ORIGIN, [GROUP])),
+    ]
+    parse = [
+        ('get_rates', api.get_rates, 'rates.xml'),
+        ('create_shipment', api.create_shipment, 'shipment.xml'),
+        ('transmit_shipments', api.transmit_shipments, 'manifests.xml'),
+        ('get_manifest', api.get_manifest, 'manifest.xml'),
+        ('get_manifest_shipments', api.get_manifest_shipments,
+         'shipments.xml'),
+        ('get_groups', api.get_groups, 'groups.xml'),
+    ]
+    for name, prepare in build:
+        seconds = timeit.timeit(prepare, number=number)
+        print("build  {0:<23} {1:8.1f} us".format(name,
+                                                  seconds / number * 1e6))
+    for name, service, payload in parse:
+        response = Recorded(load_payload(payload))
+        seconds = timeit.timeit(lambda: service.process_response(response),
+                                number=number)
+        print("parse  {0:<23} {1:8.1f} us".format(name,
+                                                  seconds / number * 1e6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=200,
+                        help="calls per service and mode")
+    parser.add_argument('--threads', type=int, default=16,
+                        help="threads, and concurrent requests under async")
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="simulated gateway latency, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--artifact-size', type=int, default=None,
+                        help="pad the label artifact to this many bytes")
+    parser.add_argument('--modes', default='sequential,threaded,async')
+    parser.add_argument('--xml-number', type=int, default=2000,
+                        help="iterations of the XML build/parse benchmarks")
+    args = parser.parse_args(argv)
+
+    gateway = Gateway(latency=(args.latency * 0.5, args.latency * 1.5),
+                      error_rate=args.error_rate,
+                      artifact_size=args.artifact_size, seed=0)
+    with gateway:
+        bench_load(gateway, args.modes.split(','), args.requests,
+                   args.threads)
+    bench_xml(args.xml_number)
+
+
+if __name__ == '__main__':
+    main()
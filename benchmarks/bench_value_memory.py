@@ -0,0 +1,148 @@
+"""
+Memory benchmark: the slotted value types of canada_post (Service, Price,
+Adjustment, Parcel, addresses) against the __dict__ based classes they
+replaced (reproduced below as Legacy*).
+
+Builds `number` rated services the way a rate cache holds them (a Service
+with its Price and two Adjustments), and as many parcels and destinations,
+and reports the memory allocated for them and their pickled size.
+
+    python benchmarks/bench_value_memory.py [number]
+
+Requires python 3 (tracemalloc).
+"""
+from __future__ import print_function
+import pickle
+import sys
+import tracemalloc
+from decimal import Decimal
+
+from canada_post.service import Service
+from canada_post.util.address import Destination
+from canada_post.util.money import Adjustment, Price
+from canada_post.util.parcel import Parcel
+
+
+class LegacyInfoObject(object):
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+
+class LegacyAdjustment(LegacyInfoObject):
+    pass
+
+
+class LegacyPrice(LegacyInfoObject):
+    def __init__(self, due, base, gst, gst_pc, pst, pst_pc, hst, hst_pc,
+                 adjustments, **kwargs):
+        self.due = due
+        self.base = base
+        self.gst = gst
+        self.gst_pc = gst_pc
+        self.pst = pst
+        self.pst_pc = pst_pc
+        self.hst = hst
+        self.hst_pc = hst_pc
+        self.tax_total = gst + pst + hst
+        self.adjustments = adjustments
+        self.adjustment_total = sum(adjustment.cost
+                                    for adjustment in adjustments)
+        super(LegacyPrice, self).__init__(**kwargs)
+
+
+class LegacyService(object):
+    def __init__(self, data):
+        self.code = data['code']
+        self.link = data['link']
+        self.name = data['name']
+        self.price = data['price']
+        self.transit_time = data['transit_time']
+
+
+class LegacyParcel(LegacyInfoObject):
+    def __init__(self, weight, length, width, height, unpackaged=False,
+                 items=None, **kwargs):
+        self.weight = weight
+        self.length = length
+        self.width = width
+        self.height = height
+        self.unpackaged = unpackaged
+        self.items = items or []
+        super(LegacyParcel, self).__init__(**kwargs)
+
+
+class LegacyDestination(LegacyInfoObject):
+    def __init__(self, country_code, postal_code, extra=None, **kwargs):
+        self.country_code = country_code
+        self.extra = extra
+        self.postal_code = postal_code.replace(" ", "").upper()
+        self.name = self.company = self.phone = None
+        self.address1 = self.address2 = self.city = self.province = None
+        super(LegacyDestination, self).__init__(**kwargs)
+
+
+LINK = {'rel': 'service', 'media-type': 'application/vnd.cpc.ship.rate-v2+xml',
+        'href': 'https://soa-gw.canadapost.ca/rs/ship/service/DOM.EP'}
+
+
+def services(number, service, price, adjustment):
+    result = []
+    for i in range(number):
+        adjustments = [
+            adjustment(code='FUELSC', name='Fuel surcharge',
+                       cost=Decimal('1.%02d' % (i % 100)),
+                       percent=Decimal('13.75')),
+            adjustment(code='AUTDISC', name='Automation discount',
+                       cost=Decimal('-0.%02d' % (i % 100)),
+                       percent=Decimal('-1.00')),
+            ]
+        result.append(service(data={
+            'code': 'DOM.EP', 'link': LINK, 'name': 'Expedited Parcel',
+            'transit_time': 2,
+            'price': price(due=Decimal('12.%02d' % (i % 100)),
+                           base=Decimal('9.59'), gst=Decimal('0.00'),
+                           gst_pc=Decimal('5.00'), pst=Decimal('0.00'),
+                           pst_pc=Decimal('0.00'), hst=Decimal('1.42'),
+                           hst_pc=Decimal('13.00'), adjustments=adjustments),
+            }))
+    return result
+
+
+def parcels(number, parcel, destination):
+    return [(parcel(weight=Decimal('2.%d' % (i % 10)), length=10, width=6,
+                    height=3),
+             destination(country_code='CA', postal_code='K1K4T3'))
+            for i in range(number)]
+
+
+def measure(build):
+    tracemalloc.start()
+    objects = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return objects, size
+
+
+def bench(number):
+    cases = [
+        ("services, legacy",
+         lambda: services(number, LegacyService, LegacyPrice,
+                          LegacyAdjustment)),
+        ("services, slotted",
+         lambda: services(number, Service, Price, Adjustment)),
+        ("parcels+destinations, legacy",
+         lambda: parcels(number, LegacyParcel, LegacyDestination)),
+        ("parcels+destinations, slotted",
+         lambda: parcels(number, Parcel, Destination)),
+    ]
+    for name, build in cases:
+        objects, size = measure(build)
+        pickled = len(pickle.dumps(objects, pickle.HIGHEST_PROTOCOL))
+        print("{0:<31} {1:8.0f} bytes/object {2:8.0f} bytes/object "
+              "pickled".format(name, float(size) / number,
+                               float(pickled) / number))
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,217 @@
+"""
+Local stand-in for the Canada Post gateway, for benchmarks and tests.
+
+Serves the payloads recorded in benchmarks/payloads for the rating
+(/rs/ship/price), shipment, manifest, group and artifact endpoints, with
+configurable latency and error injection. GET answers carry an ETag and
+honour If-None-Match. Point a client at it with the
+gateway argument:
+
+    with Gateway(latency=(0.02, 0.05), error_rate=0.01) as gateway:
+        cpa = CanadaPostAPI(..., gateway=gateway.url)
+
+Links in the recorded payloads point at Canada Post's servers; the gateway
+argument sends requests for them to the simulator as well.
+
+It can also be run on its own:
+
+    python benchmarks/gateway.py [--port 8080] [--latency 0.05]
+"""
+from __future__ import print_function
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'payloads')
+
+RATE_TYPE = 'application/vnd.cpc.ship.rate-v2+xml'
+SHIPMENT_TYPE = 'application/vnd.cpc.shipment-v7+xml'
+MANIFEST_TYPE = 'application/vnd.cpc.manifest-v7+xml'
+
+# method, path pattern, endpoint family, status, payload, content type
+ROUTES = [
+    ('POST', r'/rs/ship/price$', 'rating', 200, 'rates.xml', RATE_TYPE),
+    ('POST', r'/rs/\d+/\d+/shipment$', 'shipment', 200, 'shipment.xml',
+     SHIPMENT_TYPE),
+    ('GET', r'/rs/\d+/\d+/shipment/\d+$', 'shipment', 200, 'shipment.xml',
+     SHIPMENT_TYPE),
+    ('DELETE', r'/rs/\d+/\d+/shipment/\d+$', 'shipment', 204, None, None),
+    ('GET', r'/rs/\d+/\d+/shipment\?manifestId=', 'manifest', 200,
+     'shipments.xml', SHIPMENT_TYPE),
+    ('POST', r'/rs/\d+/\d+/manifest$', 'manifest', 200, 'manifests.xml',
+     MANIFEST_TYPE),
+    ('GET', r'/rs/\d+/\d+/manifest/\d+$', 'manifest', 200, 'manifest.xml',
+     MANIFEST_TYPE),
+    ('GET', r'/rs/\d+/\d+/group$', 'shipment', 200, 'groups.xml',
+     SHIPMENT_TYPE),
+    ('GET', r'/ers/artifact/', 'artifact', 200, 'label.pdf',
+     'application/pdf'),
+]
+
+
+def load_payload(name, artifact_size=None):
+    with open(os.path.join(PAYLOADS, name), 'rb') as payload:
+        content = payload.read()
+    if name.endswith('.pdf') and artifact_size and \
+            artifact_size > len(content):
+        # pad with a trailing comment, which PDF readers skip
+        padding = artifact_size - len(content) - 2
+        content += b'%' + b'0' * max(padding, 0) + b'\n'
+    return content
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; don't let Nagle's algorithm
+    # hold the body back until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        status, headers, content = self.server.gateway.respond(
+            self.command, self.path, self.headers)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Gateway(object):
+    """
+    :latency: seconds every response is delayed, or a (low, high) range to
+        draw the delay from uniformly
+    :error_rate: fraction of the requests answered with an error instead
+    :errors: status codes the errors are drawn from. 429 and 503 come with
+        a Retry-After header
+    :artifact_size: pad the recorded label to this many bytes
+    :artifact_pending: the first this many requests for each artifact are
+        answered 202 (not ready yet), with a Retry-After of 0
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 errors=(500, 503), artifact_size=None, seed=None,
+                 artifact_pending=0):
+        self.latency = latency
+        self.artifact_pending = artifact_pending
+        self.pending = {}
+        self.error_rate = error_rate
+        self.errors = tuple(errors)
+        self.random = random.Random(seed)
+        self.routes = [(method, re.compile(pattern), family, status,
+                        load_payload(name, artifact_size) if name else b'',
+                        content_type)
+                       for method, pattern, family, status, name,
+                       content_type in ROUTES]
+        self.error_payload = load_payload('error.xml')
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.server = _Server((host, port), _Handler)
+        self.server.gateway = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def delay(self):
+        if isinstance(self.latency, (tuple, list)):
+            return self.random.uniform(*self.latency)
+        return self.latency
+
+    def respond(self, method, path, request_headers=None):
+        """
+        Status, headers and content of the answer to a request. GET answers
+        carry an ETag, and requests that already have the content (per
+        If-None-Match) get a 304
+        """
+        for route_method, pattern, family, status, content, content_type \
+                in self.routes:
+            if route_method == method and pattern.search(path):
+                break
+        else:
+            return 404, {}, b''
+        with self._lock:
+            self.requests[family] = self.requests.get(family, 0) + 1
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            status = self.random.choice(self.errors)
+            headers = {'Content-Type': 'application/vnd.cpc.messages+xml'}
+            if status in (429, 503):
+                headers['Retry-After'] = '1'
+            return status, headers, self.error_payload
+        if family == 'artifact' and self.artifact_pending:
+            with self._lock:
+                seen = self.pending[path] = self.pending.get(path, 0) + 1
+            if seen <= self.artifact_pending:
+                return 202, {'Retry-After': '0'}, b''
+        headers = {'Content-Type': content_type} if content_type else {}
+        if method == 'GET':
+            etag = '"{0}"'.format(hashlib.sha1(content).hexdigest()[:16])
+            headers['ETag'] = etag
+            if (request_headers or {}).get('If-None-Match') == etag:
+                return 304, {'ETag': etag}, b''
+        return status, headers, content
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args(argv)
+    gateway = Gateway(args.host, args.port, args.latency, args.error_rate)
+    print("Canada Post gateway simulator on", gateway.url)
+    try:
+        gateway.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
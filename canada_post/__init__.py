@@ -8,6 +8,11 @@ DEV = "DEV"
 PROD = "PROD"
 
 class Auth(object):
+    """
+    Credentials of one Canada Post account. USERNAME and PASSWORD hold the
+    process wide defaults, used by the instances created without a username
+    or password of their own
+    """
     USERNAME = {
         DEV: "",
         PROD: "",
@@ -23,19 +28,20 @@ class Auth(object):
         self.debug = dev == DEV
         self.customer_number = customer_number
         self.contract_number = contract_number
-        self.USERNAME[dev] = username
-        self.PASSWORD[dev] = password
+        self._username = username
+        self._password = password
 
     @property
     def username(self):
-        return self.USERNAME[self.dev]
+        return self._username or self.USERNAME[self.dev]
 
     @property
     def password(self):
-        return self.PASSWORD[self.dev]
+        return self._password or self.PASSWORD[self.dev]
 
 _auth = None
 
 def set_credentials(customer_number, username, password, dev=PROD):
+    global _auth
     if _auth is None:
-        _auth = Auth(customer_number, username, password, dev)
+        _auth = Auth(customer_number, username, password, dev=dev)
@@ -0,0 +1,637 @@
+"""
+asyncio client for the Canada Post API (python 3.7+, requires aiohttp)
+
+AsyncCanadaPostAPI mirrors canada_post.api.CanadaPostAPI, but its services are
+coroutines:
+
+    async with AsyncCanadaPostAPI(customer_number, username, password,
+                                  contract_number, dev=DEV) as cpa:
+        services = await cpa.get_rates(parcel, origin, dest)
+
+The requests are built and the responses parsed by the very same service
+classes the synchronous client uses (see ServiceBase.prepare_request and
+ServiceBase.process_response), only the HTTP round-trip is done here.
+"""
+import asyncio
+import base64
+import functools
+import inspect
+import logging
+import time
+from contextlib import contextmanager
+import requests
+from urllib3.exceptions import NewConnectionError
+try:
+    import aiohttp
+    from multidict import CIMultiDict
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from canada_post import PROD, Auth
+from canada_post.service.contract_shipping import (CreateShipment, GetShipment,
+                                                   VoidShipment,
+                                                   TransmitShipments,
+                                                   GetManifest, GetArtifact,
+                                                   GetManifestShipments, GetGroups)
+from canada_post.service.rating import (GetRates)
+from canada_post.registry import ClientRegistry
+from canada_post.singleflight import SingleFlightStats
+from canada_post.transport import Transport, TransportStats
+
+
+class Response(object):
+    """
+    The parts of a requests.Response that the services' process_response
+    use, filled from an aiohttp response
+    """
+    def __init__(self, url, status_code, reason, headers, content,
+                 phases=None):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.phases = phases
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise requests.HTTPError(
+                u"{code} Error: {reason} for url: {url}".format(
+                    code=self.status_code, reason=self.reason, url=self.url),
+                response=self)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+# only aiohttp 3.10+ tells connect timeouts apart
+def basic_auth(username, password):
+    """
+    The Authorization header value for HTTP basic auth, encoded as requests
+    encodes it
+    """
+    userpass = ('%s:%s' % (username, password)).encode('latin-1')
+    return 'Basic ' + base64.b64encode(userpass).decode('ascii')
+
+
+_CONNECT_TIMEOUT = getattr(aiohttp, 'ConnectionTimeoutError', ())
+
+
+@contextmanager
+def _requests_errors():
+    """
+    Raise the requests exceptions the synchronous client raises, so that
+    callers and RetryPolicy handle both clients alike
+    """
+    try:
+        yield
+    except _CONNECT_TIMEOUT as error:
+        raise requests.exceptions.ConnectTimeout(str(error)) from error
+    except aiohttp.ClientConnectorError as error:
+        raise requests.exceptions.ConnectionError(
+            NewConnectionError(None, str(error))) from error
+    except asyncio.TimeoutError as error:
+        raise requests.exceptions.ReadTimeout(str(error)) from error
+    except aiohttp.ClientConnectionError as error:
+        raise requests.exceptions.ConnectionError(str(error)) from error
+
+
+class StreamedResponse(Response):
+    """
+    A Response whose body is read from the connection as iter_content is
+    consumed, the way requests' stream=True responses are. iter_content
+    blocks, so it must run outside the event loop's thread (AsyncGetArtifact
+    processes these in the default executor); close gives the connection
+    back, from any thread
+    """
+    def __init__(self, res, phases, on_close):
+        super(StreamedResponse, self).__init__(str(res.url), res.status,
+                                               res.reason, res.headers, None,
+                                               phases)
+        self._res = res
+        self._loop = asyncio.get_running_loop()
+        self._on_close = on_close
+
+    def iter_content(self, chunk_size=1):
+        while True:
+            chunk = asyncio.run_coroutine_threadsafe(
+                self._read(chunk_size), self._loop).result()
+            if not chunk:
+                return
+            yield chunk
+
+    async def _read(self, chunk_size):
+        with _requests_errors():
+            return await self._res.content.read(chunk_size)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._release)
+
+    def _release(self):
+        if self._res is not None:
+            # closes the connection if the body wasn't read to the end
+            self._res.release()
+            self._res = None
+            self._on_close()
+
+
+class AsyncTransport(object):
+    """
+    Pooled aiohttp transport with a concurrency limiter.
+
+    :max_concurrency: how many requests may be in flight at the same time,
+        the rest wait their turn
+    :pool_maxsize: total connections kept by the connector
+    :pool_maxsize_per_host: connections kept per host
+    :timeout: (connect, read) timeout in seconds, like Transport's
+    :cache: canada_post.httpcache.HTTPCache for the GET responses, like
+        Transport's
+    """
+    log = logging.getLogger('canada_post.aio.AsyncTransport')
+
+    def __init__(self, max_concurrency=50, pool_maxsize=100,
+                 pool_maxsize_per_host=0, timeout=Transport.DEFAULT_TIMEOUT,
+                 cache=None):
+        if aiohttp is None:
+            raise ImportError("AsyncTransport requires aiohttp, install "
+                              "python-canada-post[async]")
+        self.max_concurrency = max_concurrency
+        self.pool_maxsize = pool_maxsize
+        self.pool_maxsize_per_host = pool_maxsize_per_host
+        self.timeout = timeout
+        self.cache = cache
+        self.stats = TransportStats()
+        self.session = None
+        self._semaphore = None
+
+    def _get_session(self):
+        if self.session is None:
+            trace = aiohttp.TraceConfig()
+            stats = self.stats
+            # context.trace_request_ctx is the phases dict of the request
+            async def on_dns_resolvehost_start(session, context, params):
+                context.dns_started = time.time()
+            async def on_dns_resolvehost_end(session, context, params):
+                context.dns = time.time() - context.dns_started
+            async def on_connection_create_start(session, context, params):
+                context.connect_started = time.time()
+            async def on_connection_create_end(session, context, params):
+                stats.connection_opened()
+                phases = context.trace_request_ctx
+                if phases is not None:
+                    dns = getattr(context, 'dns', 0)
+                    if dns:
+                        phases['dns'] = dns
+                    phases['connect'] = (time.time() - context.connect_started
+                                         - dns)
+            trace.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+            trace.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+            trace.on_connection_create_start.append(
+                on_connection_create_start)
+            trace.on_connection_create_end.append(on_connection_create_end)
+            connect, read = self.timeout
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_maxsize,
+                    limit_per_host=self.pool_maxsize_per_host),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect,
+                                              sock_read=read),
+                trace_configs=[trace])
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    @property
+    def in_flight(self):
+        if self._semaphore is None:
+            return 0
+        return self.max_concurrency - self._semaphore._value
+
+    async def request(self, method, url, auth=None, data=None, headers=None,
+                      **kwargs):
+        cache = self.cache
+        key = None
+        if cache is not None:
+            key = cache.key(method, url, headers, auth,
+                            kwargs.get('stream', False))
+        if key is None:
+            if cache is None:
+                return await self.send(method, url, auth, data, headers,
+                                       **kwargs)
+            # after the request too, in case a GET stored it meanwhile
+            cache.invalidate(method, url, auth)
+            try:
+                return await self.send(method, url, auth, data, headers,
+                                       **kwargs)
+            finally:
+                cache.invalidate(method, url, auth)
+        entry = cache.lookup(key)
+        if entry is not None:
+            if entry.is_fresh():
+                cache.hit(entry)
+                return self.replay(key, entry, {})
+            headers = dict(headers or {}, **entry.conditional_headers())
+        response = await self.send(method, url, auth, data, headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            entry = cache.revalidate(key, entry, response.headers)
+            return self.replay(key, entry, response.phases)
+        entry = cache.store(key, url, response.status_code, response.reason,
+                            response.headers, response.content)
+        response.from_cache = False
+        if entry is not None:
+            response.cache_memo = cache.memo(key, entry)
+        return response
+
+    def cached(self, method, url, auth=None, headers=None, **kwargs):
+        """
+        The Response served from the cache when it holds a fresh one,
+        otherwise None, like Transport.cached
+        """
+        cache = self.cache
+        if cache is None:
+            return None
+        key = cache.key(method, url, headers, auth,
+                        kwargs.get('stream', False))
+        if key is None:
+            return None
+        entry = cache.lookup(key)
+        if entry is None or not entry.is_fresh():
+            return None
+        cache.hit(entry)
+        return self.replay(key, entry, {})
+
+    def replay(self, key, entry, phases):
+        """
+        A Response made from a stored response
+        """
+        response = Response(entry.url, entry.status_code, entry.reason,
+                            CIMultiDict(entry.headers), entry.content, phases)
+        response.from_cache = True
+        response.cache_memo = self.cache.memo(key, entry)
+        return response
+
+    async def send(self, method, url, auth=None, data=None, headers=None,
+                   stream=False, **kwargs):
+        """
+        Send a request, reading the whole response body unless stream is
+        True, in which case the response is a StreamedResponse that holds
+        its connection (and its place under max_concurrency) until it's
+        closed
+        """
+        session = self._get_session()
+        if auth is not None:
+            headers = dict(headers or {}, Authorization=basic_auth(*auth))
+        await self._semaphore.acquire()
+        res = None
+        streamed = False
+        try:
+            self.stats.request_sent()
+            phases = {}
+            started = time.time()
+            with _requests_errors():
+                res = await session.request(method.upper(), url, data=data, headers=headers,
+                                            trace_request_ctx=phases,
+                                            **kwargs)
+                content = None if stream else await res.read()
+            phases['server'] = max(
+                time.time() - started - sum(phases.values()), 0)
+            if stream:
+                response = StreamedResponse(res, phases,
+                                            self._semaphore.release)
+                # the response releases both when it's closed
+                streamed = True
+                return response
+            return Response(str(res.url), res.status, res.reason,
+                            res.headers, content, phases)
+        finally:
+            if not streamed:
+                if res is not None:
+                    res.release()
+                self._semaphore.release()
+
+    async def close(self):
+        if self.session is not None:
+            self.log.info("Closing transport, %r", self.stats)
+            if self.cache is not None:
+                self.log.info("HTTP cache: %r", self.cache.stats)
+            await self.session.close()
+            self.session = None
+
+
+class AsyncSingleFlight(object):
+    """
+    Coroutine version of canada_post.singleflight.SingleFlight
+    """
+    def __init__(self):
+        self.stats = SingleFlightStats()
+        self._calls = {}
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    async def do(self, key, coro_func, *args, **kwargs):
+        """
+        Return await coro_func(*args, **kwargs), unless a call for key is
+        already in flight, in which case wait for its outcome.
+
+        The call runs in a task of its own, so cancelling any of the callers
+        (the first one included) doesn't cancel it for the others
+        """
+        task = self._calls.get(key)
+        self.stats.called(coalesced=task is not None)
+        if task is None:
+            task = self._calls[key] = asyncio.get_running_loop().create_task(
+                coro_func(*args, **kwargs))
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # mark the exception as retrieved in case every caller was
+            # cancelled
+            task.exception()
+
+
+class AsyncService(object):
+    """
+    Awaitable wrapper around one of the canada_post.service services
+    """
+    def __init__(self, service, transport):
+        self.service = service
+        self.transport = transport
+
+    async def __call__(self, *args, **kwargs):
+        request = self.service.prepare_request(*args, **kwargs)
+        return await self.call(request)
+
+    async def call(self, request, **process_kwargs):
+        """
+        Send a prepared request and process its response, through the
+        service's instrumentation if it has one (see ServiceBase.call)
+        """
+        request = self.service.rebase(request)
+        instrumentation = self.service.instrumentation
+        if instrumentation is None:
+            return await self.process(await self.request(**request),
+                                      **process_kwargs)
+        event = instrumentation.start(self.service, request)
+        try:
+            response = await self.request(**event.request)
+            instrumentation.responded(event, response)
+            result = await self.process(response, **process_kwargs)
+        except Exception as error:
+            instrumentation.finish(event, error)
+            raise
+        instrumentation.finish(event)
+        return result
+
+    async def process(self, response, **process_kwargs):
+        return self.service.process(response, **process_kwargs)
+
+    async def request(self, **request):
+        """
+        Send an authenticated request through the transport, following the
+        service's retry policy, unless the transport's cache answers it
+        """
+        response = self.transport.cached(auth=self.service.userpass(),
+                                         **request)
+        if response is not None:
+            return response
+        policy = self.service.retry_policy
+        if policy is None:
+            return await self.send(**request)
+        attempt = 1
+        while True:
+            policy.check()
+            try:
+                response = await self.send(**request)
+            except Exception as error:
+                delay = policy.next_delay(attempt, self.service.idempotent,
+                                          error=error)
+                if delay is None:
+                    raise
+            else:
+                delay = policy.next_delay(attempt, self.service.idempotent,
+                                          response=response)
+                if delay is None:
+                    return response
+                # a streamed response holds its connection until closed
+                response.close()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def send(self, **request):
+        """
+        Send a single authenticated request, waiting for the service's rate
+        limiter first
+        """
+        limiter = self.service.rate_limiter()
+        if limiter is not None:
+            delay = limiter.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        response = await self.transport.request(
+            auth=self.service.userpass(), **request)
+        if limiter is not None:
+            limiter.feedback(response.status_code, response.headers)
+        return response
+
+
+class AsyncGetRates(AsyncService):
+    """
+    Awaitable GetRates, answering from the service's rate cache when it has
+    one, and coalescing concurrent quotes for the same scenario when the
+    service was created with coalesce=True. Caches with a blocking backend
+    (SharedBackend) are used from the default executor
+    """
+    def __init__(self, service, transport):
+        super(AsyncGetRates, self).__init__(service, transport)
+        self.single_flight = None
+        if service.single_flight is not None:
+            self.single_flight = AsyncSingleFlight()
+
+    async def __call__(self, parcel, origin, destination):
+        key = self.service.scenario_key(parcel, origin, destination)
+        cache_key = None
+        if self.service.cache is not None:
+            cache_key = self.service.cache_key(parcel, origin, destination)
+            services = await self._cache('get', cache_key)
+            if services is not None:
+                return services
+        if self.single_flight is None:
+            return await self._quote(cache_key, parcel, origin, destination)
+        return list(await self.single_flight.do(key, self._quote, cache_key,
+                                                parcel, origin, destination))
+
+    def estimate(self, parcel, origin, destination):
+        """
+        Offline estimates, see GetRates.estimate. Not a coroutine: they're
+        answered from memory
+        """
+        return self.service.estimate(parcel, origin, destination)
+
+    async def _quote(self, cache_key, parcel, origin, destination):
+        services = await super(AsyncGetRates, self).__call__(parcel, origin,
+                                                             destination)
+        if self.service.cache is not None:
+            await self._cache('set', cache_key, services)
+        if self.service.estimator is not None:
+            self.service.estimator.learn(parcel, origin, destination, services,
+                                         account=self.service.account())
+        return services
+
+    async def _cache(self, method, *args):
+        cache = self.service.cache
+        if not getattr(cache.backend, 'blocking', False):
+            return getattr(cache, method)(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, getattr(cache, method), *args)
+
+
+class AsyncGetShipment(AsyncService):
+    """
+    Awaitable GetShipment, answering from the service's shipment cache when
+    it has one
+    """
+    async def __call__(self, shipment_id):
+        shipment, request, process_kwargs = self.service.lookup(shipment_id)
+        if shipment is not None:
+            return shipment
+        return await self.call(request, **process_kwargs)
+
+
+class AsyncGetArtifact(AsyncService):
+    """
+    Awaitable GetArtifact, taking the same sink and checksum arguments.
+
+    The body is streamed like the synchronous client streams it: the
+    response is processed in the default executor, writing each chunk to the
+    sink (or the artifact store) as it's received, so neither the whole body
+    is held in memory nor the event loop blocked on disk writes
+    """
+    async def __call__(self, obj, sink=None, checksum=None):
+        artifact, request, process_kwargs = self.service.lookup(obj, sink,
+                                                                checksum)
+        if artifact is not None:
+            return artifact
+        request['stream'] = True
+        return await self.call(request, **process_kwargs)
+
+    async def process(self, response, **process_kwargs):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.service.process, response,
+                                        **process_kwargs))
+        finally:
+            # process_response closes it, but not if this was cancelled
+            response.close()
+
+
+class AsyncCanadaPostAPI(object):
+    """
+    asyncio twin of canada_post.api.CanadaPostAPI
+    """
+    def __init__(self, customer_number, username, password, contract_number="",
+                 dev=PROD, transport=None, rate_cache=None,
+                 coalesce_rates=False, rate_limits=None, retry_policy=None,
+                 rate_estimator=None, instrumentation=None, gateway=None,
+                 shipment_cache=None, artifact_store=None):
+        self.auth = Auth(customer_number, username, password, contract_number,
+                         dev)
+        if transport is None:
+            transport = AsyncTransport()
+        self.transport = transport
+        self.rate_limits = rate_limits
+        self.retry_policy = retry_policy
+        self.instrumentation = instrumentation
+        options = dict(rate_limits=rate_limits, retry_policy=retry_policy,
+                       instrumentation=instrumentation, gateway=gateway)
+        def wrap(service_class):
+            return AsyncService(service_class(self.auth, **options), transport)
+        self.get_rates = AsyncGetRates(GetRates(self.auth, cache=rate_cache,
+                                                coalesce=coalesce_rates,
+                                                estimator=rate_estimator,
+                                                **options),
+                                       transport)
+        self.create_shipment = wrap(CreateShipment)
+        self.get_shipment = AsyncGetShipment(
+            GetShipment(self.auth, cache=shipment_cache, **options), transport)
+        self.void_shipment = AsyncService(
+            VoidShipment(self.auth, cache=shipment_cache, **options),
+            transport)
+        self.transmit_shipments = wrap(TransmitShipments)
+        self.get_manifest = wrap(GetManifest)
+        self.get_artifact = AsyncGetArtifact(
+            GetArtifact(self.auth, store=artifact_store, **options),
+            transport)
+        self.get_manifest_shipments = wrap(GetManifestShipments)
+        self.get_groups = wrap(GetGroups)
+
+    async def close(self):
+        await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncClientRegistry(ClientRegistry):
+    """
+    asyncio twin of canada_post.registry.ClientRegistry, holding
+    AsyncCanadaPostAPI clients. get (which loads unknown accounts) is a
+    coroutine, and the loader may be one too; registry[key] only returns
+    accounts that are already registered
+    """
+    client_class = AsyncCanadaPostAPI
+    log = logging.getLogger('canada_post.aio.AsyncClientRegistry')
+
+    def __init__(self, loader=None, **options):
+        super(AsyncClientRegistry, self).__init__(loader, **options)
+        self._loads = AsyncSingleFlight()
+
+    async def _load(self, key):
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        account = self.loader(key)
+        if inspect.isawaitable(account):
+            account = await account
+        if account is None:
+            raise KeyError(key)
+        return self._create(key, **account)
+
+    async def get(self, key):
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        if self.loader is None:
+            raise KeyError(key)
+        return await self._loads.do(key, self._load, key)
+
+    def __getitem__(self, key):
+        return self._clients[key]
+
+    async def unregister(self, key):
+        await self._pop(key).close()
+
+    async def close(self):
+        for client in self._pop_all():
+            await client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -8,18 +8,89 @@ from canada_post.service.contract_shipping import (CreateShipment, GetShipment,
                                                    GetManifest, GetArtifact,
                                                    GetManifestShipments, GetGroups)
 from canada_post.service.rating import (GetRates)
+from canada_post.service.bulk import (BulkArtifactFetcher, BulkShipmentCreator,
+                                     ManifestExpander)
+from canada_post.transport import Transport
 
 class CanadaPostAPI(object):
+    """
+    All services share one pooled keep-alive Transport. Pass your own to tune
+    pool sizes and timeouts, e.g.
+
+        CanadaPostAPI(..., transport=Transport(pool_maxsize=50,
+                                               timeout=(3, 20)))
+
+    and check `cpa.transport.stats` to see how many connections got reused.
+
+    Pass a canada_post.cache.RateCache as rate_cache to answer repeated
+    get_rates scenarios from the cache, and coalesce_rates=True to have
+    concurrent get_rates calls for the same scenario share one request.
+    Pass a canada_post.estimate.RateEstimator as rate_estimator to have it
+    learn every quote, and estimate rates offline with
+    `cpa.get_rates.estimate(parcel, origin, dest)`.
+
+    Pass a canada_post.ratelimit.RateLimits as rate_limits to keep each
+    endpoint family under its own request rate, backing off when Canada Post
+    answers 429 or 503. See `cpa.rate_limits.stats()`.
+
+    Pass a canada_post.retry.RetryPolicy as retry_policy to retry transient
+    failures, optionally with a CircuitBreaker to fail fast with CircuitOpen
+    while Canada Post is down.
+
+    Pass a canada_post.instrument.Instrumentation as instrumentation to get
+    per endpoint latency histograms (`cpa.instrumentation.snapshot()`) and
+    request hooks.
+
+    Pass a canada_post.cache.ShipmentCache as shipment_cache to answer
+    repeated get_shipment lookups from it (void_shipment drops the shipments
+    it voids).
+
+    Pass a canada_post.artifacts.ArtifactStore as artifact_store to keep the
+    artifacts get_artifact downloads, and serve them again from it.
+
+    Pass a base URL as gateway (e.g. 'http://localhost:8080') to send every
+    request there instead of Canada Post's servers, such as the simulator
+    in benchmarks/gateway.py.
+    """
     def __init__(self, customer_number, username, password, contract_number="",
-                 dev=PROD):
+                 dev=PROD, transport=None, rate_cache=None,
+                 coalesce_rates=False, rate_limits=None, retry_policy=None,
+                 rate_estimator=None, instrumentation=None, gateway=None,
+                 shipment_cache=None, artifact_store=None):
         self.auth = Auth(customer_number, username, password, contract_number,
                          dev)
-        self.get_rates = GetRates(self.auth)
-        self.create_shipment = CreateShipment(self.auth)
-        self.get_shipment = GetShipment(self.auth)
-        self.void_shipment = VoidShipment(self.auth)
-        self.transmit_shipments = TransmitShipments(self.auth)
-        self.get_manifest = GetManifest(self.auth)
-        self.get_artifact = GetArtifact(self.auth)
-        self.get_manifest_shipments = GetManifestShipments(self.auth)
-        self.get_groups = GetGroups(self.auth)
+        if transport is None:
+            transport = Transport()
+        self.transport = transport
+        self.rate_limits = rate_limits
+        self.retry_policy = retry_policy
+        self.instrumentation = instrumentation
+        options = dict(transport=transport, rate_limits=rate_limits,
+                       retry_policy=retry_policy,
+                       instrumentation=instrumentation, gateway=gateway)
+        self.get_rates = GetRates(self.auth, cache=rate_cache,
+                                  coalesce=coalesce_rates,
+                                  estimator=rate_estimator, **options)
+        self.create_shipment = CreateShipment(self.auth, **options)
+        self.create_shipments = BulkShipmentCreator(self.create_shipment)
+        self.get_shipment = GetShipment(self.auth, cache=shipment_cache,
+                                        **options)
+        self.void_shipment = VoidShipment(self.auth, cache=shipment_cache,
+                                          **options)
+        self.transmit_shipments = TransmitShipments(self.auth, **options)
+        self.get_manifest = GetManifest(self.auth, **options)
+        self.get_artifact = GetArtifact(self.auth, store=artifact_store,
+                                        **options)
+        self.get_artifacts = BulkArtifactFetcher(self.get_artifact)
+        self.get_manifest_shipments = GetManifestShipments(self.auth,
+                                                           **options)
+        self.get_groups = GetGroups(self.auth, **options)
+        self.expand_manifests = ManifestExpander(
+            self.get_manifest, self.get_manifest_shipments, self.get_shipment,
+            self.transmit_shipments)
+
+    def close(self):
+        """
+        Close the pooled connections
+        """
+        self.transport.close()
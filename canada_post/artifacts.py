@@ -0,0 +1,333 @@
+"""
+Persistent store for artifacts (label and manifest PDFs).
+
+Give GetArtifact an ArtifactStore and every artifact it downloads is kept in
+a directory, under the link it was downloaded from, so printing a label again
+doesn't call Canada Post at all:
+
+    store = ArtifactStore('/var/lib/labels', max_bytes=2 * 1024 ** 3)
+    cpa = CanadaPostAPI(..., artifact_store=store)
+    cpa.get_artifact(shipment)       # downloaded, and kept
+    cpa.get_artifact(shipment)       # read from the store
+
+Artifacts are content-addressed: files are named after the digest of their
+content, so the same PDF downloaded from several links is stored once. When
+the store grows over max_bytes, the least recently used files are removed.
+Stored artifacts can be read through a memory map, to serve them without
+copying them into the process:
+
+    stored = store.get(shipment.links['label']['href'])
+    with stored.map() as content:
+        printer.sendall(content)
+
+The layout is
+
+    objects/<2 first digits>/<digest>   the artifacts
+    links/<sha1 of the link>            the digest, size and media type of
+                                        the artifact downloaded from a link
+
+Every file is written to a temporary name then renamed, so several processes
+can share a store. Each one counts the stored files again before evicting,
+and after storing a tenth of max_bytes, so the others' artifacts count
+towards the limit too. Temporary files left behind by a crashed download are
+removed once they're STALE_TMP seconds old.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from canada_post.cache import CacheStats
+from canada_post.util import InfoObject
+
+
+class ArtifactStoreStats(CacheStats):
+    """
+    hits and misses are lookups of links, deduplicated the artifacts
+    downloaded that were already stored under another link
+    """
+    def __init__(self):
+        super(ArtifactStoreStats, self).__init__()
+        self.deduplicated = 0
+
+    def duplicate(self):
+        with self._lock:
+            self.deduplicated += 1
+
+    def as_dict(self):
+        stats = super(ArtifactStoreStats, self).as_dict()
+        stats['deduplicated'] = self.deduplicated
+        return stats
+
+    def __repr__(self):
+        return ("ArtifactStoreStats(hits={hits}, misses={misses}, "
+                "evictions={evictions}, deduplicated={deduplicated})").format(
+                    **self.as_dict())
+
+
+class StoredArtifact(InfoObject):
+    """
+    An artifact in an ArtifactStore
+      * path: of its file. Don't write to it, other links may share it
+      * digest: hex digest of the content, with the store's algorithm
+      * size: in bytes
+      * media_type: as reported by Canada Post
+    """
+    def __init__(self, path, digest, size, media_type=None, **kwargs):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.media_type = media_type
+        super(StoredArtifact, self).__init__(**kwargs)
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    @contextmanager
+    def map(self):
+        """
+        Read-only memory map of the content, as a context manager
+        """
+        with self.open() as stored:
+            if not self.size:
+                # empty files can't be mapped
+                yield b''
+                return
+            content = mmap.mmap(stored.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield content
+            finally:
+                content.close()
+
+    def read(self):
+        with self.open() as stored:
+            return stored.read()
+
+    def copy_to(self, out):
+        """
+        Write the content into the writable file object out
+        """
+        with self.map() as content:
+            out.write(content)
+
+
+class ArtifactStore(object):
+    """
+    :directory: where the artifacts are kept, created if needed
+    :max_bytes: size over which the least recently used artifacts are removed
+    :algorithm: hashlib algorithm naming the artifacts
+    """
+    log = logging.getLogger('canada_post.artifacts.ArtifactStore')
+    chunk_size = 64 * 1024
+    # downloads can be slow, an hour old temporary file is surely left over
+    STALE_TMP = 3600
+
+    def __init__(self, directory, max_bytes=1024 ** 3, algorithm='sha256'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.algorithm = algorithm
+        self.stats = ArtifactStoreStats()
+        self._lock = threading.Lock()
+        self._objects = os.path.join(directory, 'objects')
+        self._links = os.path.join(directory, 'links')
+        self._tmp = os.path.join(directory, 'tmp')
+        for path in (self._objects, self._links, self._tmp):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        with self._lock:
+            self._scan()
+        self._sweep()
+
+    def _scan(self):
+        """
+        Count the stored artifacts again, from the directory: other
+        processes sharing it store and evict too. Called with the lock held
+        """
+        # digest -> size of every stored artifact
+        sizes = {}
+        for prefix in os.listdir(self._objects):
+            try:
+                digests = os.listdir(os.path.join(self._objects, prefix))
+            except OSError:
+                continue
+            for digest in digests:
+                try:
+                    sizes[digest] = os.path.getsize(
+                        os.path.join(self._objects, prefix, digest))
+                except OSError:
+                    # evicted meanwhile
+                    pass
+        self._sizes = sizes
+        self._stored = 0
+
+    def _sweep(self):
+        """
+        Remove the temporary files of downloads that never finished
+        """
+        now = time.time()
+        for name in os.listdir(self._tmp):
+            path = os.path.join(self._tmp, name)
+            try:
+                if now - os.path.getmtime(path) > self.STALE_TMP:
+                    os.remove(path)
+                    self.log.info("Removed stale temporary file %s", path)
+            except OSError:
+                pass
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sizes)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def _link_path(self, link):
+        return os.path.join(self._links,
+                            hashlib.sha1(link.encode('utf-8')).hexdigest())
+
+    def _write_atomically(self, path, data):
+        handle, temporary = tempfile.mkstemp(dir=self._tmp)
+        with os.fdopen(handle, 'wb') as out:
+            out.write(data)
+        os.rename(temporary, path)
+
+    def get(self, link):
+        """
+        The StoredArtifact downloaded from link, None if there's none
+        """
+        try:
+            with open(self._link_path(link), 'rb') as record:
+                entry = json.loads(record.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            self.stats.miss()
+            return None
+        path = self._object_path(entry['digest'])
+        try:
+            # the modification time is when it was last used
+            os.utime(path, None)
+        except OSError:
+            # evicted
+            self.stats.miss()
+            self._remove(self._link_path(link))
+            return None
+        self.stats.hit()
+        return StoredArtifact(path, entry['digest'], entry['size'],
+                              media_type=entry.get('media_type'))
+
+    def put(self, link, chunks, media_type=None):
+        """
+        Store the artifact downloaded from link, given as an iterable of
+        byte strings. Returns its StoredArtifact
+        """
+        digest = hashlib.new(self.algorithm)
+        size = 0
+        handle, temporary = tempfile.mkstemp(dir=self._tmp)
+        try:
+            with os.fdopen(handle, 'wb') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            digest = digest.hexdigest()
+            path = self._object_path(digest)
+            if os.path.exists(path):
+                self.stats.duplicate()
+                self.log.debug("Artifact from %s is already stored as %s",
+                               link, digest)
+                os.remove(temporary)
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    try:
+                        os.makedirs(os.path.dirname(path))
+                    except OSError:
+                        # created concurrently
+                        pass
+                os.rename(temporary, path)
+        except Exception:
+            self._remove(temporary)
+            raise
+        self._write_atomically(self._link_path(link), json.dumps({
+            'link': link, 'digest': digest, 'size': size,
+            'media_type': media_type}).encode('utf-8'))
+        self.log.info("Stored %d bytes of artifact from %s as %s", size, link,
+                      digest)
+        with self._lock:
+            self._sizes[digest] = size
+            self._stored += size
+            if self._stored > self.max_bytes * 0.1 or \
+                    sum(self._sizes.values()) > self.max_bytes:
+                # other processes may have stored or evicted artifacts
+                self._scan()
+            if sum(self._sizes.values()) > self.max_bytes:
+                self._evict(keep=digest)
+        return StoredArtifact(path, digest, size, media_type=media_type)
+
+    def _evict(self, keep):
+        def used(digest):
+            try:
+                return os.path.getmtime(self._object_path(digest))
+            except OSError:
+                return 0
+        # down to 90% of max_bytes, not to evict again on the next put
+        target = self.max_bytes * 0.9
+        total = sum(self._sizes.values())
+        evicted = 0
+        for digest in sorted(self._sizes, key=used):
+            if total <= target:
+                break
+            if digest == keep:
+                continue
+            total -= self._sizes.pop(digest)
+            self._remove(self._object_path(digest))
+            evicted += 1
+        if evicted:
+            self.stats.evicted(evicted)
+            self.log.info("Evicted %d artifacts, %d bytes left", evicted,
+                          total)
+            self.prune()
+
+    def prune(self):
+        """
+        Remove the links to artifacts that aren't stored anymore, and stale
+        temporary files
+        """
+        self._sweep()
+        for name in os.listdir(self._links):
+            path = os.path.join(self._links, name)
+            try:
+                with open(path, 'rb') as record:
+                    digest = json.loads(record.read().decode('utf-8'))['digest']
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            if not os.path.exists(self._object_path(digest)):
+                self._remove(path)
+
+    def discard(self, link):
+        """
+        Forget the artifact downloaded from link. Its content stays until
+        it's evicted, other links may share it
+        """
+        self._remove(self._link_path(link))
+
+    def clear(self):
+        with self._lock:
+            self._sizes.clear()
+            for path in (self._objects, self._links):
+                shutil.rmtree(path, ignore_errors=True)
+                os.makedirs(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
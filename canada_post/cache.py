@@ -0,0 +1,310 @@
+"""
+Caching for Canada Post service results.
+
+A cache is a front (RateCache, ShipmentCache) that keeps hit/miss statistics
+and a backend that stores the values:
+
+  * MemoryBackend keeps them in-process, in a size-bounded LRU with TTL
+  * SharedBackend keeps them in a redis-like key/value server, so several
+    worker processes share the cached values. Anything with redis-py's
+    get(key), set(key, value, ex=seconds), delete(*keys) and
+    scan_iter(match=pattern) works
+"""
+import hashlib
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def evicted(self, count=1):
+        with self._lock:
+            self.evictions += count
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hit_ratio,
+            }
+
+    def __repr__(self):
+        return ("CacheStats(hits={hits}, misses={misses}, "
+                "evictions={evictions})").format(**self.as_dict())
+
+
+class CacheBackend(object):
+    """
+    Interface for cache backends. Keys are hashable tuples, values anything
+    picklable. get returns None for missing or expired keys.
+
+    Backends that do network I/O set `blocking`, so that the asyncio client
+    calls them in an executor rather than on the event loop
+    """
+    blocking = False
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    In-process LRU cache holding up to maxsize values, each for at most its
+    ttl seconds
+    """
+    def __init__(self, maxsize=10000):
+        super(MemoryBackend, self).__init__()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires <= time.time():
+                return None
+            # re-insert as the most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            evicted = 0
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self.stats.evicted(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedBackend(CacheBackend):
+    """
+    Cache backend on a redis-like server shared by several processes.
+
+    Values are pickled and stored under `prefix` + a digest of the key, with
+    the server taking care of expiration. Size bounding and LRU eviction are
+    the server's job too (e.g. redis' maxmemory-policy allkeys-lru)
+    """
+    log = logging.getLogger('canada_post.cache.SharedBackend')
+    blocking = True
+
+    def __init__(self, client, prefix="canada_post:"):
+        super(SharedBackend, self).__init__()
+        self.client = client
+        self.prefix = prefix
+
+    def make_key(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return self.prefix + digest
+
+    def get(self, key):
+        data = self.client.get(self.make_key(key))
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            self.log.warning("Dropping unreadable cache entry for %r", key)
+            self.delete(key)
+            return None
+
+    def set(self, key, value, ttl):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if ttl is None:
+            self.client.set(self.make_key(key), data)
+        else:
+            self.client.set(self.make_key(key), data, ex=int(ttl) or 1)
+
+    def delete(self, key):
+        self.client.delete(self.make_key(key))
+
+    def clear(self, batch=500):
+        """
+        Delete every key under the prefix, batch keys at a time
+        """
+        keys = []
+        for key in self.client.scan_iter(match=self.prefix + '*',
+                                         count=batch):
+            keys.append(key)
+            if len(keys) >= batch:
+                self.client.delete(*keys)
+                keys = []
+        if keys:
+            self.client.delete(*keys)
+
+
+class RateCache(object):
+    """
+    Cache of GetRates results, keyed on the normalized mailing scenario (see
+    GetRates.cache_key), holding each quote for ttl seconds.
+
+    The default backend is an in-process MemoryBackend of up to maxsize
+    scenarios.
+
+    With by_zone=True, scenarios are keyed on the destination's rate zone
+    rather than on its postal code, when it has one (see
+    canada_post.zones): every destination in a zone shares the same quotes
+    """
+    log = logging.getLogger('canada_post.cache.RateCache')
+
+    def __init__(self, backend=None, ttl=15 * 60, maxsize=10000,
+                 by_zone=False):
+        if backend is None:
+            backend = MemoryBackend(maxsize=maxsize)
+        self.backend = backend
+        self.ttl = ttl
+        self.by_zone = by_zone
+        self.stats = backend.stats
+
+    def get(self, key):
+        services = self.backend.get(key)
+        if services is None:
+            self.stats.miss()
+            return None
+        self.stats.hit()
+        self.log.debug("Cache hit for scenario %r", key)
+        return list(services)
+
+    def set(self, key, services):
+        self.backend.set(key, list(services), self.ttl)
+
+    def invalidate(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+
+class CachedShipment(object):
+    """
+    A Shipment held by a ShipmentCache, with the validators Canada Post sent
+    with it (ETag and Last-Modified headers) and when it was last checked
+    """
+    def __init__(self, shipment, etag=None, last_modified=None, checked=None):
+        self.shipment = shipment
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked = time.time() if checked is None else checked
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ShipmentCache(object):
+    """
+    Cache of GetShipment results, keyed on the account, its environment (DEV
+    or PROD) and the shipment id.
+
+    A shipment is answered from the cache for `fresh` seconds after it was
+    fetched or last revalidated. After that, it's revalidated with a
+    conditional request, which Canada Post answers with 304 and no body if
+    the shipment hasn't changed (when it sent an ETag or Last-Modified
+    header). Entries are dropped after ttl seconds, and when VoidShipment
+    voids the shipment.
+
+    stats counts fresh answers as hits, full fetches as misses, and
+    `revalidated` the 304 answers
+    """
+    log = logging.getLogger('canada_post.cache.ShipmentCache')
+
+    def __init__(self, backend=None, fresh=60, ttl=24 * 3600, maxsize=10000):
+        if backend is None:
+            backend = MemoryBackend(maxsize=maxsize)
+        self.backend = backend
+        self.fresh = fresh
+        self.ttl = ttl
+        self.stats = backend.stats
+        self._lock = threading.Lock()
+        self.revalidated = 0
+
+    def key(self, auth, shipment_id):
+        return ('shipment', auth.dev, str(auth.customer_number),
+                str(shipment_id))
+
+    def get(self, key):
+        """
+        The CachedShipment for key, None if there's none
+        """
+        return self.backend.get(key)
+
+    def is_fresh(self, entry, now=None):
+        now = time.time() if now is None else now
+        return now - entry.checked < self.fresh
+
+    def set(self, key, shipment, etag=None, last_modified=None):
+        self.backend.set(key, CachedShipment(shipment, etag, last_modified),
+                         self.ttl)
+
+    def refresh(self, key, entry):
+        """
+        Mark entry as just revalidated
+        """
+        with self._lock:
+            self.revalidated += 1
+        entry.checked = time.time()
+        self.backend.set(key, entry, self.ttl)
+
+    def invalidate(self, key):
+        self.log.debug("Invalidating %r", key)
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
@@ -0,0 +1,7 @@
+"""
+Python 2/3 compatibility helpers
+"""
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
@@ -7,5 +7,20 @@ class CanadaPostError(Exception):
         self.message = message
         super(CanadaPostError, self).__init__(*args, **kwargs)
 
-def Wait(Exception):
-    pass
+class Wait(Exception):
+    """
+    Raised by GetArtifact when Canada Post answers 202: the artifact isn't
+    ready yet and has to be asked for again later. retry_after holds the
+    seconds Canada Post asked us to wait, if it said so
+    """
+    def __init__(self, retry_after=None, *args):
+        self.retry_after = retry_after
+        super(Wait, self).__init__(*args)
+
+class InDoubt(CanadaPostError):
+    """
+    A request that can't be safely repeated was sent, but whether Canada Post
+    acted on it is unknown (e.g. the connection dropped before the answer)
+    """
+    def __init__(self, message, *args, **kwargs):
+        super(InDoubt, self).__init__(None, message, *args, **kwargs)
@@ -0,0 +1,163 @@
+"""
+Offline rate estimation, from the quotes GetRates got before.
+
+A RateEstimator learns every GetRates answer it's given (see GetRates'
+estimator argument) and answers later scenarios from an in-memory index,
+without calling Canada Post. Prices depend on the account's contract, on
+the billable weight and on where the parcel goes, so quotes are indexed by
+account, origin FSA, destination country and FSA (ZIP3 for the US),
+billable weight bucket and service code.
+
+Every Estimate tells how old and how consistent the recent quotes behind it
+are, so the caller can decide between showing it and waiting for a live
+quote.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from canada_post.util import InfoObject
+
+# cm3 per kg, the volumetric weight divisor for parcels
+VOLUMETRIC_DIVISOR = 6000
+
+
+class Estimate(InfoObject):
+    """
+    An estimated quote: the Service from the latest quote seen for the
+    scenario's bucket, how many quotes were seen (samples), the age of the
+    latest one in seconds, and a confidence between 0 and 1
+    """
+    def __init__(self, service, samples, age, confidence, stale, **kwargs):
+        self.service = service
+        self.samples = samples
+        self.age = age
+        self.confidence = confidence
+        self.stale = stale
+        super(Estimate, self).__init__(**kwargs)
+
+    @property
+    def code(self):
+        return self.service.code
+
+    @property
+    def price(self):
+        return self.service.price
+
+    @property
+    def transit_time(self):
+        return self.service.transit_time
+
+
+def billable_weight(parcel):
+    """
+    The heavier of the parcel's weight and its volumetric weight, in kg
+    """
+    weight = float(parcel.weight or 0)
+    if parcel.length and parcel.width and parcel.height:
+        volume = (float(parcel.length) * float(parcel.width)
+                  * float(parcel.height))
+        weight = max(weight, volume / VOLUMETRIC_DIVISOR)
+    return weight
+
+
+def area(postal_code, country_code):
+    """
+    The part of a postal code that rates depend on: the FSA of a Canadian
+    postal code, the first three digits of a US zip code, nothing for other
+    countries
+    """
+    if country_code not in ("CA", "US") or not postal_code:
+        return None
+    return postal_code.replace(" ", "").upper()[:3]
+
+
+class RateEstimator(object):
+    """
+    Thread-safe index of past quotes.
+
+    :weight_step: width of the billable weight buckets, in kg
+    :max_age: seconds after which a quote is considered stale. An estimate's
+        confidence falls linearly from 1 to 0 over max_age, and is further
+        lowered when the last `window` quotes seen for the bucket disagree
+    :window: how many of the latest quotes of a service are compared; older
+        ones, say from before a price change, no longer count
+    :maxsize: buckets kept, the ones learned longest ago are dropped first
+
+    Quotes are learned and estimated per account, any hashable value telling
+    accounts apart (GetRates uses GetRates.account()), since contract
+    prices differ
+    """
+    def __init__(self, weight_step=0.5, max_age=24 * 3600, window=10,
+                 maxsize=100000):
+        self.weight_step = weight_step
+        self.max_age = max_age
+        self.window = window
+        self.maxsize = maxsize
+        self._index = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def bucket(self, parcel, origin, destination, account=None):
+        """
+        Index key for a mailing scenario of account
+        """
+        weight = int(math.ceil(billable_weight(parcel) / self.weight_step))
+        return (account, area(origin.postal_code, origin.country_code),
+                destination.country_code,
+                area(destination.postal_code, destination.country_code),
+                weight)
+
+    def learn(self, parcel, origin, destination, services, now=None,
+              account=None):
+        """
+        Add the Services GetRates returned for a scenario of account to the
+        index
+        """
+        key = self.bucket(parcel, origin, destination, account)
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = dict(self._index.pop(key, {}))
+            for service in services:
+                samples, dues = 0, ()
+                previous = entries.get(service.code)
+                if previous is not None:
+                    _, samples, _, dues = previous
+                dues = (dues + (service.price.due,))[-self.window:]
+                entries[service.code] = (service, samples + 1, now, dues)
+            # entries are replaced, never changed: once estimate has taken
+            # a bucket's dict under the lock, it can read it without
+            self._index[key] = entries
+            while len(self._index) > self.maxsize:
+                self._index.popitem(last=False)
+
+    def estimate(self, parcel, origin, destination, now=None, account=None):
+        """
+        Estimated quotes for a scenario of account, as a list of Estimates
+        (one per service code, cheapest first). Empty if no quote was
+        learned for its bucket
+        """
+        key = self.bucket(parcel, origin, destination, account)
+        # learn pops and reinserts buckets, so the index is only read locked
+        with self._lock:
+            entries = self._index.get(key)
+        if not entries:
+            return []
+        now = time.time() if now is None else now
+        estimates = []
+        for service, samples, learned, dues in entries.values():
+            age = max(now - learned, 0)
+            freshness = max(1 - float(age) / self.max_age, 0)
+            high = max(dues)
+            consistency = float(min(dues) / high) if high else 1.0
+            estimates.append(Estimate(service, samples, age,
+                                      freshness * consistency,
+                                      age > self.max_age))
+        estimates.sort(key=lambda estimate: estimate.price.due)
+        return estimates
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
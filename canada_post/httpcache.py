@@ -0,0 +1,486 @@
+"""
+HTTP cache for the GET endpoints (GetGroups, GetManifest, GetShipment,
+GetManifestShipments, and link-followed resources), at the transport level.
+
+Give a Transport (or AsyncTransport) an HTTPCache and the GET responses it
+receives are stored, per account and URL (and served to requests with the
+same Accept header), following their Cache-Control, Expires, ETag and
+Last-Modified headers:
+
+  * while a response is fresh (Cache-Control max-age, Expires, or the
+    cache's default_ttl when the response says neither), it's served
+    without a request
+  * after that, it's revalidated with If-None-Match/If-Modified-Since. A 304
+    answer serves the stored body again, and the service doesn't even parse
+    it again: the XML tree it parsed from that body last time is reused
+  * no-store responses are never stored, no-cache ones always revalidated
+  * a POST, PUT, DELETE or PATCH to a URL drops its stored response, as
+    VoidShipment's DELETE does for the shipment's
+
+Responses live in a MemoryStorage or a DiskStorage, both bounded in bytes and
+evicting the least recently used. Streamed requests (artifacts) and requests
+that carry their own conditional headers bypass the cache. See stats for hit
+ratios.
+"""
+import calendar
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+from canada_post.cache import CacheStats
+
+# response headers kept with a stored response
+STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control',
+                  'Expires', 'Date')
+# methods that change the resource at their URL
+UNSAFE_METHODS = frozenset(['POST', 'PUT', 'DELETE', 'PATCH'])
+
+
+class HTTPCacheStats(CacheStats):
+    """
+    hits are responses served without a request, revalidated the ones served
+    after a 304, misses the ones fetched in full. hit_ratio counts both hits
+    and revalidations, fresh_ratio only hits
+    """
+    def __init__(self):
+        super(HTTPCacheStats, self).__init__()
+        self.revalidated = 0
+        self.stored = 0
+
+    def revalidation(self):
+        with self._lock:
+            self.revalidated += 1
+
+    def store(self):
+        with self._lock:
+            self.stored += 1
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.revalidated + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits + self.revalidated) / lookups
+
+    @property
+    def fresh_ratio(self):
+        lookups = self.hits + self.revalidated + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def as_dict(self):
+        stats = super(HTTPCacheStats, self).as_dict()
+        stats.update(revalidated=self.revalidated, stored=self.stored,
+                     fresh_ratio=self.fresh_ratio)
+        return stats
+
+    def __repr__(self):
+        return ("HTTPCacheStats(hits={hits}, revalidated={revalidated}, "
+                "misses={misses}, evictions={evictions})").format(
+                    **self.as_dict())
+
+
+class CachedResponse(object):
+    """
+    A stored response: what's needed to answer again with it, and to
+    revalidate it. accept is the Accept header it was requested with
+    """
+    def __init__(self, url, status_code, reason, headers, content,
+                 expires=None, stored=None, accept=None):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.expires = expires
+        self.stored = time.time() if stored is None else stored
+        self.accept = accept
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified')
+
+    @property
+    def validator(self):
+        return self.etag or self.last_modified or self.stored
+
+    @property
+    def size(self):
+        return len(self.content) + sum(len(name) + len(value) for name, value
+                                       in self.headers.items()) + 256
+
+    def is_fresh(self, now=None):
+        now = time.time() if now is None else now
+        return self.expires is not None and now < self.expires
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+def parse_cache_control(value):
+    """
+    Directives of a Cache-Control header, as a dict of name -> value (None
+    for directives without one)
+    """
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def _http_date(value):
+    parsed = parsedate_tz(value) if value else None
+    if parsed is None:
+        return None
+    if parsed[9] is None:
+        return calendar.timegm(parsed[:9])
+    return mktime_tz(parsed)
+
+
+def freshness(headers, default_ttl=0, now=None):
+    """
+    Seconds a response with headers stays fresh, None if it mustn't be
+    stored
+    """
+    control = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in control:
+        return None
+    if 'no-cache' in control:
+        return 0
+    max_age = control.get('max-age')
+    if max_age is not None and max_age.isdigit():
+        return int(max_age)
+    expires = _http_date(headers.get('Expires'))
+    if expires is not None:
+        date = _http_date(headers.get('Date'))
+        now = time.time() if now is None else now
+        return max(expires - (date if date is not None else now), 0)
+    return default_ttl
+
+
+class MemoryStorage(object):
+    """
+    In-process LRU storage holding up to max_bytes of responses
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._data[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        evicted = 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            if entry.size > self.max_bytes:
+                return 0
+            self._data[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self.size -= old.size
+                evicted += 1
+        return evicted
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class DiskStorage(object):
+    """
+    Storage in a directory, one file per response, holding up to max_bytes.
+    The least recently used files (by modification time, which reads touch)
+    are removed when it's full. Files are replaced atomically, so several
+    processes can share the directory: each one counts the files again
+    before evicting, and after writing a tenth of max_bytes, so the others'
+    files count towards the limit too
+    """
+    log = logging.getLogger('canada_post.httpcache.DiskStorage')
+    SUFFIX = '.response'
+    # temporary files older than this are left over by a crashed writer
+    STALE_TMP = 3600
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            self._scan()
+
+    def _scan(self):
+        """
+        Count the stored files again, from the directory, and remove stale
+        temporary files. Called with the lock held
+        """
+        sizes = {}
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(self.SUFFIX):
+                    sizes[name] = os.path.getsize(path)
+                elif name.endswith('.tmp') and \
+                        now - os.path.getmtime(path) > self.STALE_TMP:
+                    os.remove(path)
+            except OSError:
+                # removed meanwhile
+                pass
+        self._sizes = sizes
+        self._written = 0
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sizes)
+
+    def _name(self, key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + \
+            self.SUFFIX
+
+    def get(self, key):
+        path = os.path.join(self.directory, self._name(key))
+        try:
+            with open(path, 'rb') as stored:
+                data = stored.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        try:
+            key_stored, entry = pickle.loads(data)
+        except Exception:
+            self.log.warning("Dropping unreadable cached response %s", path)
+            self.delete(key)
+            return None
+        # a digest collision, however unlikely, mustn't serve another URL
+        return entry if key_stored == key else None
+
+    def set(self, key, entry):
+        data = pickle.dumps((key, entry), pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return 0
+        name = self._name(key)
+        handle, temporary = tempfile.mkstemp(dir=self.directory,
+                                             suffix='.tmp')
+        with os.fdopen(handle, 'wb') as stored:
+            stored.write(data)
+        os.rename(temporary, os.path.join(self.directory, name))
+        with self._lock:
+            self._sizes[name] = len(data)
+            self._written += len(data)
+            if self._written > self.max_bytes * 0.1 or \
+                    sum(self._sizes.values()) > self.max_bytes:
+                # other processes may have added or removed files
+                self._scan()
+            if sum(self._sizes.values()) <= self.max_bytes:
+                return 0
+            return self._evict()
+
+    def _evict(self):
+        def used(name):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                return 0
+        evicted = 0
+        # down to 90% of max_bytes, not to evict again on the next set
+        target = self.max_bytes * 0.9
+        total = sum(self._sizes.values())
+        for name in sorted(self._sizes, key=used):
+            if total <= target:
+                break
+            total -= self._sizes.pop(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            evicted += 1
+        return evicted
+
+    def delete(self, key):
+        name = self._name(key)
+        with self._lock:
+            self._sizes.pop(name, None)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._scan()
+            names = list(self._sizes)
+            self._sizes.clear()
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class HTTPCache(object):
+    """
+    :storage: MemoryStorage (the default) or DiskStorage
+    :default_ttl: seconds responses that don't say how long they're fresh
+        are served without revalidation. 0 revalidates them every time
+    :memo_size: how many parsed trees are kept for reuse on 304s
+    """
+    log = logging.getLogger('canada_post.httpcache.HTTPCache')
+
+    def __init__(self, storage=None, default_ttl=0, memo_size=1024):
+        self.storage = MemoryStorage() if storage is None else storage
+        self.default_ttl = default_ttl
+        self.memo_size = memo_size
+        self.stats = HTTPCacheStats()
+        self._memos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, method, url, headers=None, auth=None, stream=False):
+        """
+        Cache key of a request, None if it can't use the cache
+        """
+        headers = headers or {}
+        if method.upper() != 'GET' or stream or \
+                'If-None-Match' in headers or 'If-Modified-Since' in headers:
+            return None
+        return (self._account(auth), url, headers.get('Accept'))
+
+    def _account(self, auth):
+        # responses are per account
+        return auth[0] if isinstance(auth, tuple) else None
+
+    def _stored_key(self, key):
+        # one response is stored per account and URL, whatever its Accept
+        # header, so that invalidate can find it
+        return key[:2]
+
+    def lookup(self, key):
+        """
+        The stored response for key (fresh or not), None if there's none
+        """
+        entry = self.storage.get(self._stored_key(key))
+        if entry is None or getattr(entry, 'accept', None) != key[2]:
+            return None
+        return entry
+
+    def invalidate(self, method, url, auth=None):
+        """
+        Drop the stored response for url if method changes it (see
+        UNSAFE_METHODS). The transports call this around those requests
+        """
+        if method.upper() not in UNSAFE_METHODS:
+            return
+        self.log.debug("Invalidating %s after a %s", url, method.upper())
+        self.storage.delete((self._account(auth), url))
+
+    def hit(self, entry):
+        self.stats.hit()
+        self.log.debug("Serving %s from the cache", entry.url)
+
+    def store(self, key, url, status_code, reason, headers, content):
+        """
+        Store a response fetched in full, if it may be. Returns the
+        CachedResponse, or None
+        """
+        self.stats.miss()
+        if status_code != 200:
+            return None
+        headers = dict((name, headers[name]) for name in STORED_HEADERS
+                       if headers.get(name) is not None)
+        ttl = freshness(headers, self.default_ttl)
+        if ttl is None or not (ttl or 'ETag' in headers or
+                               'Last-Modified' in headers):
+            # not storable, or useless: never fresh and can't be revalidated
+            return None
+        entry = CachedResponse(url, status_code, reason, headers, content,
+                               expires=time.time() + ttl, accept=key[2])
+        self.stats.store()
+        evicted = self.storage.set(self._stored_key(key), entry)
+        if evicted:
+            self.stats.evicted(evicted)
+        return entry
+
+    def revalidate(self, key, entry, headers):
+        """
+        Store a new copy of entry, updated after a 304 with headers, and
+        return it. entry itself is left alone: other threads may be
+        replaying it
+        """
+        self.stats.revalidation()
+        updated = dict(entry.headers)
+        for name in STORED_HEADERS:
+            if headers.get(name) is not None and name != 'Content-Type':
+                updated[name] = headers[name]
+        ttl = freshness(updated, self.default_ttl)
+        entry = CachedResponse(entry.url, entry.status_code, entry.reason,
+                               updated, entry.content,
+                               expires=time.time() + (ttl or 0),
+                               stored=entry.stored,
+                               accept=getattr(entry, 'accept', key[2]))
+        evicted = self.storage.set(self._stored_key(key), entry)
+        if evicted:
+            self.stats.evicted(evicted)
+        return entry
+
+    def memo(self, key, entry):
+        """
+        The dict the services keep the XML tree parsed from entry's content
+        in (see ServiceBase.parse_xml), shared by every response served from
+        the same stored content
+        """
+        memo_key = (key, entry.validator)
+        with self._lock:
+            memo = self._memos.pop(memo_key, None)
+            if memo is None:
+                memo = {}
+            self._memos[memo_key] = memo
+            while len(self._memos) > self.memo_size:
+                self._memos.popitem(last=False)
+        return memo
+
+    def clear(self):
+        self.storage.clear()
+        with self._lock:
+            self._memos.clear()
@@ -0,0 +1,271 @@
+"""
+Request instrumentation for the Canada Post services.
+
+Give the services an Instrumentation (CanadaPostAPI's instrumentation
+argument) and every call is measured:
+
+  * its phases: connect (DNS lookup and TCP handshake; aiohttp reports the
+    DNS lookup apart), tls (the TLS handshake; included in connect with
+    aiohttp), server (from sending the request to receiving the response)
+    and parse (turning the response into the service's result), plus the
+    total. Connection phases only show up for calls that opened a new
+    connection
+  * the request and response payload sizes and the response status code
+
+and recorded in latency histograms per endpoint family (rating, shipment,
+manifest, artifact) and phase. Hooks see every call before it's sent and
+after it's done, and exporters publish the collected statistics wherever
+they're needed.
+"""
+import logging
+import threading
+import time
+from canada_post.util import InfoObject
+
+PHASES = ('dns', 'connect', 'tls', 'server', 'parse', 'total')
+
+
+class Histogram(object):
+    """
+    Thread-safe HDR-style latency histogram: values are counted in buckets
+    whose width grows with the value, so that any recorded value is known to
+    within 1 / 2 ** (precision_bits - 1) (about 1.6% by default), whatever
+    its magnitude, in constant memory. Values are recorded in seconds, with
+    microsecond resolution
+    """
+    def __init__(self, precision_bits=7):
+        self.precision_bits = precision_bits
+        self._lock = threading.Lock()
+        self._counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = max(value.bit_length() - self.precision_bits, 0)
+        return shift, value >> shift
+
+    def record(self, seconds):
+        value = max(int(seconds * 1e6), 0)
+        index = self._index(value)
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, percent):
+        """
+        Value (in seconds) below which percent % of the recorded ones are
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(percent / 100.0 * self.count, 1)
+            seen = 0
+            for shift, value in sorted(self._counts):
+                seen += self._counts[shift, value]
+                if seen >= rank:
+                    # middle of the bucket
+                    low = value << shift
+                    return min((low + ((1 << shift) - 1) / 2.0) / 1e6,
+                               self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'min': self.min,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max,
+            }
+
+
+class RequestEvent(InfoObject):
+    """
+    One service call, as seen by the hooks. Pre-request hooks get it with
+    the request (the keyword arguments of the HTTP request, which they may
+    change) filled; post-response hooks once the call is done, with
+    status_code, sizes, phases (seconds per phase) and error, if it failed
+    """
+    def __init__(self, service, endpoint, request, **kwargs):
+        self.service = service
+        self.endpoint = endpoint
+        self.request = request
+        self.method = request.get('method', '').upper()
+        self.url = request.get('url')
+        data = request.get('data')
+        self.request_size = len(data) if data else 0
+        self.status_code = None
+        self.response_size = None
+        self.phases = {}
+        self.error = None
+        self.started = time.time()
+        self.parse_started = None
+        super(RequestEvent, self).__init__(**kwargs)
+
+
+def response_size(response):
+    """
+    Size of a response's body, without reading it if it's streamed
+    """
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        return int(length)
+    if hasattr(response, '_content'):
+        # a requests.Response, whose _content is the body once it's read
+        content = response._content
+    else:
+        content = response.content
+    if isinstance(content, bytes):
+        return len(content)
+    return None
+
+
+class EndpointStats(object):
+    def __init__(self, precision_bits=7):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.statuses = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency = dict((phase, Histogram(precision_bits))
+                            for phase in PHASES)
+
+    def record(self, event):
+        with self._lock:
+            self.requests += 1
+            if event.error is not None:
+                self.errors += 1
+            if event.status_code is not None:
+                self.statuses[event.status_code] = \
+                    self.statuses.get(event.status_code, 0) + 1
+            self.request_bytes += event.request_size
+            self.response_bytes += event.response_size or 0
+        for phase, seconds in event.phases.items():
+            self.latency[phase].record(seconds)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'statuses': dict(self.statuses),
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'latency': dict((phase, histogram.as_dict())
+                            for phase, histogram in self.latency.items()
+                            if histogram.count),
+            }
+
+
+class Exporter(object):
+    """
+    Interface for statistics exporters (to a metrics server, a log...).
+    export gets Instrumentation.snapshot()'s dict
+    """
+    def export(self, snapshot):
+        raise NotImplementedError
+
+
+class LoggingExporter(Exporter):
+    """
+    Logs one line per endpoint and phase
+    """
+    log = logging.getLogger('canada_post.instrument.LoggingExporter')
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def export(self, snapshot):
+        for endpoint, stats in sorted(snapshot.items()):
+            self.log.log(self.level, "%s: %d requests, %d errors, "
+                         "statuses %r", endpoint, stats['requests'],
+                         stats['errors'], stats['statuses'])
+            for phase, latency in sorted(stats['latency'].items()):
+                self.log.log(self.level, "%s %s: p50 %.4fs, p99 %.4fs, "
+                             "max %.4fs", endpoint, phase, latency['p50'],
+                             latency['p99'], latency['max'])
+
+
+class Instrumentation(object):
+    """
+    :pre_request: callables called with the RequestEvent of every call
+        before it's sent
+    :post_response: callables called with the RequestEvent of every call
+        once it's done
+    :exporters: Exporters that export() publishes the statistics to
+    """
+    log = logging.getLogger('canada_post.instrument.Instrumentation')
+
+    def __init__(self, pre_request=None, post_response=None, exporters=None,
+                 precision_bits=7):
+        self.pre_request = list(pre_request or [])
+        self.post_response = list(post_response or [])
+        self.exporters = list(exporters or [])
+        self.precision_bits = precision_bits
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def endpoint(self, name):
+        stats = self.endpoints.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self.endpoints.setdefault(
+                    name, EndpointStats(self.precision_bits))
+        return stats
+
+    def start(self, service, request):
+        """
+        Create the RequestEvent of a service call and run the pre-request
+        hooks on it
+        """
+        event = RequestEvent(service.__class__.__name__, service.family,
+                             request)
+        for hook in self.pre_request:
+            hook(event)
+        return event
+
+    def responded(self, event, response):
+        event.status_code = response.status_code
+        event.response_size = response_size(response)
+        event.phases.update(getattr(response, 'phases', None) or {})
+        event.parse_started = time.time()
+
+    def finish(self, event, error=None):
+        """
+        Record a finished call and run the post-response hooks on it
+        """
+        now = time.time()
+        event.error = error
+        if event.parse_started is not None:
+            event.phases['parse'] = now - event.parse_started
+        event.phases['total'] = now - event.started
+        self.endpoint(event.endpoint).record(event)
+        for hook in self.post_response:
+            try:
+                hook(event)
+            except Exception:
+                self.log.exception("Post-response hook %r failed", hook)
+
+    def snapshot(self):
+        return dict((name, stats.as_dict())
+                    for name, stats in self.endpoints.items())
+
+    def export(self):
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter.export(snapshot)
+        return snapshot
@@ -0,0 +1,457 @@
+"""
+Durable outbox for creating and transmitting shipments.
+
+Instead of waiting for Canada Post, packing stations hand their shipments to
+an Outbox: the request is built (and validated) right away, saved in a local
+SQLite database, and sent later by a pool of worker threads, so enqueueing
+takes as long whatever the gateway is doing:
+
+    outbox = Outbox('outbox.db', cpa, workers=4)
+    outbox.subscribe(notify_station)  # called with each finished entry
+    outbox.start()
+    outbox.create_shipment(order.number, parcel, origin, dest, service,
+                           group_name)
+    ...
+    outbox.transmit_shipments('2026-10-18', origin, [group_name])
+    entry = outbox.get(order.number)   # or poll, or outbox.wait(key)
+
+Every entry is keyed by a caller supplied key (e.g. the order number), and
+enqueueing a key again returns the existing entry rather than a duplicate.
+Results are saved along with the requests, and given to the callbacks and
+to get/wait. A transmit is only sent once the shipments enqueued before it
+are done, so its manifests include them.
+
+As creating and transmitting aren't idempotent, an entry is only sent again
+when Canada Post certainly didn't act on it: the connection couldn't be
+opened, the circuit breaker was open or Canada Post answered 429. Those are
+retried with backoff, up to max_attempts. Requests that Canada Post refused
+(4xx) fail. Ones whose outcome is unknown (timeouts, dropped connections,
+5xx), and ones that were being sent when the process died, are put in doubt:
+check whether they were done (e.g. with GetGroups) and call retry or discard.
+
+Entries are claimed atomically, so two outboxes draining the same database
+never send an entry twice. Still, only open the database in one process at
+a time: opening it puts the entries another process is sending in doubt.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from canada_post.errors import CanadaPostError, InDoubt
+from canada_post.retry import CircuitOpen, connect_failed
+from canada_post.service.bulk import refused
+from canada_post.service.contract_shipping import Shipment
+from canada_post.util import InfoObject
+
+
+def _dump_shipment(shipment):
+    return dict(shipment.__dict__)
+
+
+def _load_shipment(data):
+    return Shipment(**data)
+
+
+def _same(value):
+    return value
+
+
+# kind -> name of the CanadaPostAPI service, result dumper and loader
+KINDS = {
+    'create_shipment': ('create_shipment', _dump_shipment, _load_shipment),
+    'transmit_shipments': ('transmit_shipments', _same, _same),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    method TEXT NOT NULL,
+    url TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    data BLOB,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, id);
+"""
+
+
+class OutboxEntry(InfoObject):
+    """
+    A request in the outbox, and where it stands
+      * key: the caller's key
+      * kind: 'create_shipment' or 'transmit_shipments'
+      * state: one of Outbox's PENDING, STARTED, DONE, FAILED and IN_DOUBT
+      * attempts: times it was sent
+      * result: the service's return value once DONE (a Shipment, or the
+        manifest links)
+      * error: what went wrong, for FAILED and IN_DOUBT entries
+    """
+    def __init__(self, id, key, kind, state, attempts=0, result=None,
+                 error=None, created=None, updated=None, **kwargs):
+        self.id = id
+        self.key = key
+        self.kind = kind
+        self.state = state
+        self.attempts = attempts
+        self.result = result
+        self.error = error
+        self.created = created
+        self.updated = updated
+        super(OutboxEntry, self).__init__(**kwargs)
+
+    @property
+    def finished(self):
+        return self.state in (Outbox.DONE, Outbox.FAILED, Outbox.IN_DOUBT)
+
+    @property
+    def ok(self):
+        return self.state == Outbox.DONE
+
+    def get_result(self):
+        """
+        The result of a DONE entry. Raises InDoubt for entries in doubt and
+        CanadaPostError for failed ones
+        """
+        if self.state == Outbox.IN_DOUBT:
+            raise InDoubt(self.error)
+        if self.state == Outbox.FAILED:
+            raise CanadaPostError(None, self.error)
+        return self.result
+
+
+class Outbox(object):
+    """
+    :path: of the SQLite database, created if needed
+    :api: the CanadaPostAPI sending the requests
+    :workers: threads sending requests
+    :max_attempts: sends of an entry that certainly didn't reach Canada Post
+        before it fails
+    :backoff: seconds before sending such an entry again, doubling after
+        each attempt up to max_backoff
+    :fsync: make every write survive OS crashes and power losses too, not
+        only process crashes
+    """
+    PENDING = 'pending'
+    STARTED = 'started'
+    DONE = 'done'
+    FAILED = 'failed'
+    IN_DOUBT = 'in-doubt'
+    log = logging.getLogger('canada_post.outbox.Outbox')
+
+    def __init__(self, path, api, workers=4, max_attempts=10, backoff=1.0,
+                 max_backoff=300.0, fsync=False):
+        self.path = path
+        self.api = api
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.callbacks = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._threads = []
+        self._stopping = False
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous={0}".format(
+            'FULL' if fsync else 'NORMAL'))
+        self._db.executescript(SCHEMA)
+        self._recover()
+
+    def _recover(self):
+        """
+        Put in doubt the entries a previous process was sending when it died
+        """
+        now = time.time()
+        with self._lock:
+            count = self._db.execute(
+                "UPDATE outbox SET state = ?, error = ?, updated = ? "
+                "WHERE state = ?",
+                (self.IN_DOUBT, "Sent by a previous process but its outcome "
+                 "is unknown", now, self.STARTED)).rowcount
+        if count:
+            self.log.warning("%d outbox entries were being sent when the "
+                             "last process stopped, they're in doubt", count)
+
+    def subscribe(self, callback):
+        """
+        Have callback called with the OutboxEntry of every entry that
+        finishes (done, failed or in doubt), from the worker threads
+        """
+        self.callbacks.append(callback)
+
+    def _entry(self, row):
+        if row is None:
+            return None
+        result = row['result']
+        if result is not None:
+            result = KINDS[row['kind']][2](json.loads(result))
+        return OutboxEntry(row['id'], row['key'], row['kind'], row['state'],
+                           attempts=row['attempts'], result=result,
+                           error=row['error'], created=row['created'],
+                           updated=row['updated'])
+
+    def enqueue(self, key, kind, request):
+        """
+        Save a prepared request (see ServiceBase.prepare_request) of a kind
+        of KINDS, to be sent by the workers. Returns its OutboxEntry, the
+        existing one if key was already enqueued
+        """
+        now = time.time()
+        data = request.get('data')
+        if data is not None:
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            data = sqlite3.Binary(data)
+        with self._lock:
+            try:
+                self._db.execute(
+                    "INSERT INTO outbox (key, kind, method, url, headers, "
+                    "data, state, created, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, kind, request['method'], request['url'],
+                     json.dumps(request.get('headers') or {}), data,
+                     self.PENDING, now, now))
+            except sqlite3.IntegrityError:
+                self.log.info("%r is already in the outbox", key)
+            else:
+                self._changed.notify()
+            return self._get(key)
+
+    def create_shipment(self, key, parcel, origin, destination, service,
+                        group, options=None):
+        """
+        Enqueue a CreateShipment, validated now. Returns its OutboxEntry
+        """
+        request = self.api.create_shipment.prepare_request(
+            parcel, origin, destination, service, group, options)
+        return self.enqueue(key, 'create_shipment', request)
+
+    def transmit_shipments(self, key, origin, group_ids, name=None,
+                           detailed=True, excluded_shipments=[]):
+        """
+        Enqueue a TransmitShipments. Returns its OutboxEntry
+        """
+        request = self.api.transmit_shipments.prepare_request(
+            origin, group_ids, name, detailed, excluded_shipments)
+        return self.enqueue(key, 'transmit_shipments', request)
+
+    def _get(self, key):
+        return self._entry(self._db.execute(
+            "SELECT * FROM outbox WHERE key = ?", (key,)).fetchone())
+
+    def get(self, key):
+        """
+        The OutboxEntry of key, None if it was never enqueued
+        """
+        with self._lock:
+            return self._get(key)
+
+    def entries(self, state=None):
+        """
+        Every OutboxEntry, or the ones in state, in the order they were
+        enqueued
+        """
+        with self._lock:
+            if state is None:
+                rows = self._db.execute("SELECT * FROM outbox ORDER BY id")
+            else:
+                rows = self._db.execute(
+                    "SELECT * FROM outbox WHERE state = ? ORDER BY id",
+                    (state,))
+            return [self._entry(row) for row in rows.fetchall()]
+
+    def stats(self):
+        """
+        The number of entries in each state
+        """
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT state, COUNT(*) FROM outbox GROUP BY state")
+                .fetchall())
+
+    def wait(self, key, timeout=None):
+        """
+        Wait until the entry of key is finished, up to timeout seconds.
+        Returns its OutboxEntry, finished or not
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while True:
+                entry = self._get(key)
+                if entry is None or entry.finished:
+                    return entry
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return entry
+                self._changed.wait(remaining)
+
+    def retry(self, key):
+        """
+        Send a failed or in doubt entry again. Only do so for entries in
+        doubt once you know Canada Post didn't act on them
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET state = ?, attempts = 0, not_before = 0, "
+                "error = NULL, updated = ? WHERE key = ? AND state IN (?, ?)",
+                (self.PENDING, time.time(), key, self.FAILED, self.IN_DOUBT))
+            self._changed.notify_all()
+
+    def discard(self, key):
+        """
+        Remove an entry that isn't being sent
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM outbox WHERE key = ? AND state != ?",
+                             (key, self.STARTED))
+
+    def _claim(self):
+        """
+        Mark the next entry due as started and return its row, or return
+        the seconds until one will be due (None if there's none, or they
+        wait for other entries to finish, 0 if it was claimed by another
+        outbox meanwhile)
+        """
+        now = time.time()
+        # a transmit waits for the shipments enqueued before it
+        row = self._db.execute(
+            "SELECT * FROM outbox AS entry WHERE state = ? AND not_before <= ? "
+            "AND (kind != 'transmit_shipments' OR NOT EXISTS ("
+            "  SELECT 1 FROM outbox WHERE id < entry.id "
+            "  AND kind = 'create_shipment' AND state IN (?, ?))) "
+            "ORDER BY id LIMIT 1",
+            (self.PENDING, now, self.PENDING, self.STARTED)).fetchone()
+        if row is None:
+            due = self._db.execute(
+                "SELECT MIN(not_before) FROM outbox WHERE state = ? "
+                "AND not_before > ?", (self.PENDING, now)).fetchone()[0]
+            return None if due is None else max(due - now, 0.01)
+        claimed = self._db.execute(
+            "UPDATE outbox SET state = ?, attempts = attempts + 1, "
+            "updated = ? WHERE id = ? AND state = ?",
+            (self.STARTED, now, row['id'], self.PENDING)).rowcount
+        if not claimed:
+            # another outbox on the database claimed it first, look again
+            return 0
+        return row
+
+    def _finish(self, row, state, result=None, error=None, not_before=0):
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET state = ?, result = ?, error = ?, "
+                "not_before = ?, updated = ? WHERE id = ?",
+                (state, result, error, not_before, time.time(), row['id']))
+            self._changed.notify_all()
+            entry = self._get(row['key'])
+        if entry.finished:
+            for callback in self.callbacks:
+                try:
+                    callback(entry)
+                except Exception:
+                    self.log.exception("Outbox callback %r failed", callback)
+
+    def send(self, row):
+        """
+        Send the request of a started entry and record its outcome
+        """
+        service_name, dump, _ = KINDS[row['kind']]
+        service = getattr(self.api, service_name)
+        request = {'method': row['method'], 'url': row['url'],
+                   'headers': json.loads(row['headers'])}
+        if row['data'] is not None:
+            request['data'] = bytes(row['data'])
+        attempt = row['attempts'] + 1
+        try:
+            result = service.call(request)
+        except Exception as error:
+            status = getattr(getattr(error, 'response', None), 'status_code',
+                             None)
+            if isinstance(error, CircuitOpen) or connect_failed(error) or \
+                    status == 429:
+                # never reached Canada Post, or turned away before acting
+                if attempt < self.max_attempts:
+                    delay = min(self.max_backoff,
+                                self.backoff * 2 ** (attempt - 1))
+                    if isinstance(error, CircuitOpen):
+                        delay = max(delay, error.retry_after)
+                    self.log.info("Outbox entry %r not sent (%r), trying "
+                                  "again in %.1fs", row['key'], error, delay)
+                    self._finish(row, self.PENDING, error=repr(error),
+                                 not_before=time.time() + delay)
+                else:
+                    self._finish(row, self.FAILED, error=repr(error))
+            elif refused(error):
+                self._finish(row, self.FAILED, error=repr(error))
+            else:
+                self.log.warning("Outcome of outbox entry %r unknown: %r",
+                                 row['key'], error)
+                self._finish(row, self.IN_DOUBT, error=repr(error))
+            return
+        self._finish(row, self.DONE, result=json.dumps(dump(result)))
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._stopping:
+                        return
+                    claimed = self._claim()
+                    if isinstance(claimed, sqlite3.Row):
+                        break
+                    self._changed.wait(claimed)
+            try:
+                self.send(claimed)
+            except Exception as error:
+                # e.g. the result couldn't be saved; don't lose the thread
+                self.log.exception("Outbox entry %r failed", claimed['key'])
+                self._finish(claimed, self.IN_DOUBT, error=repr(error))
+
+    def start(self):
+        """
+        Start the worker threads
+        """
+        with self._lock:
+            self._stopping = False
+        for number in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work,
+                                      name='canada-post-outbox')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """
+        Stop the worker threads, once they're done sending their current
+        entry
+        """
+        with self._lock:
+            self._stopping = True
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def close(self):
+        self.stop()
+        self._db.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,158 @@
+"""
+Client side rate limiting for the Canada Post gateway.
+
+Each endpoint family (rating, shipment, manifest, artifact) gets its own
+AdaptiveRateLimiter, a token bucket whose rate backs off when the gateway
+throttles us (429 or 503 answers, honouring Retry-After) and slowly climbs
+back to the configured rate as requests succeed.
+
+Callers reserve a token and wait the delay they're given before sending, so
+the same limiter works for threads (acquire) and for coroutines
+(await asyncio.sleep(limiter.reserve())).
+"""
+import logging
+import math
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+THROTTLED = (429, 503)
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait according to a Retry-After header value (either a number
+    of seconds or an HTTP date), None if it can't be parsed
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - time.time(), 0)
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Thread-safe token bucket allowing `rate` requests per second, in bursts
+    of up to `burst` requests.
+
+    Each throttled answer cuts the rate by the `decrease` factor (at most
+    once per second, down to min_rate), and each successful one adds
+    `increase` / rate to it, i.e. about `increase` requests per second for
+    every second of traffic, up to max_rate (the initial rate by default)
+    """
+    log = logging.getLogger('canada_post.ratelimit.AdaptiveRateLimiter')
+
+    def __init__(self, rate=10.0, burst=None, min_rate=0.5, max_rate=None,
+                 decrease=0.5, increase=0.5):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate or rate)
+        self.min_rate = float(min_rate)
+        self.burst = burst or max(1, int(rate))
+        self.decrease = decrease
+        self.increase = increase
+        self.throttled = 0
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """
+        Take a token, returning the seconds to wait before using it
+        """
+        with self._lock:
+            self._refill(time.time())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Take a token, sleeping until it's available
+        """
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    @property
+    def queue_depth(self):
+        """
+        Number of requests waiting for their token
+        """
+        with self._lock:
+            self._refill(time.time())
+            return max(int(math.ceil(-self._tokens)), 0)
+
+    def feedback(self, status_code, headers=None):
+        """
+        Adapt the rate to the status code (and Retry-After header) of a
+        response
+        """
+        with self._lock:
+            now = time.time()
+            if status_code in THROTTLED:
+                self.throttled += 1
+                if now - self._last_decrease >= 1:
+                    self._last_decrease = now
+                    self._refill(now)
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.log.warning("Throttled by Canada Post (%d), rate "
+                                     "down to %.2f/s", status_code, self.rate)
+                retry_after = parse_retry_after(
+                    (headers or {}).get('Retry-After'))
+                if retry_after:
+                    # nobody gets a token before retry_after seconds
+                    self._refill(now)
+                    self._tokens = min(self._tokens, -retry_after * self.rate)
+            elif status_code < 400 and self.rate < self.max_rate:
+                self._refill(now)
+                self.rate = min(self.max_rate,
+                                self.rate + self.increase / self.rate)
+
+    def as_dict(self):
+        return {
+            'rate': self.rate,
+            'queue_depth': self.queue_depth,
+            'throttled': self.throttled,
+            }
+
+
+class RateLimits(object):
+    """
+    The AdaptiveRateLimiters of each endpoint family, created on first use.
+    `rates` maps family names to their rate, the rest get `rate`. Any other
+    keyword arguments are passed on to the limiters
+    """
+    def __init__(self, rate=10.0, rates=None, **limiter_options):
+        self.rate = rate
+        self.rates = rates or {}
+        self.limiter_options = limiter_options
+        self.limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, family):
+        limiter = self.limiters.get(family)
+        if limiter is None:
+            with self._lock:
+                limiter = self.limiters.get(family)
+                if limiter is None:
+                    limiter = AdaptiveRateLimiter(
+                        rate=self.rates.get(family, self.rate),
+                        **self.limiter_options)
+                    self.limiters[family] = limiter
+        return limiter
+
+    def stats(self):
+        return dict((family, limiter.as_dict())
+                    for family, limiter in self.limiters.items())
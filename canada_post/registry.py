@@ -0,0 +1,124 @@
+"""
+Clients for many Canada Post accounts in one process.
+
+A ClientRegistry holds one CanadaPostAPI per account, each with its own
+credentials, contract number and connection pool, so one worker can serve
+rates and shipments for many merchants at once:
+
+    registry = ClientRegistry(rate_cache=RateCache())
+    registry.register('acme', customer_number, username, password,
+                      contract_number)
+    services = registry['acme'].get_rates(parcel, origin, dest)
+
+Accounts can also be loaded on first use, e.g. from a database, by giving the
+registry a loader. canada_post.aio.AsyncClientRegistry is the asyncio twin.
+"""
+import logging
+import threading
+from canada_post import PROD
+from canada_post.api import CanadaPostAPI
+from canada_post.singleflight import SingleFlight
+
+
+class ClientRegistry(object):
+    """
+    :loader: callable taking the key of an account that isn't registered and
+        returning the keyword arguments to register it with
+        (customer_number, username, password, contract_number...), or None
+        if there's no such account. Concurrent lookups of the same account
+        share one load
+    Other keyword arguments are client options shared by every account (e.g.
+    rate_cache or instrumentation), which register's own options override.
+    rate_cache and rate_estimator can be shared, their keys include the
+    account. Give rate_limits per account: Canada Post's quotas are per
+    account
+    """
+    client_class = CanadaPostAPI
+    log = logging.getLogger('canada_post.registry.ClientRegistry')
+
+    def __init__(self, loader=None, **options):
+        self.loader = loader
+        self.options = options
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._loads = SingleFlight()
+
+    def _create(self, key, customer_number, username, password,
+                contract_number="", dev=PROD, **options):
+        client_options = dict(self.options)
+        client_options.update(options)
+        with self._lock:
+            if key in self._clients:
+                raise KeyError("Account {0!r} is already registered".format(
+                    key))
+            client = self._clients[key] = self.client_class(
+                customer_number, username, password, contract_number, dev,
+                **client_options)
+        self.log.info("Registered account %r (customer %s)", key,
+                      customer_number)
+        return client
+
+    def register(self, key, customer_number, username, password,
+                 contract_number="", dev=PROD, **options):
+        """
+        Create the client of an account. Raises KeyError if key is already
+        registered
+        """
+        return self._create(key, customer_number, username, password,
+                            contract_number, dev, **options)
+
+    def _load(self, key):
+        # another caller may have registered it while we waited
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        account = self.loader(key)
+        if account is None:
+            raise KeyError(key)
+        return self._create(key, **account)
+
+    def get(self, key):
+        """
+        The client of an account, loading it if there's a loader. Raises
+        KeyError for unknown accounts
+        """
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        if self.loader is None:
+            raise KeyError(key)
+        return self._loads.do(key, self._load, key)
+
+    __getitem__ = get
+
+    def __contains__(self, key):
+        return key in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def keys(self):
+        return list(self._clients)
+
+    def _pop(self, key):
+        with self._lock:
+            return self._clients.pop(key)
+
+    def _pop_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        return clients
+
+    def unregister(self, key):
+        """
+        Forget an account and close its connections
+        """
+        self._pop(key).close()
+
+    def close(self):
+        """
+        Close the connections of every account, and forget them
+        """
+        for client in self._pop_all():
+            client.close()
@@ -0,0 +1,186 @@
+"""
+Retries and circuit breaking for the Canada Post services.
+
+A RetryPolicy decides whether a failed request is sent again, and after how
+long: transient failures (connection errors, timeouts, 5xx and 429 answers)
+are retried with exponential backoff and jitter, but only when repeating the
+request is harmless. Services whose calls aren't idempotent (creating,
+transmitting or voiding shipments) are only retried when the request
+provably never reached Canada Post, or was refused with 429.
+
+A policy can carry a CircuitBreaker, which makes calls fail fast with
+CircuitOpen while the gateway keeps failing, instead of having every caller
+wait for its own timeouts.
+"""
+import logging
+import random
+import threading
+import time
+import requests
+from urllib3.exceptions import NewConnectionError
+from canada_post.errors import CanadaPostError
+from canada_post.ratelimit import parse_retry_after
+
+
+class CircuitOpen(CanadaPostError):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+    retry_after holds the seconds until it lets a request through again
+    """
+    def __init__(self, retry_after, *args, **kwargs):
+        self.retry_after = retry_after
+        super(CircuitOpen, self).__init__(
+            None, "Canada Post is failing, not sending requests for "
+                  "{0:.1f}s".format(retry_after), *args, **kwargs)
+
+
+def connect_failed(error):
+    """
+    True if error shows that the request never reached Canada Post, so that
+    sending it again can't do anything twice
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        cause = error.args[0]
+        # requests wraps it in a MaxRetryError
+        cause = getattr(cause, 'reason', cause)
+        return isinstance(cause, NewConnectionError)
+    return False
+
+
+def transient(error):
+    return isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout))
+
+
+class CircuitBreaker(object):
+    """
+    Thread-safe circuit breaker. After failure_threshold consecutive
+    failures it opens, and calls fail with CircuitOpen for reset_timeout
+    seconds. Then a single trial request is let through: the circuit closes
+    again if it succeeds, and stays open for another reset_timeout if it
+    fails
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    log = logging.getLogger('canada_post.retry.CircuitBreaker')
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        Raise CircuitOpen unless a request may be sent now
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self._opened + self.reset_timeout - time.time()
+            if self.state == self.OPEN and remaining <= 0:
+                # this caller is the trial request
+                self.state = self.HALF_OPEN
+                return
+            self.rejected += 1
+            raise CircuitOpen(max(remaining, 0))
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                self.log.info("Canada Post is back, closing circuit")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    self.log.warning("%d failures in a row, opening circuit "
+                                     "for %.1fs", self.failures,
+                                     self.reset_timeout)
+                self.state = self.OPEN
+                self._opened = time.time()
+
+    def as_dict(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            }
+
+
+class RetryPolicy(object):
+    """
+    :max_attempts: tries per call, the first one included
+    :backoff: seconds before the first retry, doubling after each one up to
+        max_backoff, randomized by +/- `jitter` (a fraction of the delay). A
+        Retry-After header is honoured instead, unless it's longer than
+        max_backoff, in which case the call isn't retried
+    :statuses: response status codes worth retrying
+    :breaker: an optional CircuitBreaker, fed with the outcome of every
+        attempt
+    """
+    log = logging.getLogger('canada_post.retry.RetryPolicy')
+    STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=10.0,
+                 jitter=0.5, statuses=STATUSES, breaker=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses
+        self.breaker = breaker
+
+    def check(self):
+        """
+        Raise CircuitOpen if the breaker won't let a request through
+        """
+        if self.breaker is not None:
+            self.breaker.check()
+
+    def backoff_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def next_delay(self, attempt, idempotent, error=None, response=None):
+        """
+        Record the outcome of attempt number `attempt` (1 based), which
+        either raised error or got response, and return the seconds to wait
+        before trying again, or None if it shouldn't be
+        """
+        if error is not None:
+            failed = transient(error)
+            retry = failed and (idempotent or connect_failed(error))
+        else:
+            failed = response.status_code >= 500
+            retry = response.status_code in self.statuses and (
+                idempotent or response.status_code == 429)
+        if self.breaker is not None:
+            if failed:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+        if not retry or attempt >= self.max_attempts:
+            return None
+        delay = self.backoff_delay(attempt)
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                if retry_after > self.max_backoff:
+                    return None
+                delay = retry_after
+        self.log.info("Attempt %d failed (%s), trying again in %.2fs",
+                      attempt, error if error is not None
+                      else response.status_code, delay)
+        return delay
@@ -2,48 +2,195 @@
 Different Canada Post Developer Program services
 """
 import logging
+import time
 from lxml import etree
 from canada_post import DEV, PROD
-from canada_post.util import InfoObject
+from canada_post.util import InfoObject, FrozenValueObject, FrozenDict
+from canada_post.util.payload import payload
 from canada_post.util.money import Price, get_decimal, Adjustment
-import requests
+from canada_post.util.xpath import PRICE_QUOTES, first, parse
+from canada_post.transport import Transport
 
 class ServiceBase(object):
     """
     base class for API endpoints/services
+
+    Every service is split in two halves: prepare_request builds the keyword
+    arguments for the HTTP request (method, url, data, headers) and
+    process_response turns the response into the service's return value.
+    Calling the service does both over this service's transport; the asyncio
+    client in canada_post.aio reuses the same two halves.
+
+    `family` is the endpoint family the service's requests are rate limited
+    under, when it's given a canada_post.ratelimit.RateLimits. Given a
+    canada_post.retry.RetryPolicy, failed requests are sent again; unless
+    the service is `idempotent`, only when they never reached Canada Post.
+    Given a canada_post.instrument.Instrumentation, every call is measured
+    and goes through its hooks. Given a gateway (a base URL such as
+    'http://localhost:8080'), requests go there instead of Canada Post's
+    servers, e.g. to test against a stand-in.
+
+    When the transport has a canada_post.httpcache.HTTPCache, the XML tree
+    parsed from a stored response is reused as long as that response is
+    served again (see parse_xml); process_response still builds new objects
+    from it on every call, so callers never share a result.
     """
+    family = None
+    idempotent = True
     SERVER = {
         DEV: "ct.soa-gw.canadapost.ca",
         PROD: "soa-gw.canadapost.ca",
     }
 
-    def __init__(self, auth):
+    def __init__(self, auth, transport=None, rate_limits=None,
+                 retry_policy=None, instrumentation=None, gateway=None):
         self.auth = auth
+        self.transport = transport
+        self.rate_limits = rate_limits
+        self.retry_policy = retry_policy
+        self.instrumentation = instrumentation
+        self.gateway = gateway
+
+    def __call__(self, *args, **kwargs):
+        request = self.prepare_request(*args, **kwargs)
+        return self.call(request)
+
+    def call(self, request, **process_kwargs):
+        """
+        Send a prepared request and process its response (with
+        process_kwargs), through the instrumentation if there's one
+        """
+        request = self.rebase(request)
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return self.process(self.request(**request), **process_kwargs)
+        event = instrumentation.start(self, request)
+        try:
+            response = self.request(**event.request)
+            instrumentation.responded(event, response)
+            result = self.process(response, **process_kwargs)
+        except Exception as error:
+            instrumentation.finish(event, error)
+            raise
+        instrumentation.finish(event)
+        return result
+
+    def process(self, response, **process_kwargs):
+        return self.process_response(response, **process_kwargs)
+
+    def parse_xml(self, response):
+        """
+        The lxml tree of the response's body. Responses from an HTTPCache
+        carry a cache_memo shared by every response served from the same
+        stored content, where the first tree parsed is kept: a 304 or a
+        fresh hit isn't parsed again. The tree is shared, only read it
+        """
+        memo = getattr(response, 'cache_memo', None)
+        if memo is None:
+            return parse(response.content)
+        try:
+            return memo['tree']
+        except KeyError:
+            tree = memo['tree'] = parse(response.content)
+            return tree
 
     def get_server(self):
         return self.SERVER[self.auth.dev]
 
+    def rebase(self, request):
+        """
+        The request, sent to the gateway if one was given
+        """
+        if not self.gateway:
+            return request
+        location = request['url'].split('//', 1)[-1]
+        path = location[location.find('/'):] if '/' in location else '/'
+        return dict(request, url=self.gateway.rstrip('/') + path)
+
     def get_url(self):
         raise NotImplementedError
 
+    def prepare_request(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def process_response(self, response):
+        raise NotImplementedError
+
     def userpass(self):
         return self.auth.username, self.auth.password
 
+    def rate_limiter(self):
+        """
+        The AdaptiveRateLimiter for this service's family, None if it isn't
+        rate limited
+        """
+        if self.rate_limits is None:
+            return None
+        return self.rate_limits.get(self.family)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send an authenticated request through this service's transport,
+        following the retry policy. Responses the transport's cache holds
+        fresh are served first: they don't wait for the rate limiter, count
+        against it, or go through the circuit breaker
+        """
+        if self.transport is None:
+            self.transport = Transport()
+        response = self.transport.cached(method, url, auth=self.userpass(),
+                                         **kwargs)
+        if response is not None:
+            return response
+        policy = self.retry_policy
+        if policy is None:
+            return self.send(method, url, **kwargs)
+        attempt = 1
+        while True:
+            policy.check()
+            try:
+                response = self.send(method, url, **kwargs)
+            except Exception as error:
+                delay = policy.next_delay(attempt, self.idempotent,
+                                          error=error)
+                if delay is None:
+                    raise
+            else:
+                delay = policy.next_delay(attempt, self.idempotent,
+                                          response=response)
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def send(self, method, url, **kwargs):
+        """
+        Send a single authenticated request, waiting for the rate limiter
+        first
+        """
+        if self.transport is None:
+            self.transport = Transport()
+        limiter = self.rate_limiter()
+        if limiter is not None:
+            limiter.acquire()
+        response = self.transport.request(method, url, auth=self.userpass(),
+                                          **kwargs)
+        if limiter is not None:
+            limiter.feedback(response.status_code, response.headers)
+        return response
+
 class CallLinkService(ServiceBase):
     """
     Services that are called from link details returned by a prior call
 
-    override klass.method to change GET to POST, DELETE, PUT, etcetera
+    override klass.method_name to change GET to POST, DELETE, PUT, etcetera
     """
     log = logging.getLogger('canada_post.service.CallLinkService')
     link_rel = 'BAD_NAME'
     method_name = 'get'
-    def __init__(self, *args, **kwargs):
-        super(CallLinkService, self).__init__(*args, **kwargs)
-        self.method = getattr(requests, self.method_name)
-    def __call__(self, shipment):
+    def prepare_request(self, shipment):
         """
-        Void the Shipment object passed as parameter, using it's 'void' link
+        Call the link_rel link of the Shipment object passed as parameter
         """
         self.log.info("Calling %s on shipment %s", self.__class__.__name__,
                       shipment)
@@ -54,25 +201,29 @@ class CallLinkService(ServiceBase):
             'Accept': link['media-type'],
             'Accept-language': 'en-CA',
             }
-        res = self.method(url, headers=headers, auth=(self.userpass()))
+        return {'method': self.method_name, 'url': url, 'headers': headers}
+
+    def process_response(self, res):
         self.log.info("Response status code: %d", res.status_code)
-        self.log.debug("Response content: %s", res.content)
+        self.log.debug("Response content: %s", payload(res))
         if not res.ok:
             res.raise_for_status()
         return res
 
-class Service(object):
+class Service(FrozenValueObject):
     """
     Represents each of the service options returned from a call to GetRates for
-    a given parcel. Serves as parameter to call GetService
+    a given parcel. Serves as parameter to call GetService. Read-only, so
+    the ones a rate cache holds can be handed to every caller
     """
+    __slots__ = ('code', 'link', 'name', 'price', 'transit_time')
     log = logging.getLogger('canada_post.service.rating.Service')
     def __init__(self, xml_subtree=None, data={}):
         if xml_subtree is not None:
             self._from_xml(xml_subtree)
         else:
             self.code = data.get('code', 'BAD.CODE')
-            self.link = data.get('link', {})
+            self.link = FrozenDict(data.get('link', {}))
             self.name = data.get('name', 'UNDEFINED')
             self.price = data.get('price', Price())
             self.transit_time = data.get('transit_time', -1)
@@ -90,32 +241,33 @@ class Service(object):
         lxml.etree.Element representing one of CP's response's <price-quote>
         elements
         """
-        self.code = xml.find("service-code").text
-        self.link = dict(xml.find("service-link").attrib)
-        self.name = xml.find("service-name").text
-        self.price = self._price_from_xml(xml.find("price-details"))
-        self.transit_time = xml.find("service-standard/expected-transit-time")
-        if self.transit_time is not None:
-            self.transit_time = int(self.transit_time.text)
+        self.code = first(PRICE_QUOTES.service_code(xml))
+        self.link = FrozenDict(first(PRICE_QUOTES.service_link(xml)).attrib)
+        self.name = first(PRICE_QUOTES.service_name(xml))
+        self.price = self._price_from_xml(
+            first(PRICE_QUOTES.price_details(xml)))
+        transit_time = first(PRICE_QUOTES.transit_time(xml))
+        self.transit_time = (int(transit_time) if transit_time is not None
+                             else None)
 
     def _price_from_xml(self, xml):
         """
         Create a Price detail object from a <price-details> XML element as
         returned from the CP API
         """
-        due = get_decimal(xml.find("due").text)
-        base = get_decimal(xml.find("base").text)
-        tax = xml.find("taxes/gst")
+        due = get_decimal(first(PRICE_QUOTES.due(xml)))
+        base = get_decimal(first(PRICE_QUOTES.base(xml)))
+        tax = first(PRICE_QUOTES.gst(xml))
         gst = get_decimal(tax.text)
         gst_percent = get_decimal(tax.get("percent"))
-        tax = xml.find("taxes/pst")
+        tax = first(PRICE_QUOTES.pst(xml))
         pst = get_decimal(tax.text)
         pst_percent = get_decimal(tax.get("percent"))
-        tax = xml.find("taxes/hst")
+        tax = first(PRICE_QUOTES.hst(xml))
         hst = get_decimal(tax.text)
         hst_percent = get_decimal(tax.get("percent"))
         adjustments = [Adjustment(xml_source=adj)
-                       for adj in xml.findall("adjustments/adjustment")]
+                       for adj in PRICE_QUOTES.adjustments(xml)]
         return Price(due=due, base=base, gst=gst, gst_pc=gst_percent,
                      pst=pst, pst_pc=pst_percent, hst=hst, hst_pc=hst_percent,
                      adjustments=adjustments)
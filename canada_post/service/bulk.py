@@ -0,0 +1,592 @@
+"""
+Bulk operations, running many calls of a service concurrently
+"""
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from canada_post.errors import Wait, InDoubt
+from canada_post.service.contract_shipping import Shipment, Manifest
+from canada_post.util import InfoObject
+
+
+class ArtifactResult(InfoObject):
+    """
+    Outcome of downloading the artifact of obj (a Shipment or Manifest):
+    either the artifact (whatever GetArtifact returned) or the error it
+    failed with, after `attempts` tries
+    """
+    def __init__(self, obj, artifact=None, error=None, attempts=1, **kwargs):
+        self.obj = obj
+        self.artifact = artifact
+        self.error = error
+        self.attempts = attempts
+        super(ArtifactResult, self).__init__(**kwargs)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class BulkArtifactFetcher(object):
+    """
+    Download the artifacts (labels or manifests) of many Shipment or Manifest
+    objects concurrently, over a pool of max_workers threads.
+
+    Artifacts that aren't ready yet (GetArtifact raises Wait) are tried again
+    later, with exponential backoff starting at `backoff` seconds, capped at
+    `max_backoff`, randomized by +/- `jitter` (a fraction of the delay) and
+    up to max_attempts times, without holding up the other downloads.
+    """
+    log = logging.getLogger('canada_post.service.bulk.BulkArtifactFetcher')
+
+    def __init__(self, get_artifact, max_workers=8, max_attempts=10,
+                 backoff=1.0, max_backoff=60.0, jitter=0.5):
+        self.get_artifact = get_artifact
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt, wait_error=None):
+        """
+        Seconds to wait before the attempt after `attempt` (1 based)
+        """
+        if wait_error is not None and wait_error.retry_after is not None:
+            return wait_error.retry_after
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def __call__(self, objects, sink=None, checksum=None):
+        """
+        Download the artifact of every one of objects, yielding an
+        ArtifactResult for each as soon as it's done (so not in input order).
+
+        sink: if given, a function taking the object and returning the sink
+            (path or writable file object) for its artifact. Otherwise
+            artifacts go to temporary files, as with GetArtifact
+        checksum: hashlib algorithm name, see GetArtifact
+        """
+        # (ready at, input position, object, attempt)
+        queue = [(0, position, obj, 1)
+                 for position, obj in enumerate(objects)]
+        heapq.heapify(queue)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while queue or running:
+                now = time.time()
+                while (queue and queue[0][0] <= now
+                       and len(running) < self.max_workers):
+                    _, position, obj, attempt = heapq.heappop(queue)
+                    future = pool.submit(self.get_artifact, obj,
+                                         sink=sink(obj) if sink else None,
+                                         checksum=checksum)
+                    running[future] = (position, obj, attempt)
+
+                timeout = None
+                if queue and len(running) < self.max_workers:
+                    timeout = max(queue[0][0] - now, 0)
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    position, obj, attempt = running.pop(future)
+                    try:
+                        artifact = future.result()
+                    except Wait as error:
+                        if attempt < self.max_attempts:
+                            delay = self.delay(attempt, error)
+                            self.log.info("Artifact for %s not ready, trying "
+                                          "again in %.1fs", obj, delay)
+                            heapq.heappush(queue, (time.time() + delay,
+                                                   position, obj,
+                                                   attempt + 1))
+                            continue
+                        yield ArtifactResult(obj, error=error,
+                                             attempts=attempt)
+                    except Exception as error:
+                        self.log.warning("Getting artifact for %s failed: %r",
+                                         obj, error)
+                        yield ArtifactResult(obj, error=error,
+                                             attempts=attempt)
+                    else:
+                        yield ArtifactResult(obj, artifact=artifact,
+                                             attempts=attempt)
+
+
+def refused(error):
+    """
+    Whether a request failed with error was refused, so that Canada Post
+    certainly didn't act on it: it was invalid, or answered with a 4xx status
+    """
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return isinstance(error, AssertionError) or (
+        status is not None and 400 <= status < 500)
+
+
+class ShipmentOrder(InfoObject):
+    """
+    One shipment to create with BulkShipmentCreator: the CreateShipment
+    arguments plus key, a string that identifies this shipment across runs
+    (e.g. your order number), so a resumed run doesn't create it twice
+    """
+    def __init__(self, key, parcel, origin, destination, service, group,
+                 options=None, **kwargs):
+        self.key = key
+        self.parcel = parcel
+        self.origin = origin
+        self.destination = destination
+        self.service = service
+        self.group = group
+        self.options = options
+        super(ShipmentOrder, self).__init__(**kwargs)
+
+    def args(self):
+        return (self.parcel, self.origin, self.destination, self.service,
+                self.group, self.options)
+
+
+class ShipmentResult(InfoObject):
+    """
+    Outcome of a ShipmentOrder: either the created Shipment or the error it
+    failed with. resumed is True when the outcome comes from the journal of
+    a previous run rather than from Canada Post
+    """
+    def __init__(self, order, shipment=None, error=None, resumed=False,
+                 **kwargs):
+        self.order = order
+        self.shipment = shipment
+        self.error = error
+        self.resumed = resumed
+        super(ShipmentResult, self).__init__(**kwargs)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class MemoryJournal(object):
+    """
+    Journal of the state of every ShipmentOrder key: 'started' once its
+    request is about to be sent, then 'created' (with the shipment's data)
+    or 'failed' when Canada Post definitely didn't create it. A key left
+    'started' is in doubt.
+
+    This one lives in memory; see JournalFile for one that survives crashes
+    """
+    STARTED = 'started'
+    CREATED = 'created'
+    FAILED = 'failed'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def record(self, key, state, **data):
+        entry = dict(data, key=key, state=state)
+        with self._lock:
+            self.entries[key] = entry
+            self._write(entry)
+
+    def _write(self, entry):
+        pass
+
+
+class JournalFile(MemoryJournal):
+    """
+    Append-only JSON lines journal file. Loads the entries of previous runs
+    when opened. With fsync=True every record is synced to disk, surviving
+    OS crashes as well as process crashes
+    """
+    def __init__(self, path, fsync=False):
+        super(JournalFile, self).__init__()
+        self.path = path
+        self.fsync = fsync
+        if os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a record cut short by a crash
+                        continue
+                    self.entries[entry['key']] = entry
+        self._file = open(path, 'a')
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class BulkShipmentCreator(object):
+    """
+    Create many shipments concurrently, with up to max_workers requests in
+    flight.
+
+    Every order is validated (with CreateShipment.validate) before any
+    request is sent. Outcomes are recorded in a journal, and orders the
+    journal already knows about aren't sent again:
+      * created ones are answered with the journaled shipment
+      * ones that were sent but never got a definite answer (the run
+        crashed, or the connection failed) are reported as InDoubt. Check
+        GetGroups/the group's shipments before creating them again
+      * failed ones are retried
+    """
+    log = logging.getLogger('canada_post.service.bulk.BulkShipmentCreator')
+
+    def __init__(self, create_shipment, max_workers=8):
+        self.create_shipment = create_shipment
+        self.max_workers = max_workers
+
+    def validate(self, orders):
+        """
+        Return a list with the error that each of orders would fail with, or
+        None for the ones that can be created. Whatever exception validating
+        an order raises fails that order alone, not the batch
+        """
+        errors = []
+        seen = set()
+        for order in orders:
+            error = None
+            if order.key in seen:
+                error = ValueError(
+                    "Duplicate shipment order key {0!r}".format(order.key))
+            else:
+                seen.add(order.key)
+                try:
+                    self.create_shipment.validate(*order.args())
+                except Exception as validation_error:
+                    self.log.debug("Shipment order %r is invalid: %r",
+                                   order.key, validation_error)
+                    error = validation_error
+            errors.append(error)
+        return errors
+
+    def __call__(self, orders, journal=None):
+        """
+        Create the shipments for orders (ShipmentOrder instances), yielding
+        a ShipmentResult for each as soon as it's done
+
+        journal: a MemoryJournal or JournalFile to record outcomes in, and
+            resume from
+        """
+        orders = list(orders)
+        if journal is None:
+            journal = MemoryJournal()
+        errors = self.validate(orders)
+        self.log.info("Creating %d shipments, %d invalid", len(orders),
+                      len(errors) - errors.count(None))
+
+        to_send = []
+        for order, error in zip(orders, errors):
+            if error is not None:
+                yield ShipmentResult(order, error=error)
+                continue
+            entry = journal.get(order.key)
+            if entry is None or entry['state'] == journal.FAILED:
+                to_send.append(order)
+            elif entry['state'] == journal.CREATED:
+                yield ShipmentResult(order, resumed=True,
+                                     shipment=Shipment(**entry['shipment']))
+            else:
+                yield ShipmentResult(order, resumed=True, error=InDoubt(
+                    "Shipment {0!r} was sent by a previous run but its "
+                    "outcome is unknown".format(order.key)))
+
+        to_send.reverse()
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                while to_send or running:
+                    # keep the queue short, so results stream back while the
+                    # rest are still being sent
+                    while to_send and len(running) < self.max_workers * 2:
+                        order = to_send.pop()
+                        journal.record(order.key, journal.STARTED)
+                        future = pool.submit(self.create_shipment,
+                                             *order.args())
+                        running[future] = order
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield self._result(running.pop(future), future,
+                                           journal)
+        finally:
+            # the caller stopped iterating (or a journal write failed): the
+            # pool has waited for the requests it was sending, journal them
+            # so a resumed run doesn't report created shipments as InDoubt
+            for future, order in running.items():
+                self._result(order, future, journal)
+
+    def _result(self, order, future, journal):
+        try:
+            shipment = future.result()
+        except Exception as error:
+            if refused(error):
+                # Canada Post refused it, nothing was created
+                journal.record(order.key, journal.FAILED, error=repr(error))
+            else:
+                self.log.warning("Outcome of shipment %r unknown: %r",
+                                 order.key, error)
+            return ShipmentResult(order, error=error)
+        journal.record(order.key, journal.CREATED,
+                       shipment=dict(shipment.__dict__))
+        return ShipmentResult(order, shipment=shipment)
+
+
+class ExpansionResult(InfoObject):
+    """
+    Outcome of one call of a manifest expansion. stage is the service called:
+      * MANIFEST: GetManifest for the manifest at link href `key`; value is
+        the Manifest
+      * SHIPMENT_IDS: GetManifestShipments for that manifest; value is the
+        list of shipment ids
+      * SHIPMENT: GetShipment for shipment id `key`; value is the Shipment
+    manifest is the href of the manifest it belongs to. resumed is True when
+    the value comes from the journal of a previous run
+    """
+    MANIFEST = 'manifest'
+    SHIPMENT_IDS = 'shipment_ids'
+    SHIPMENT = 'shipment'
+
+    def __init__(self, stage, manifest, key, value=None, error=None,
+                 resumed=False, **kwargs):
+        self.stage = stage
+        self.manifest = manifest
+        self.key = key
+        self.value = value
+        self.error = error
+        self.resumed = resumed
+        super(ExpansionResult, self).__init__(**kwargs)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def journal_key(self):
+        return "{0}:{1}".format(self.stage, self.key)
+
+
+class ManifestNode(InfoObject):
+    """
+    A manifest of a ManifestGraph: its link (as TransmitShipments returned
+    it), the Manifest, the ids of its shipments, the Shipments by id, and
+    the failed ExpansionResults of all of those
+    """
+    def __init__(self, link, **kwargs):
+        self.link = link
+        self.manifest = None
+        self.shipment_ids = None
+        self.shipments = {}
+        self.errors = []
+        super(ManifestNode, self).__init__(**kwargs)
+
+    @property
+    def complete(self):
+        return (self.manifest is not None and self.shipment_ids is not None
+                and len(self.shipments) == len(self.shipment_ids))
+
+
+class ManifestGraph(InfoObject):
+    """
+    Manifests (ManifestNodes by href, in transmission order) and their
+    shipments, as expanded by ManifestExpander
+    """
+    def __init__(self, links, **kwargs):
+        self.manifests = OrderedDict((link['href'], ManifestNode(link))
+                                     for link in links)
+        super(ManifestGraph, self).__init__(**kwargs)
+
+    def add(self, result):
+        node = self.manifests[result.manifest]
+        if result.error is not None:
+            node.errors.append(result)
+        elif result.stage == result.MANIFEST:
+            node.manifest = result.value
+        elif result.stage == result.SHIPMENT_IDS:
+            node.shipment_ids = result.value
+        else:
+            node.shipments[result.key] = result.value
+
+    @property
+    def errors(self):
+        return [error for node in self.manifests.values()
+                for error in node.errors]
+
+    @property
+    def complete(self):
+        return all(node.complete for node in self.manifests.values())
+
+    def shipments(self):
+        """
+        Iterate over the expanded Shipments of every manifest
+        """
+        for node in self.manifests.values():
+            for shipment_id in node.shipment_ids or ():
+                if shipment_id in node.shipments:
+                    yield node.shipments[shipment_id]
+
+
+class ManifestExpander(object):
+    """
+    Expand manifests into their shipments: GetManifest for every manifest
+    link, GetManifestShipments for every manifest and GetShipment for every
+    shipment id, with up to max_workers calls in flight. A call is sent as
+    soon as the one it depends on is done, and shipments are fetched before
+    the remaining manifests, so complete manifests stream back early.
+
+    With a journal (see MemoryJournal/JournalFile), every successful call is
+    recorded, and a run with the same journal after a partial failure only
+    makes the calls that failed or never ran
+    """
+    log = logging.getLogger('canada_post.service.bulk.ManifestExpander')
+
+    def __init__(self, get_manifest, get_manifest_shipments, get_shipment,
+                 transmit_shipments=None, max_workers=8):
+        self.get_manifest = get_manifest
+        self.get_manifest_shipments = get_manifest_shipments
+        self.get_shipment = get_shipment
+        self.transmit_shipments = transmit_shipments
+        self.max_workers = max_workers
+
+    def _from_journal(self, journal, result):
+        entry = journal.get(result.journal_key)
+        if entry is None or entry['state'] != journal.CREATED:
+            return None
+        value = entry['value']
+        if result.stage == result.MANIFEST:
+            value = Manifest(**value)
+        elif result.stage == result.SHIPMENT:
+            value = Shipment(**value)
+        result.value = value
+        result.resumed = True
+        return result
+
+    def _record(self, journal, result):
+        value = result.value
+        if result.stage != result.SHIPMENT_IDS:
+            value = dict(value.__dict__)
+        journal.record(result.journal_key, journal.CREATED, value=value)
+
+    def _call(self, result, argument):
+        if result.stage == result.MANIFEST:
+            result.value = self.get_manifest(argument)
+        elif result.stage == result.SHIPMENT_IDS:
+            result.value = self.get_manifest_shipments(argument)
+        else:
+            result.value = self.get_shipment(argument)
+        return result
+
+    def stream(self, links, journal=None):
+        """
+        Expand the manifests at links (as returned by TransmitShipments),
+        yielding an ExpansionResult for every call as soon as it's done
+        """
+        if journal is None:
+            journal = MemoryJournal()
+        # stack of (ExpansionResult to fill, argument of its call)
+        pending = [(ExpansionResult(ExpansionResult.MANIFEST, link['href'],
+                                    link['href']), link)
+                   for link in reversed(list(links))]
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                while pending and len(running) < self.max_workers:
+                    result, argument = pending.pop()
+                    if self._from_journal(journal, result) is not None:
+                        pending.extend(self._next(result))
+                        yield result
+                        continue
+                    future = pool.submit(self._call, result, argument)
+                    running[future] = result
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as error:
+                        self.log.warning("Getting %s %s failed: %r",
+                                         result.stage, result.key, error)
+                        result.error = error
+                    else:
+                        self._record(journal, result)
+                        pending.extend(self._next(result))
+                    yield result
+
+    def _next(self, result):
+        """
+        The calls that depend on a successful one
+        """
+        if result.stage == result.MANIFEST:
+            return [(ExpansionResult(result.SHIPMENT_IDS, result.manifest,
+                                     result.manifest), result.value)]
+        if result.stage == result.SHIPMENT_IDS:
+            return [(ExpansionResult(result.SHIPMENT, result.manifest,
+                                     shipment_id), shipment_id)
+                    for shipment_id in reversed(result.value)]
+        return []
+
+    def __call__(self, links, journal=None):
+        """
+        Expand the manifests at links into a ManifestGraph. Failed calls end
+        up in its errors; run again with the same journal to resume
+        """
+        links = list(links)
+        graph = ManifestGraph(links)
+        for result in self.stream(links, journal):
+            graph.add(result)
+        return graph
+
+    def transmit(self, key, origin, group_ids, journal=None, **kwargs):
+        """
+        Transmit the shipments of group_ids (see TransmitShipments, which
+        gets the other keyword arguments) and expand the manifests that
+        creates. key identifies the transmission across runs (e.g. the
+        date): resuming with the same journal doesn't transmit again, and
+        raises InDoubt if a previous run transmitted without getting an
+        answer
+        """
+        if journal is None:
+            journal = MemoryJournal()
+        journal_key = "transmit:{0}".format(key)
+        entry = journal.get(journal_key)
+        if entry is not None and entry['state'] == journal.STARTED:
+            raise InDoubt("Transmission {0!r} was sent by a previous run but "
+                          "its outcome is unknown".format(key))
+        if entry is not None and entry['state'] == journal.CREATED:
+            links = entry['links']
+        else:
+            journal.record(journal_key, journal.STARTED)
+            try:
+                links = self.transmit_shipments(origin, group_ids, **kwargs)
+            except Exception as error:
+                if refused(error):
+                    journal.record(journal_key, journal.FAILED,
+                                   error=repr(error))
+                raise
+            journal.record(journal_key, journal.CREATED, links=links)
+        return self(links, journal)
+
@@ -2,13 +2,20 @@
 ContractShipping Canada Post API
 https://www.canadapost.ca/cpo/mc/business/productsservices/developers/services/shippingmanifest/default.jsf
 """
+import copy
+import hashlib
 import logging
 from tempfile import NamedTemporaryFile
 from lxml import etree
-import requests
-from canada_post.errors import Wait
+from canada_post.compat import text_type
+from canada_post.errors import CanadaPostError, Wait
 from canada_post.service import ServiceBase, CallLinkService
+from canada_post.service.request import (SHIPMENT, ADDRESS_DETAILS, CUSTOMS,
+                                         CUSTOMS_ITEM, DIMENSIONS)
+from canada_post.util.xpath import (SHIPMENT_INFO, MANIFESTS, SHIPMENTS,
+                                          GROUPS, first, links_dict)
 from canada_post.util import InfoObject
+from canada_post.util.payload import payload, masked
 import os
 
 
@@ -40,20 +47,19 @@ class Shipment(InfoObject):
     def _from_xml(self, xml):
         # I do this this way because I can't expect all return codes to have all
         #  values, I just fill in every Simple element in self
-        for child in xml.getchildren():
-            if child.tag == "shipment-id":
+        for child in xml.iterchildren(tag=etree.Element):
+            tag = etree.QName(child).localname
+            if tag == "shipment-id":
                 self.id = child.text
-            elif child.tag == "shipment-status":
+            elif tag == "shipment-status":
                 self.status = child.text
-            elif child.tag == "links":
+            elif tag == "links":
                 # I can't make these into InfoObjects because there's a `self`
                 #  rel object
-                self.links = dict((link['rel'], link)
-                    for link in map(lambda l: dict(l.attrib),
-                                    child.findall("link")))
+                self.links = links_dict(SHIPMENT_INFO.link(child))
             else:
                 # expected "tracking-pin" "return-tracking-pin"
-                attrname = child.tag.replace("-", "_")
+                attrname = tag.replace("-", "_")
                 setattr(self, attrname, child.text)
 
 class Manifest(InfoObject):
@@ -64,8 +70,8 @@ class Manifest(InfoObject):
         super(Manifest, self).__init__(**kwargs)
 
     def _from_xml(self, xml):
-        self.po_number = xml.find('po-number').text
-        self.links = dict((link['rel'], link) for link in map(lambda l: dict(l.attrib), xml.find('links').findall('link')))
+        self.po_number = first(MANIFESTS.po_number(xml))
+        self.links = links_dict(MANIFESTS.manifest_links(xml))
 
 class CreateShipment(ServiceBase):
     """
@@ -75,15 +81,18 @@ class CreateShipment(ServiceBase):
     URL ="https://{server}/rs/{customer}/{mobo}/shipment"
     log = logging.getLogger('canada_post.service.contract_shipping'
                             '.CreateShipment')
+    family = 'shipment'
+    idempotent = False
     headers = {'Accept': "application/vnd.cpc.shipment-v7+xml",
                'Content-type': "application/vnd.cpc.shipment-v7+xml",
                'Accept-language': "en-CA",
         }
 
-    def __init__(self, auth, url=None):
+    def __init__(self, auth, url=None, transport=None, **kwargs):
         if url:
             self.URL = url
-        super(CreateShipment, self).__init__(auth)
+        super(CreateShipment, self).__init__(auth, transport=transport,
+                                             **kwargs)
 
     def set_link(self, url):
         """
@@ -96,91 +105,43 @@ class CreateShipment(ServiceBase):
                                customer=self.auth.customer_number,
                                mobo=self.auth.customer_number)
 
-    def _create_address_detail(self, parent, address, add_child):
+    def _address_details(self, address):
         """
-        Creates the address detail part of the request. You need to do any
+        Render the address-details part of the request. You need to do any
         checks outside of this call
         """
-        addr_detail = add_child("address-details", parent)
-        add_child("address-line-1", addr_detail).text = address.address1
-        add_child("address-line-2", addr_detail).text = address.address2
-        add_child("city", addr_detail).text = address.city
-        if address.province:
-            add_child("prov-state", addr_detail).text = address.province
-        add_child("country-code", addr_detail).text = address.country_code
+        postal_code = None
         if address.postal_code:
-            add_child("postal-zip-code",
-                      addr_detail).text = unicode(address.postal_code)
-        else:
-            assert address.country_code not in ("US", "CA"), (
-                u"Addresses within {} require "
-                u"a postal code").format(address.country_code)
-
-        return addr_detail
-
-    def __call__(self, parcel, origin, destination, service, group,
+            postal_code = text_type(address.postal_code)
+        return ADDRESS_DETAILS.render(address1=address.address1,
+                                      address2=address.address2,
+                                      city=address.city,
+                                      province=address.province or None,
+                                      country_code=address.country_code,
+                                      postal_code=postal_code)
+
+    def validate(self, parcel, origin, destination, service, group,
                  options=None):
         """
-        Create a shipping order for the given parcels
-
-        parcel: must be a canada_post.util.parcel.Parcel
-        origin: must be a canada_post.util.address.Origin instance
-        destination: must be a canada_post.util.address.Destination instance
-        service: must be a canada_post.service.Service instance with at least
-            the code parameter set up
-        group: must be a string or unicode defining the parcel group that this
-            parcel should be added to
+        Check that a shipment can be created with the given arguments. Raises
+        AssertionError on the first problem found
         """
-        debug = "( DEBUG )" if self.auth.debug else ""
-        self.log.info(("Create shipping for parcel %s, from %s to %s{debug}"
-                       .format(debug=debug)), parcel, origin, destination)
-
-        # shipment
-        shipment = etree.Element(
-            "shipment", xmlns="http://www.canadapost.ca/ws/shipment-v7")
-
-        # add child function
-        add_child = add_child_factory(shipment)
-
-        add_child("group-id").text = group
-        add_child("requested-shipping-point").text = unicode(origin.postal_code)
-        delivery_spec = add_child("delivery-spec")
-        add_child("service-code", delivery_spec).text = service.code
-
         # sender
-        sender = add_child("sender", delivery_spec)
-        if origin.name:
-            add_child("name", sender).text = origin.name
         assert origin.company, ("The sender needs a company name for "
                                 "Contract Shipping service")
-        add_child("company", sender).text = origin.company
         assert origin.phone, ("The sender needs a phone for "
                               "Contact Shipping Service")
-        add_child("contact-phone", sender).text = origin.phone
-
-        #destination details, first assertions
         assert any((origin.address1, origin.address2)), (
             "The sender needs an address to Create Shipping")
         assert origin.city, "Need the sender's city to Create Shipping"
         assert origin.province, "Need the sender's province to Create Shipping"
-        sender_details = self._create_address_detail(sender, origin, add_child)
-        # done sender
+        if not origin.postal_code:
+            assert origin.country_code not in ("US", "CA"), (
+                u"Addresses within {} require "
+                u"a postal code").format(origin.country_code)
 
         # destination
-        dest = add_child("destination", delivery_spec)
-        if destination.name:
-            add_child("name", dest).text = destination.name
-        else:
-            # TODO: if the Deliver to Post Office option is used, the name
-            #  element must be present for the destination.
-            pass
-        if destination.company:
-            add_child("company", dest).text = destination.company
-        if destination.extra:
-            add_child("additional-address-info").text = destination.extra
-        if destination.phone:
-            add_child("client-voice-number", dest).text = destination.phone
-        else:
+        if not destination.phone:
             # Required for destination when service is one of
             #  Expedited Parcel-USA, Xpresspost-USA, Xpresspost-International,
             #  Priority Worldwide Parcel or Pak
@@ -190,135 +151,208 @@ class CreateShipment(ServiceBase):
                                 "USA.PW.PAK", "INT.PW.PARCEL", "INT.PK.PAK"):
                 assert False, ("Service {code} requires destination to have a "
                                "phone number").format(code=service.code)
-
-        # destination details, first assertions
         assert any((destination.address1, destination.address2)), (
             "Must have address to Create Shipping")
         if not destination.province:
             assert destination.country_code not in ("CA", "US"), (
                 "Country code is required for international shippings")
-        # and then creation
-        dest_details = self._create_address_detail(dest, destination, add_child)
-        # done destination
+        if not destination.postal_code:
+            assert destination.country_code not in ("US", "CA"), (
+                u"Addresses within {} require "
+                u"a postal code").format(destination.country_code)
+
+        # customs
+        if destination.country_code != 'CA':
+            assert bool(parcel.items), ("International shipping requires a "
+                                        "list of the items")
+
+        # settlement-info
+        assert self.auth.contract_number, ("Must have a contract number for "
+                                           "contract shipping")
+
+    def prepare_request(self, parcel, origin, destination, service, group,
+                        options=None):
+        """
+        Create a shipping order for the given parcels
+
+        parcel: must be a canada_post.util.parcel.Parcel
+        origin: must be a canada_post.util.address.Origin instance
+        destination: must be a canada_post.util.address.Destination instance
+        service: must be a canada_post.service.Service instance with at least
+            the code parameter set up
+        group: must be a string or unicode defining the parcel group that this
+            parcel should be added to
+        """
+        debug = "( DEBUG )" if self.auth.debug else ""
+        self.log.info(("Create shipping for parcel %s, from %s to %s{debug}"
+                       .format(debug=debug)), masked(parcel), masked(origin),
+                      masked(destination))
+        self.validate(parcel, origin, destination, service, group, options)
+
+        # TODO: if the Deliver to Post Office option is used, the name
+        #  element must be present for the destination.
 
         # customs
+        customs = None
         if destination.country_code != 'CA':
             # international shippings require customs details. Several things
-            # are hardcoded here, which should be parametrical.
-            customs = add_child('customs', delivery_spec)
-            # TODO: this should be a parameter
-            add_child('currency', customs).text = 'CAD'
-            # TODO: this should be a parameter
-            # these are the valid options:
+            # are hardcoded in the template (currency CAD, reason-for-export
+            # SOG), which should be parametrical.
+            # these are the valid reasons for export:
             #  GIF = gift
             #  DOC = document
             #  SAM = commercial sample
             #  REP = repair or warranty
             #  SOG = sale of goods
             #  OTH = other
-            add_child('reason-for-export', customs).text = 'SOG'
-            sku_list = add_child('sku-list', customs)
-            assert bool(parcel.items), ("International shipping requires a "
-                                        "list of the items")
-            for item in parcel.items:
-                item_elem = add_child('item', sku_list)
-                add_child('customs-number-of-units',
-                          item_elem).text = unicode(item.amount)
-                add_child('customs-description',
-                          item_elem).text = item.description
-                add_child('unit-weight', item_elem).text = unicode(item.weight)
-                add_child('customs-value-per-unit',
-                          item_elem).text = unicode(item.price)
-
-        # done customs
+            items = b"".join(
+                CUSTOMS_ITEM.render(units=text_type(item.amount),
+                                    description=item.description,
+                                    weight=text_type(item.weight),
+                                    value=text_type(item.price))
+                for item in parcel.items)
+            customs = CUSTOMS.render(items=items)
 
         # options
+        options_xml = None
         if options is not None:
-            options_elem = add_child("options", delivery_spec)
-            for option in options:
-                options_elem.append(option.make_xml())
-        # done options
+            options_xml = b"".join(etree.tostring(option.make_xml())
+                                   for option in options)
+            if options_xml:
+                options_xml = b"<options>" + options_xml + b"</options>"
+            else:
+                options_xml = b"<options/>"
 
         # parcel
-        parcel_chars = add_child("parcel-characteristics", delivery_spec)
-        add_child("weight", parcel_chars).text = unicode(parcel.weight)
+        dimensions = None
         if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
-            dims = add_child("dimensions", parcel_chars)
-            add_child("length", dims).text = unicode(parcel.length)
-            add_child("width", dims).text = unicode(parcel.width)
-            add_child("height", dims).text = unicode(parcel.height)
-        add_child("unpackaged", parcel_chars).text = ("true"
-                                                      if parcel.unpackaged
-                                                      else "false")
+            dimensions = DIMENSIONS.render(length=text_type(parcel.length),
+                                           width=text_type(parcel.width),
+                                           height=text_type(parcel.height))
 
         # TODO: notification
-        #notification = add_child("notification", delivery_spec)
-
-        print_preferences = add_child("print-preferences", delivery_spec)
-        add_child("output-format", print_preferences).text = "4x6"
-
-        # preferences
-        preferences = add_child("preferences", delivery_spec)
-        add_child("show-packing-instructions", preferences).text = "false"
-        # TODO: these two are actually optional (may be "false") for CA
-        # shippings
-        add_child("show-postage-rate", preferences).text = "false"
-        add_child("show-insured-value", preferences).text = "false"
-
-        # settlement-info
-        settlement = add_child("settlement-info", delivery_spec)
+        # TODO: show-postage-rate and show-insured-value are actually optional
+        # (may be "false") for CA shippings
         # TODO: set paid-by-customer if a different customer is paying for this
-        #add_child("paid-by-customer", settlement).text = FOOBAR
-        assert self.auth.contract_number, ("Must have a contract number for "
-                                           "contract shipping")
-        add_child("contract-id", settlement).text = self.auth.contract_number
-        # TODO: can be CreditCard as well
-        add_child("intended-method-of-payment", settlement).text = "Account"
+        # TODO: intended-method-of-payment can be CreditCard as well
+        request = SHIPMENT.render(
+            group_id=group,
+            requested_shipping_point=text_type(origin.postal_code),
+            service_code=service.code,
+            sender_name=origin.name or None,
+            sender_company=origin.company,
+            sender_phone=origin.phone,
+            sender_address=self._address_details(origin),
+            destination_name=destination.name or None,
+            destination_company=destination.company or None,
+            destination_phone=destination.phone or None,
+            destination_address=self._address_details(destination),
+            customs=customs,
+            options=options_xml,
+            weight=text_type(parcel.weight),
+            dimensions=dimensions,
+            unpackaged="true" if parcel.unpackaged else "false",
+            contract_id=self.auth.contract_number,
+            additional_address_info=destination.extra or None)
 
         url = self.get_url()
         self.log.info("Using url %s", url)
-        request = etree.tostring(shipment, pretty_print=self.auth.debug)
-        self.log.debug("Request xml: %s", request)
-        response = requests.post(url=url, data=request, headers=self.headers,
-                                 auth=self.userpass())
+        self.log.debug("Request xml: %s",
+                       payload(request, pretty=self.auth.debug))
+        return {'method': 'POST', 'url': url, 'data': request,
+                'headers': self.headers}
+
+    def process_response(self, response):
         self.log.info("Request returned with status %s", response.status_code)
-        self.log.debug("Request returned content: %s", response.content)
+        self.log.debug("Request returned content: %s", payload(response))
 
         if not response.ok:
             response.raise_for_status()
 
-        # this is a hack to remove the namespace from the response, since this
-        #breaks xpath lookup in lxml
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
+        restree = self.parse_xml(response)
         return Shipment(xml=restree)
 
 class GetShipment(ServiceBase):
+    """
+    Get a Shipment (the same as CreateShipment returns) by its id.
+
+    Given a canada_post.cache.ShipmentCache, repeated lookups are answered
+    from it, revalidating entries that aren't fresh anymore with a
+    conditional request
+    """
     URL = 'https://{server}/rs/000{customer}/000{mobo}/shipment'
     log = logging.getLogger('canada_post.service.contract_shipping'
                             '.GetShipment')
+    family = 'shipment'
     headers = {'Accept': 'application/vnd.cpc.shipment-v7+xml',
                'Accept-language': 'en-CA'}
 
+    def __init__(self, auth, transport=None, cache=None, **kwargs):
+        self.cache = cache
+        super(GetShipment, self).__init__(auth, transport=transport,
+                                          **kwargs)
+
+    def __call__(self, shipment_id):
+        shipment, request, process_kwargs = self.lookup(shipment_id)
+        if shipment is not None:
+            return shipment
+        return self.call(request, **process_kwargs)
+
+    def lookup(self, shipment_id):
+        """
+        Returns a copy of the cached Shipment if it's fresh, otherwise None,
+        the request to send and the keyword arguments of process_response
+        for it. The request is conditional only when a cached entry can be
+        revalidated, i.e. Canada Post sent it with validators. Callers get
+        copies, so they can't change the cached Shipment
+        """
+        if self.cache is None:
+            return None, self.prepare_request(shipment_id), {}
+        key = self.cache.key(self.auth, shipment_id)
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            self.cache.stats.hit()
+            return copy.deepcopy(entry.shipment), None, {}
+        request = self.prepare_request(shipment_id)
+        conditional = entry.conditional_headers() if entry is not None else {}
+        if not conditional:
+            # a full fetch, that a 304 can't answer
+            return None, request, {'cache_key': key}
+        request['headers'] = dict(request['headers'], **conditional)
+        return None, request, {'cache_key': key, 'cached': entry}
+
     def get_url(self):
         return self.URL.format(server=self.get_server(),
                                customer=self.auth.customer_number,
                                mobo=self.auth.customer_number)
 
-    def __call__(self, shipment_id):
+    def prepare_request(self, shipment_id):
         url = self.get_url() + '/' + str(shipment_id)
         self.log.info("Using url %s", url)
-        response = requests.get(url, headers=self.headers,
-                                 auth=self.userpass())
+        return {'method': 'GET', 'url': url, 'headers': self.headers}
+
+    def process_response(self, response, cache_key=None, cached=None):
         self.log.info("Request returned with status %s", response.status_code)
-        self.log.debug("Request returned content: %s", response.content)
+        if response.status_code == 304:
+            if cached is None:
+                # nothing was asked to be revalidated, and there's no body
+                raise CanadaPostError(304, "Not Modified answered to an "
+                                           "unconditional request")
+            self.cache.refresh(cache_key, cached)
+            return copy.deepcopy(cached.shipment)
+        self.log.debug("Request returned content: %s", payload(response))
 
         if not response.ok:
             response.raise_for_status()
 
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
-        return restree
+        restree = self.parse_xml(response)
+        shipment = Shipment(xml=restree)
+        if cache_key is not None:
+            self.cache.stats.miss()
+            self.cache.set(cache_key, copy.deepcopy(shipment),
+                           etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'))
+        return shipment
 
 class TransmitShipments(ServiceBase):
     """
@@ -331,6 +365,8 @@ class TransmitShipments(ServiceBase):
     URL ="https://{server}/rs/{customer}/{mobo}/manifest"
     log = logging.getLogger('canada_post.service.contract_shipping'
                             '.TransmitShipments')
+    family = 'manifest'
+    idempotent = False
     headers = {'Accept': "application/vnd.cpc.manifest-v7+xml",
                'Content-Type': 'application/vnd.cpc.manifest-v7+xml',
                'Accept-language': 'en-CA',
@@ -341,8 +377,8 @@ class TransmitShipments(ServiceBase):
                                customer=self.auth.customer_number,
                                mobo=self.auth.customer_number)
 
-    def __call__(self, origin, group_ids, name=None, detailed=True,
-                 excluded_shipments=[]):
+    def prepare_request(self, origin, group_ids, name=None, detailed=True,
+                        excluded_shipments=[]):
         """
         Transmit shipments to create manifests from
 
@@ -361,9 +397,9 @@ class TransmitShipments(ServiceBase):
 
         groups = add_child('group-ids')
         for group_id in group_ids:
-            add_child('group-id', groups).text = unicode(group_id)
+            add_child('group-id', groups).text = text_type(group_id)
 
-        add_child('requested-shipping-point').text = unicode(origin.postal_code)
+        add_child('requested-shipping-point').text = text_type(origin.postal_code)
 
         add_child('detailed-manifests').text = 'true' if detailed else 'false'
 
@@ -375,41 +411,39 @@ class TransmitShipments(ServiceBase):
         add_child('manifest-company', address).text = origin.company
         if name:
             add_child('manifest-name', address).text = name
-        add_child('phone-number', address).text = unicode(origin.phone)
+        add_child('phone-number', address).text = text_type(origin.phone)
         # details start
         details = add_child('address-details', address)
         add_child('address-line-1', details).text = origin.address1
         add_child('address-line-2', details).text = origin.address2
         add_child('city', details).text = origin.city
         add_child('prov-state', details).text = origin.province
-        add_child('postal-zip-code', details).text = unicode(origin.postal_code)
+        add_child('postal-zip-code', details).text = text_type(origin.postal_code)
         #details end
         # address end
 
         if excluded_shipments:
             excluded = add_child('excluded-shipments')
             for shipment in excluded_shipments:
-                add_child('shipment-id', excluded).text = unicode(shipment)
+                add_child('shipment-id', excluded).text = text_type(shipment)
 
         url = self.get_url()
         self.log.info("Using url %s", url)
-        request = etree.tostring(transmit, pretty_print=self.auth.debug)
-        self.log.debug("Request xml: %s", request)
-
-        response = requests.post(url=url, data=request, headers=self.headers,
-                                 auth=self.userpass())
+        request = etree.tostring(transmit)
+        self.log.debug("Request xml: %s",
+                       payload(request, pretty=self.auth.debug))
+        return {'method': 'POST', 'url': url, 'data': request,
+                'headers': self.headers}
 
+    def process_response(self, response):
         self.log.info("Request returned with status %s", response.status_code)
-        self.log.debug("Request returned content: %s", response.content)
+        self.log.debug("Request returned content: %s", payload(response))
 
         if not response.ok:
             response.raise_for_status()
 
-        # this is a hack to remove the namespace from the response, since this
-        #breaks xpath lookup in lxml
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
-        links = [dict(link.attrib) for link in restree.getchildren()]
+        restree = self.parse_xml(response)
+        links = [dict(link.attrib) for link in MANIFESTS.links(restree)]
         return links
 
 class GetManifest(ServiceBase):
@@ -418,23 +452,26 @@ class GetManifest(ServiceBase):
     """
     log = logging.getLogger('canada_post.service.contract_shipping'
                             '.GetManifest')
+    family = 'manifest'
 
     headers = {'Accept': "application/vnd.cpc.manifest-v7+xml",
                'Content-Type': 'application/vnd.cpc.manifest-v7+xml',
                'Accept-language': 'en-CA',
         }
 
-    def __call__(self, link):
+    def prepare_request(self, link):
         self.log.info("Getting manifest from link %s", link)
-        response = requests.get(link['href'], auth=self.userpass(), headers=self.headers)
+        return {'method': 'GET', 'url': link['href'], 'headers': self.headers}
+
+    def process_response(self, response):
         self.log.info("Canada Post returned with status code %d",
                       response.status_code)
-        self.log.debug("Canada Post returned with content %s", response.content)
+        self.log.debug("Canada Post returned with content %s",
+                       payload(response))
         if not response.ok:
             response.raise_for_status()
 
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
+        restree = self.parse_xml(response)
         return Manifest(xml=restree)
 
 class GetManifestShipments(ServiceBase):
@@ -443,69 +480,218 @@ class GetManifestShipments(ServiceBase):
     """
     log = logging.getLogger('canada_post.service.contract_shipping'
                             '.GetManifestShipments')
+    family = 'manifest'
     headers = {'Accept': "application/vnd.cpc.shipment-v7+xml",
                'Accept-language': 'en-CA',
         }
-    def __call__(self, manifest):
+    def prepare_request(self, manifest):
         self.log.info("Getting shipments for manifest %s", str(manifest))
         link = manifest.links['manifestShipments']['href']
         self.log.info("Using link %s", link)
-        response = requests.get(link, headers=self.headers,
-                                auth=self.userpass())
+        return {'method': 'GET', 'url': link, 'headers': self.headers}
+
+    def process_response(self, response):
         self.log.info("Canada Post returned with status code %d",
                       response.status_code)
-        self.log.debug("CanadaPost returned with content: %s", response.content)
+        self.log.debug("CanadaPost returned with content: %s",
+                       payload(response))
         if not response.ok:
             response.raise_for_status()
 
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
+        restree = self.parse_xml(response)
         shipments = []
-        for link in restree.findall('link'):
+        for link in SHIPMENTS.links(restree):
             url = link.attrib['href']
             shipments.append(os.path.basename(url))
         return shipments
 
+class Artifact(InfoObject):
+    """
+    An artifact streamed by GetArtifact into a caller supplied sink.
+    It contains
+      * sink: the path or file object it was written to
+      * size: in bytes
+      * media_type: as reported by Canada Post
+      * checksum: hex digest of the content, if one was asked for
+    """
+    def __init__(self, sink, size, media_type=None, checksum=None, **kwargs):
+        self.sink = sink
+        self.size = size
+        self.media_type = media_type
+        self.checksum = checksum
+        super(Artifact, self).__init__(**kwargs)
+
 class GetArtifact(ServiceBase):
     """
     Download a PDF link from a Shipment or Manifest object, and return a
     temporary file with it
+
+    The body is streamed to disk chunk by chunk, so it's never held in memory
+    whole. Pass a sink (a path or a writable file-like object) to write it
+    there instead of a temporary file, and checksum (a hashlib algorithm name,
+    e.g. 'sha256') to have its digest computed on the way; the return value
+    is then an Artifact
+
+    Given a canada_post.artifacts.ArtifactStore, artifacts are kept in it
+    and served from it when they're asked for again, without calling Canada
+    Post. Without a sink, the return value is then the stored file, opened
+    for reading, rather than a temporary file
     """
     log = logging.getLogger('canada_post.service.contract_shipping'
                             '.GetArtifact')
-    def __call__(self, obj):
+    family = 'artifact'
+    chunk_size = 64 * 1024
+
+    def __init__(self, auth, transport=None, store=None, **kwargs):
+        self.store = store
+        super(GetArtifact, self).__init__(auth, transport=transport,
+                                          **kwargs)
+
+    def __call__(self, obj, sink=None, checksum=None):
+        artifact, request, process_kwargs = self.lookup(obj, sink, checksum)
+        if artifact is not None:
+            return artifact
+        request['stream'] = True
+        return self.call(request, **process_kwargs)
+
+    def lookup(self, obj, sink=None, checksum=None):
+        """
+        Returns the artifact of obj delivered from the store if it's there,
+        otherwise None, the request to send and the keyword arguments of
+        process_response for it
+        """
+        request = self.prepare_request(obj)
+        process_kwargs = {'sink': sink, 'checksum': checksum}
+        if self.store is None:
+            return None, request, process_kwargs
+        link = request['url']
+        stored = self.store.get(link)
+        if stored is not None:
+            self.log.info("Artifact for object %s is stored as %s", str(obj),
+                          stored.digest)
+            return self.deliver(stored, sink, checksum), None, {}
+        process_kwargs['link'] = link
+        return None, request, process_kwargs
+
+    def prepare_request(self, obj):
         self.log.info("Getting artifact for object %s", str(obj))
         link = obj.links[obj.artifact_type]
         self.log.info("Using link %s", link)
-        res = requests.get(link['href'], auth=self.userpass())
-        self.log.info("Canada Post returned with status code %d",
-                      res.status_code)
-        self.log.debug("Canada Post returned with content: %s", res.content)
-        if res.status_code == 202:
-            raise Wait
-        if not res.ok:
-            res.raise_for_status()
-
-        img_temp = NamedTemporaryFile(delete=False)
-        img_temp.write(res.content)
-        img_temp.flush()
-        return img_temp
+        return {'method': 'GET', 'url': link['href']}
+
+    def process_response(self, res, sink=None, checksum=None, link=None):
+        try:
+            self.log.info("Canada Post returned with status code %d",
+                          res.status_code)
+            if res.status_code == 202:
+                retry_after = res.headers.get('Retry-After')
+                if retry_after is not None and retry_after.isdigit():
+                    raise Wait(int(retry_after))
+                raise Wait()
+            if not res.ok:
+                res.raise_for_status()
+
+            if link is not None:
+                stored = self.store.put(
+                    link, res.iter_content(self.chunk_size),
+                    media_type=res.headers.get('Content-Type'))
+                return self.deliver(stored, sink, checksum)
+            if sink is None:
+                img_temp = NamedTemporaryFile(delete=False)
+                self._write(res.iter_content(self.chunk_size), img_temp)
+                img_temp.flush()
+                return img_temp
+            if hasattr(sink, 'write'):
+                size, digest = self._write(res.iter_content(self.chunk_size),
+                                           sink, checksum)
+            else:
+                with open(sink, 'wb') as sink_file:
+                    size, digest = self._write(
+                        res.iter_content(self.chunk_size), sink_file,
+                        checksum)
+            return Artifact(sink, size,
+                            media_type=res.headers.get('Content-Type'),
+                            checksum=digest)
+        finally:
+            res.close()
+
+    def deliver(self, stored, sink=None, checksum=None):
+        """
+        Hand a canada_post.artifacts.StoredArtifact over the way a download
+        is: opened for reading without a sink, otherwise copied into the
+        sink and described by an Artifact
+        """
+        if sink is None:
+            return stored.open()
+        out = sink if hasattr(sink, 'write') else open(sink, 'wb')
+        try:
+            if checksum is None or checksum == self.store.algorithm:
+                stored.copy_to(out)
+                digest = stored.digest if checksum else None
+            else:
+                with stored.open() as content:
+                    chunks = iter(lambda: content.read(self.chunk_size), b'')
+                    _, digest = self._write(chunks, out, checksum)
+        finally:
+            if out is not sink:
+                out.close()
+        return Artifact(sink, stored.size, media_type=stored.media_type,
+                        checksum=digest)
+
+    def _write(self, chunks, out, checksum=None):
+        """
+        Stream the chunks of a response body into out. Returns the number of
+        bytes written and the hex digest of the content (None if no checksum
+        algorithm was given)
+        """
+        digest = hashlib.new(checksum) if checksum else None
+        size = 0
+        for chunk in chunks:
+            out.write(chunk)
+            size += len(chunk)
+            if digest is not None:
+                digest.update(chunk)
+        self.log.debug("Wrote %d bytes of artifact content", size)
+        return size, digest.hexdigest() if digest is not None else None
 
 
 class VoidShipment(CallLinkService):
     """
     Cancel a Contract Shipping created Shipment created by CreateShipment
+
+    Given the ShipmentCache of GetShipment, drops the shipment from it
     """
     log = logging.getLogger("canada_post.service.contract_shipping"
                             ".VoidShipment")
+    family = 'shipment'
+    idempotent = False
     link_rel = 'self'
     method_name = 'delete'
 
+    def __init__(self, auth, transport=None, cache=None, **kwargs):
+        self.cache = cache
+        super(VoidShipment, self).__init__(auth, transport=transport,
+                                           **kwargs)
+
+    def invalidate(self, shipment_id):
+        if self.cache is not None and shipment_id:
+            self.cache.invalidate(self.cache.key(self.auth, shipment_id))
+
+    def prepare_request(self, shipment):
+        self.invalidate(getattr(shipment, 'id', None))
+        return super(VoidShipment, self).prepare_request(shipment)
+
+    def process_response(self, res):
+        # again, in case a lookup cached it while the request was in flight
+        self.invalidate(os.path.basename(res.url.split('?')[0]))
+        return super(VoidShipment, self).process_response(res)
+
 
 class GetGroups(ServiceBase):
     URL = 'https://{server}/rs/{customer}/{mobo}/group'
     log = logging.getLogger('canada_post.service.contract_shipping'
                             '.GetGroups')
+    family = 'shipment'
     headers = {'Accept': 'application/vnd.cpc.shipment-v7+xml',
                'Accept-language': 'en-CA'}
 
@@ -514,18 +700,16 @@ class GetGroups(ServiceBase):
                                customer=self.auth.customer_number,
                                mobo=self.auth.customer_number)
 
-    def __call__(self, *args, **kwargs):
+    def prepare_request(self, *args, **kwargs):
         url = self.get_url()
         self.log.info("Using url %s", url)
-        response = requests.get(url, headers=self.headers,
-                                 auth=self.userpass())
+        return {'method': 'GET', 'url': url, 'headers': self.headers}
 
+    def process_response(self, response):
         self.log.info("Request returned with status %s", response.status_code)
-        self.log.debug("Request returned content: %s", response.content)
+        self.log.debug("Request returned content: %s", payload(response))
         if not response.ok:
             response.raise_for_status()
 
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
-        groups = restree.xpath('/groups/group/group-id')
-        return [group.text for group in groups]
+        restree = self.parse_xml(response)
+        return GROUPS.group_ids(restree)
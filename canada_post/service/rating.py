@@ -3,10 +3,17 @@ GetRates Canada Post API
 https://www.canadapost.ca/cpo/mc/business/productsservices/developers/services/rating/default.jsf
 """
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from canada_post.service import ServiceBase, Service
+from canada_post.service.request import (MAILING_SCENARIO, DIMENSIONS,
+                                         DOMESTIC, UNITED_STATES,
+                                         INTERNATIONAL)
+from canada_post.util.xpath import PRICE_QUOTES, response_error
+from canada_post.compat import text_type
+from canada_post.util.payload import payload, masked
 from canada_post.errors import CanadaPostError
-from lxml import etree
-import requests
+from canada_post.singleflight import SingleFlight
 
 class GetRates(ServiceBase):
     URL = "https://{server}/rs/ship/price"
@@ -15,73 +22,188 @@ class GetRates(ServiceBase):
                "Accept-language": "en-CA",
         }
     log = logging.getLogger('canada_post.service.rating.GetRates')
+    family = 'rating'
+
+    def __init__(self, auth, transport=None, cache=None, coalesce=False,
+                 estimator=None, **kwargs):
+        """
+        cache: an optional canada_post.cache.RateCache. Scenarios found in it
+            are answered without calling Canada Post
+        coalesce: if True, calls for a scenario that is already being quoted
+            by another thread wait for that quote instead of making their
+            own request. See self.single_flight.stats
+        estimator: an optional canada_post.estimate.RateEstimator, that
+            learns every quote received from Canada Post
+        """
+        self.cache = cache
+        self.single_flight = SingleFlight() if coalesce else None
+        self.estimator = estimator
+        super(GetRates, self).__init__(auth, transport=transport, **kwargs)
+
+    def __call__(self, parcel, origin, destination):
+        if (self.cache is None and self.single_flight is None
+                and self.estimator is None):
+            return super(GetRates, self).__call__(parcel, origin, destination)
+        key = self.scenario_key(parcel, origin, destination)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache_key(parcel, origin, destination)
+            services = self.cache.get(cache_key)
+            if services is not None:
+                return services
+        if self.single_flight is None:
+            return self._quote(cache_key, parcel, origin, destination)
+        return list(self.single_flight.do(key, self._quote, cache_key, parcel,
+                                          origin, destination))
+
+    def _quote(self, cache_key, parcel, origin, destination):
+        services = super(GetRates, self).__call__(parcel, origin, destination)
+        if self.cache is not None:
+            self.cache.set(cache_key, services)
+        if self.estimator is not None:
+            self.estimator.learn(parcel, origin, destination, services,
+                                 account=self.account())
+        return services
+
+    def estimate(self, parcel, origin, destination):
+        """
+        This account's estimated quotes for a scenario, from the estimator
+        (see canada_post.estimate.RateEstimator.estimate)
+        """
+        return self.estimator.estimate(parcel, origin, destination,
+                                       account=self.account())
 
     def get_url(self):
         return self.URL.format(server=self.get_server())
 
-    def __call__(self, parcel, origin, destination):
+    def account(self):
         """
-        Call the GetRates service
+        The account, environment (DEV or PROD) and contract this service
+        quotes for: quotes of different ones differ
         """
-        self.log.info("Getting rates for parcel: %s, from %s to %s", parcel,
-                      origin, destination)
-        request_tree = etree.Element(
-            'mailing-scenario', xmlns="http://www.canadapost.ca/ws/ship/rate-v2")
-        def add_child(child_name, parent=request_tree):
-            return etree.SubElement(parent, child_name)
-        add_child("customer-number").text = unicode(self.auth.customer_number)
-        if self.auth.contract_number:
-            add_child("contract-id").text = unicode(self.auth.contract_number)
+        return (self.auth.dev, text_type(self.auth.customer_number),
+                text_type(self.auth.contract_number or ""))
 
-        # parcel characteristics
-        par_chars = add_child("parcel-characteristics")
-        add_child("weight", par_chars).text = unicode(parcel.weight)
+    def scenario_key(self, parcel, origin, destination):
+        """
+        Normalized, hashable key for a mailing scenario, in this account's
+        environment (DEV or PROD). Two scenarios with the same key make the
+        same GetRates request
+        """
+        dimensions = None
+        if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
+            dimensions = (text_type(parcel.length), text_type(parcel.width),
+                          text_type(parcel.height))
+        postal_code = None
+        if destination.country_code in ("CA", "US"):
+            postal_code = destination.postal_code
+        return self.account() + (text_type(parcel.weight), dimensions,
+                                 origin.postal_code, destination.country_code,
+                                 postal_code)
+
+    def cache_key(self, parcel, origin, destination):
+        """
+        Key of a mailing scenario in the rate cache: its scenario_key, with
+        the destination's zone instead of its postal code when the cache is
+        keyed by zone. Only the cache shares quotes between the destinations
+        of a zone, batches and coalescing still tell them apart
+        """
+        key = self.scenario_key(parcel, origin, destination)
+        zone = getattr(destination, 'zone', None)
+        if zone and key[-1] is not None and self.cache.by_zone:
+            key = key[:-1] + (("zone", zone),)
+        return key
+
+    def batch(self, scenarios, max_workers=8):
+        """
+        Get rates for many (parcel, origin, destination) scenarios at once
+
+        Identical scenarios (see scenario_key) are quoted only once, and the
+        distinct ones run concurrently in a pool of up to max_workers threads
+        (0 quotes them one after the other, in this thread).
+        Returns a list in the same order as scenarios, where each item is
+        either the list of Services for that scenario or the CanadaPostError
+        it failed with
+        """
+        scenarios = [tuple(scenario) for scenario in scenarios]
+        keys = [self.scenario_key(*scenario) for scenario in scenarios]
+        distinct = OrderedDict()
+        for key, scenario in zip(keys, scenarios):
+            distinct.setdefault(key, scenario)
+        if not distinct:
+            return []
+        self.log.info("Getting rates for %d scenarios (%d distinct)",
+                      len(scenarios), len(distinct))
+        if max_workers == 0:
+            results = dict((key, self._batch_quote(scenario))
+                           for key, scenario in distinct.items())
+            return [results[key] for key in keys]
+        with ThreadPoolExecutor(max_workers=min(max_workers,
+                                                len(distinct))) as pool:
+            futures = dict((key, pool.submit(self._batch_quote, scenario))
+                           for key, scenario in distinct.items())
+        return [futures[key].result() for key in keys]
+
+    def _batch_quote(self, scenario):
+        try:
+            return self(*scenario)
+        except CanadaPostError as error:
+            return error
+        except Exception as error:
+            self.log.exception("Getting rates for %s failed", masked(scenario))
+            response = getattr(error, 'response', None)
+            code = getattr(response, 'status_code', None)
+            return CanadaPostError(code, text_type(error))
+
+    def prepare_request(self, parcel, origin, destination):
+        """
+        Build the GetRates mailing-scenario request for the given parcel
+        """
+        self.log.info("Getting rates for parcel: %s, from %s to %s",
+                      masked(parcel), masked(origin), masked(destination))
+        contract_id = None
+        if self.auth.contract_number:
+            contract_id = text_type(self.auth.contract_number)
 
         # par_chars/dimensions
+        dimensions = None
         if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
-            dims = add_child("dimensions", par_chars)
-            add_child("length", dims).text = unicode(parcel.length)
-            add_child("width", dims).text = unicode(parcel.width)
-            add_child("height", dims).text = unicode(parcel.height)
-
-        add_child("origin-postal-code").text = origin.postal_code
+            dimensions = DIMENSIONS.render(length=text_type(parcel.length),
+                                           width=text_type(parcel.width),
+                                           height=text_type(parcel.height))
 
         # destination
-        dest = add_child("destination")
         if destination.country_code == "CA":
-            doms = add_child("domestic", dest)
-            add_child("postal-code", doms).text = destination.postal_code
+            dest = DOMESTIC.render(postal_code=destination.postal_code)
         elif destination.country_code == "US":
-            us = add_child("united-states", dest)
-            add_child("zip-code", us).text = destination.postal_code
+            dest = UNITED_STATES.render(zip_code=destination.postal_code)
         else:
             # international shipping
-            intr = add_child("international", dest)
-            add_child("country-code", intr).text = destination.country_code
+            dest = INTERNATIONAL.render(country_code=destination.country_code)
+
+        request = MAILING_SCENARIO.render(
+            customer_number=text_type(self.auth.customer_number),
+            contract_id=contract_id,
+            weight=text_type(parcel.weight),
+            dimensions=dimensions,
+            origin_postal_code=origin.postal_code,
+            destination=dest)
 
         url = self.get_url()
         self.log.info("Using url %s", url)
-        request = str(etree.tostring(request_tree, pretty_print=self.auth.debug))
-        self.log.debug("Request xml: %s", request)
-        response = requests.post(url, data=request, headers=self.headers,
-                                 auth=self.userpass())
+        self.log.debug("Request xml: %s",
+                       payload(request, pretty=self.auth.debug))
+        return {'method': 'POST', 'url': url, 'data': request,
+                'headers': self.headers}
+
+    def process_response(self, response):
         self.log.info("Request returned with status %s", response.status_code)
-        self.log.debug("Request returned content: %s", response.content)
+        self.log.debug("Request returned content: %s", payload(response))
         if not response.ok:
-            restree = etree.XML(response.content.replace(' xmlns="',
-                                                         ' xmlnamespace="'))
-            error_code = restree.find(".//code").text
-            if error_code.isdigit():
-                error_code = int(error_code)
-            message = restree.find(".//description").text
-
-            raise CanadaPostError(error_code, message)
-
-        # this is a hack to remove the namespace from the response, since this
-        #breaks xpath lookup in lxml
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
+            raise response_error(response)
+        restree = self.parse_xml(response)
+
         services = [Service(xml_subtree=price)
-                    for price in restree.findall("price-quote")]
+                    for price in PRICE_QUOTES.price_quotes(restree)]
 
         return services
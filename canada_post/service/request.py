@@ -0,0 +1,147 @@
+"""
+Request serialization for the Canada Post services
+
+Most of a request document is the same from one call to the next, so instead
+of building an lxml tree and serializing it on every call, each request type
+has Templates: the document split at its variable fields, with the constant
+markup encoded once at import time. Rendering only escapes and joins the
+field values, and gives the same bytes etree.tostring gives for the
+equivalent tree. Requests are always rendered compact, DEV included; only
+their log records are pretty printed (see canada_post.util.payload).
+
+Template syntax:
+
+    {tag=name}   the <tag> element with the (escaped) text of field `name`,
+                 or <tag/> if the field is None
+    {tag?=name}  same, but left out altogether if the field is None
+    {name}       the already rendered bytes of field `name` (e.g. another
+                 template's output), nothing if None
+"""
+import re
+
+_FIELD = re.compile(r'\{(?:([\w-]+)(\?)?=)?(\w+)\}')
+# characters that etree.tostring would escape, or reject
+_SPECIAL = re.compile(u'[&<>\r\x00-\x08\x0b\x0c\x0e-\x1f]|[^\x00-\x7f]')
+_INVALID = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def escape(text):
+    """
+    Escape text for an element's content, the way etree.tostring does for
+    ASCII output: markup characters and carriage returns escaped, non ASCII
+    characters as character references. Returns bytes
+    """
+    if _SPECIAL.search(text) is None:
+        return text.encode('ascii')
+    if _INVALID.search(text) is not None:
+        raise ValueError("All strings must be XML compatible: Unicode or "
+                         "ASCII, no NULL bytes or control characters")
+    text = (text.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+            .replace(u'>', u'&gt;').replace(u'\r', u'&#13;'))
+    return text.encode('ascii', 'xmlcharrefreplace')
+
+
+class Template(object):
+    def __init__(self, source):
+        self.source = source
+        self._parts = []
+        position = 0
+        for match in _FIELD.finditer(source):
+            constant = source[position:match.start()].encode('ascii')
+            tag, optional, name = match.groups()
+            if tag is None:
+                self._parts.append((constant, name, None, None, None, False))
+            else:
+                self._parts.append((constant, name,
+                                    ('<%s>' % tag).encode('ascii'),
+                                    ('</%s>' % tag).encode('ascii'),
+                                    ('<%s/>' % tag).encode('ascii'),
+                                    bool(optional)))
+            position = match.end()
+        self._tail = source[position:].encode('ascii')
+
+    def render(self, **fields):
+        out = []
+        append = out.append
+        for constant, name, start, end, empty, optional in self._parts:
+            append(constant)
+            value = fields.get(name)
+            if start is None:
+                if value:
+                    append(value)
+            elif value is None:
+                if not optional:
+                    append(empty)
+            else:
+                append(start)
+                append(escape(value))
+                append(end)
+        append(self._tail)
+        return b''.join(out)
+
+
+DIMENSIONS = Template(
+    '<dimensions>{length=length}{width=width}{height=height}</dimensions>')
+
+# GetRates
+MAILING_SCENARIO = Template(
+    '<mailing-scenario xmlns="http://www.canadapost.ca/ws/ship/rate-v2">'
+    '{customer-number=customer_number}'
+    '{contract-id?=contract_id}'
+    '<parcel-characteristics>{weight=weight}{dimensions}'
+    '</parcel-characteristics>'
+    '{origin-postal-code=origin_postal_code}'
+    '<destination>{destination}</destination>'
+    '</mailing-scenario>')
+DOMESTIC = Template('<domestic>{postal-code=postal_code}</domestic>')
+UNITED_STATES = Template('<united-states>{zip-code=zip_code}</united-states>')
+INTERNATIONAL = Template(
+    '<international>{country-code=country_code}</international>')
+
+# CreateShipment
+SHIPMENT = Template(
+    '<shipment xmlns="http://www.canadapost.ca/ws/shipment-v7">'
+    '{group-id=group_id}'
+    '{requested-shipping-point=requested_shipping_point}'
+    '<delivery-spec>'
+    '{service-code=service_code}'
+    '<sender>'
+    '{name?=sender_name}{company=sender_company}'
+    '{contact-phone=sender_phone}{sender_address}'
+    '</sender>'
+    '<destination>'
+    '{name?=destination_name}{company?=destination_company}'
+    '{additional-address-info?=additional_address_info}'
+    '{client-voice-number?=destination_phone}{destination_address}'
+    '</destination>'
+    '{customs}{options}'
+    '<parcel-characteristics>'
+    '{weight=weight}{dimensions}{unpackaged=unpackaged}'
+    '</parcel-characteristics>'
+    '<print-preferences><output-format>4x6</output-format>'
+    '</print-preferences>'
+    '<preferences>'
+    '<show-packing-instructions>false</show-packing-instructions>'
+    '<show-postage-rate>false</show-postage-rate>'
+    '<show-insured-value>false</show-insured-value>'
+    '</preferences>'
+    '<settlement-info>{contract-id=contract_id}'
+    '<intended-method-of-payment>Account</intended-method-of-payment>'
+    '</settlement-info>'
+    '</delivery-spec>'
+    '</shipment>')
+ADDRESS_DETAILS = Template(
+    '<address-details>'
+    '{address-line-1=address1}{address-line-2=address2}{city=city}'
+    '{prov-state?=province}{country-code=country_code}'
+    '{postal-zip-code?=postal_code}'
+    '</address-details>')
+CUSTOMS = Template(
+    '<customs><currency>CAD</currency>'
+    '<reason-for-export>SOG</reason-for-export>'
+    '<sku-list>{items}</sku-list></customs>')
+CUSTOMS_ITEM = Template(
+    '<item>'
+    '{customs-number-of-units=units}{customs-description=description}'
+    '{unit-weight=weight}{customs-value-per-unit=value}'
+    '</item>')
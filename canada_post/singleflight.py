@@ -0,0 +1,81 @@
+"""
+Request coalescing: while a call for a key is in flight, other callers asking
+for the same key wait for its result instead of making their own call.
+
+SingleFlight does this for threads, canada_post.aio.AsyncSingleFlight for
+coroutines.
+"""
+import threading
+
+
+class SingleFlightStats(object):
+    """
+    `calls` counts every call made through the SingleFlight, `coalesced` the
+    ones that waited on another caller's request instead of making their own
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def called(self, coalesced):
+        with self._lock:
+            self.calls += 1
+            if coalesced:
+                self.coalesced += 1
+
+    def as_dict(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced}
+
+    def __repr__(self):
+        return "SingleFlightStats(calls={calls}, coalesced={coalesced})".format(
+            **self.as_dict())
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self.stats = SingleFlightStats()
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), unless a call for key is already in
+        flight, in which case wait for it and return (or raise) its outcome.
+        Should the call die of a BaseException (KeyboardInterrupt,
+        SystemExit...), the waiting callers raise it too
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        self.stats.called(coalesced=not leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
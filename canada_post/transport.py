@@ -0,0 +1,283 @@
+"""
+HTTP transport shared by the Canada Post services.
+
+A Transport owns one pooled, keep-alive requests session, so consecutive calls
+to the gateway reuse their TCP+TLS connections instead of doing a new
+handshake every time. CanadaPostAPI creates one and hands it to all of its
+services.
+
+Every response it returns gets a `phases` dict with the time spent opening a
+connection (connect, for DNS and TCP, and tls) if a new one was needed, and
+waiting for the server (server).
+
+Given a canada_post.httpcache.HTTPCache, GET responses are stored and served
+or revalidated from it. Responses from the cache have from_cache set, and
+every cacheable response a cache_memo dict (see ServiceBase.parse_xml).
+"""
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3 import PoolManager
+from urllib3.connection import HTTPSConnection
+
+# phases of the request in progress in each thread
+_local = threading.local()
+
+
+def _record_phase(phase, seconds):
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0) + seconds
+
+
+def _timed_connection(conn):
+    """
+    Wrap the connect method of a new urllib3 connection to time its phases
+    """
+    connect = conn.connect
+    open_socket = conn._new_conn
+    opened = []
+    def _new_conn():
+        started = time.time()
+        try:
+            return open_socket()
+        finally:
+            opened.append(time.time() - started)
+    def timed_connect():
+        del opened[:]
+        started = time.time()
+        try:
+            return connect()
+        finally:
+            elapsed = time.time() - started
+            socket_time = sum(opened)
+            _record_phase('connect', socket_time)
+            if isinstance(conn, HTTPSConnection):
+                _record_phase('tls', max(elapsed - socket_time, 0))
+    conn._new_conn = _new_conn
+    conn.connect = timed_connect
+    return conn
+
+
+class TransportStats(object):
+    """
+    Connection counters for a Transport.
+
+    `requests` is the number of requests sent and `connections` the number
+    of connections the pool had to open for them; the rest were served by a
+    kept-alive connection.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.pools = 0
+
+    def request_sent(self):
+        with self._lock:
+            self.requests += 1
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def pool_created(self):
+        with self._lock:
+            self.pools += 1
+
+    @property
+    def reused(self):
+        return max(self.requests - self.connections, 0)
+
+    @property
+    def reuse_ratio(self):
+        if not self.requests:
+            return 0.0
+        return float(self.reused) / self.requests
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'connections': self.connections,
+            'reused': self.reused,
+            'reuse_ratio': self.reuse_ratio,
+            'pools': self.pools,
+            }
+
+    def __repr__(self):
+        return ("TransportStats(requests={requests}, connections={connections}, "
+                "reused={reused}, pools={pools})").format(**self.as_dict())
+
+
+class _CountingPoolManager(PoolManager):
+    """
+    PoolManager that reports every new host pool and every new connection to
+    a TransportStats instance
+    """
+    def __init__(self, stats, *args, **kwargs):
+        self.stats = stats
+        super(_CountingPoolManager, self).__init__(*args, **kwargs)
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super(_CountingPoolManager, self)._new_pool(
+            scheme, host, port, request_context=request_context)
+        self.stats.pool_created()
+        stats = self.stats
+        new_conn = pool._new_conn
+        def _new_conn():
+            stats.connection_opened()
+            return _timed_connection(new_conn())
+        pool._new_conn = _new_conn
+        return pool
+
+
+class TransportAdapter(HTTPAdapter):
+    def __init__(self, stats, *args, **kwargs):
+        self.stats = stats
+        super(TransportAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False,
+                         **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = _CountingPoolManager(self.stats,
+                                                num_pools=connections,
+                                                maxsize=maxsize, block=block,
+                                                **pool_kwargs)
+
+
+class Transport(object):
+    """
+    Pooled keep-alive HTTP transport.
+
+    :pool_connections: how many host pools to keep (one per host the
+        services talk to; the gateway plus the hosts in returned links)
+    :pool_maxsize: connections kept alive per host
+    :pool_block: if True, never open more than `pool_maxsize` connections to
+        a host at the same time, wait for a free one instead
+    :timeout: default (connect, read) timeout in seconds for every request
+    :cache: canada_post.httpcache.HTTPCache for the GET responses
+    """
+    log = logging.getLogger('canada_post.transport.Transport')
+    DEFAULT_TIMEOUT = (10, 60)
+
+    def __init__(self, pool_connections=4, pool_maxsize=10, pool_block=False,
+                 timeout=DEFAULT_TIMEOUT, cache=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.timeout = timeout
+        self.cache = cache
+        self.stats = TransportStats()
+        self.session = requests.Session()
+        adapter = TransportAdapter(self.stats,
+                                   pool_connections=pool_connections,
+                                   pool_maxsize=pool_maxsize,
+                                   pool_block=pool_block)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        cache = self.cache
+        key = None
+        if cache is not None:
+            key = cache.key(method, url, kwargs.get('headers'),
+                            kwargs.get('auth'), kwargs.get('stream', False))
+        if key is None:
+            if cache is None:
+                return self.send(method, url, **kwargs)
+            # after the request too, in case a GET stored it meanwhile
+            cache.invalidate(method, url, kwargs.get('auth'))
+            try:
+                return self.send(method, url, **kwargs)
+            finally:
+                cache.invalidate(method, url, kwargs.get('auth'))
+        entry = cache.lookup(key)
+        if entry is not None:
+            if entry.is_fresh():
+                cache.hit(entry)
+                return self.replay(key, entry, {})
+            kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                     **entry.conditional_headers())
+        response = self.send(method, url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            entry = cache.revalidate(key, entry, response.headers)
+            return self.replay(key, entry, response.phases)
+        entry = cache.store(key, url, response.status_code, response.reason,
+                            response.headers, response.content)
+        response.from_cache = False
+        if entry is not None:
+            response.cache_memo = cache.memo(key, entry)
+        return response
+
+    def cached(self, method, url, **kwargs):
+        """
+        The response to a request served from the cache when it holds a
+        fresh one, otherwise None: the request has to be sent. The services
+        ask first, so that cache hits aren't rate limited or refused by an
+        open circuit breaker
+        """
+        cache = self.cache
+        if cache is None:
+            return None
+        key = cache.key(method, url, kwargs.get('headers'), kwargs.get('auth'),
+                        kwargs.get('stream', False))
+        if key is None:
+            return None
+        entry = cache.lookup(key)
+        if entry is None or not entry.is_fresh():
+            return None
+        cache.hit(entry)
+        return self.replay(key, entry, {})
+
+    def replay(self, key, entry, phases):
+        """
+        A requests.Response made from a stored response
+        """
+        response = requests.Response()
+        response.url = entry.url
+        response.status_code = entry.status_code
+        response.reason = entry.reason
+        response.headers = CaseInsensitiveDict(entry.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = entry.content
+        response.phases = phases
+        response.from_cache = True
+        response.cache_memo = self.cache.memo(key, entry)
+        return response
+
+    def send(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        self.stats.request_sent()
+        phases = _local.phases = {}
+        started = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        finally:
+            _local.phases = None
+        phases['server'] = max(time.time() - started
+                               - phases.get('connect', 0)
+                               - phases.get('tls', 0), 0)
+        response.phases = phases
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        self.log.info("Closing transport, %r", self.stats)
+        if self.cache is not None:
+            self.log.info("HTTP cache: %r", self.cache.stats)
+        self.session.close()
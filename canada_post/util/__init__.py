@@ -1,9 +1,119 @@
+_SLOT_NAMES = {}
+
+def slot_names(klass):
+    """
+    Names of the attributes declared in the __slots__ of klass and its bases
+    """
+    names = _SLOT_NAMES.get(klass)
+    if names is None:
+        names = []
+        for base in reversed(klass.__mro__):
+            for name in base.__dict__.get('__slots__', ()):
+                if name not in ('__dict__', '__weakref__') and \
+                        name not in names:
+                    names.append(name)
+        names = _SLOT_NAMES[klass] = tuple(names)
+    return names
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return frozenset((key, _hashable(item)) for key, item in value.items())
+    return value
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("{0} is read-only".format(self.__class__.__name__))
+
+class FrozenDict(dict):
+    """
+    Read-only dict, for the mappings FrozenValueObjects hold. It hashes, and
+    its copy() is a plain, mutable dict
+    """
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
 class InfoObject(object):
+    # subclasses get a __dict__ unless they declare __slots__ too
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
         # set any extra kwargs we got
             setattr(self, k, v)
 
     def __repr__(self):
+        contents = dict((name, getattr(self, name, None))
+                        for name in slot_names(type(self)))
+        contents.update(getattr(self, '__dict__', {}))
         return "{klass}.{contents}".format(klass=self.__class__.__name__,
-                                           contents=repr(self.__dict__))
+                                           contents=repr(contents))
+
+class ValueObject(InfoObject):
+    """
+    InfoObject with its attributes declared in __slots__, instead of a
+    __dict__ per instance. Subclasses that take extra keyword arguments keep
+    a '__dict__' slot for them, which stays unallocated until one is set.
+
+    Value objects are equal when their declared attributes and extras are,
+    hash alike when they're equal, and pickle as a tuple of values. They can
+    still be changed, which must not happen while one is a dict key or in a
+    set; FrozenValueObject subclasses can't be
+    """
+    __slots__ = ()
+
+    def _values(self):
+        return tuple(getattr(self, name, None)
+                     for name in slot_names(type(self)))
+
+    def _extras(self):
+        return getattr(self, '__dict__', None) or {}
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._values() == other._values() and \
+            self._extras() == other._extras()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((_hashable(self._values()), _hashable(self._extras())))
+
+    def __getstate__(self):
+        return self._values(), self._extras() or None
+
+    def __setstate__(self, state):
+        values, extra = state
+        for name, value in zip(slot_names(type(self)), values):
+            setattr(self, name, value)
+        if extra:
+            for name, value in extra.items():
+                setattr(self, name, value)
+
+class FrozenValueObject(ValueObject):
+    """
+    Read-only ValueObject: each attribute can be set once, by __init__, and
+    is never rebound nor deleted after that. So they can be used as dict
+    keys and shared between caches and callers
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError("{0} is read-only, can't set {1}".format(
+                self.__class__.__name__, name))
+        super(FrozenValueObject, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError("{0} is read-only, can't delete {1}".format(
+            self.__class__.__name__, name))
@@ -1,37 +1,64 @@
-from canada_post.util import InfoObject
+import re
+from canada_post.util import ValueObject
+
+# valid (normalized) postal codes, by country
+POSTAL_CODE_PATTERNS = {
+    "CA": re.compile(r"^[ABCEGHJ-NPRSTVXY]\d[ABCEGHJ-NPRSTV-Z]\d"
+                     r"[ABCEGHJ-NPRSTV-Z]\d$"),
+    "US": re.compile(r"^\d{5}(-?\d{4})?$"),
+}
+
+def normalize_postal_code(postal_code):
+    return postal_code.replace(" ", "").upper()
+
+def split_address(address):
+    """
+    Split a street address in the two lines of up to 44 characters Canada
+    Post takes. address is either a string, split at its last space before
+    the 44th character, or an already split (line 1, line 2) tuple.
+    Returns (None, None) for an empty address, raises ValueError for one
+    that's too long
+    """
+    if not address:
+        return None, None
+    if isinstance(address, tuple):
+        if not all(len(x) < 44 for x in address):
+            raise ValueError("Street address must be split in two 44 "
+                             "characters groups")
+        return address[0], address[1]
+    if len(address) >= 88:
+        raise ValueError("Street address can have up to 88 characters")
+    last_space_ix = address.rfind(" ", 0, 44)
+    address1 = address[:last_space_ix].strip()
+    address2 = address[last_space_ix:].strip()
+    if len(address2) >= 44:
+        raise ValueError("Must be able to split address in two 44 "
+                         "characters groups")
+    return address1, address2
+
+def check_city(city):
+    """
+    Raise ValueError for a city name Canada Post won't take
+    """
+    if city and len(city) >= 40:
+        raise ValueError("City name must have up to 40 characters")
+
+class AddressBase(ValueObject):
+    __slots__ = ('postal_code', 'name', 'company', 'phone', 'address1',
+                 'address2', 'city', 'province', '__dict__')
 
-class AddressBase(InfoObject):
     def __init__(self, postal_code, name=None, company=None, phone=None,
                  address=None, city=None, province=None,
                  *args, **kwargs):
-        self.postal_code = postal_code.replace(" ", "").upper()
+        self.postal_code = normalize_postal_code(postal_code)
         self.name = name
         self.company = company
         self.phone = phone
 
-        if address:
-            if isinstance(address, tuple):
-                assert all(len(x) < 44 for x in address), ("Street address "
-                                                           "must be split in "
-                                                           "two 44 characters "
-                                                           "groups")
-                self.address1 = address[0]
-                self.address2 = address[1]
-            else:
-                assert len(address) < 88, ("Street address can have up to 88 "
-                                           "characters")
-                last_space_ix = address.rfind(" ", 0, 44)
-                self.address1 = address[:last_space_ix].strip()
-                self.address2 = address[last_space_ix:].strip()
-                assert len(self.address2) < 44, ("Must be able to split "
-                                                 "address in two 44 characters "
-                                                 "groups")
-        else:
-            self.address1 = self.address2 = None
+        self.address1, self.address2 = split_address(address)
 
         self.city = city
-        if city:
-            assert len(city) < 40, ("City name must have up to 40 characters")
+        check_city(city)
 
         self.province = province
 
@@ -40,12 +67,29 @@ class AddressBase(InfoObject):
         super(AddressBase, self).__init__(**kwargs)
 
 class Origin(AddressBase):
+    __slots__ = ('country_code',)
+
     def __init__(self, country_code="CA", *args, **kwargs):
         self.country_code = country_code
         super(Origin, self).__init__(*args, **kwargs)
 
 class Destination(AddressBase):
+    """
+    If Destination.postal_index holds a canada_post.zones.PostalIndex,
+    destinations found in it get their zone, and their province unless
+    given one
+    """
+    __slots__ = ('country_code', 'extra', 'zone')
+    postal_index = None
+
     def __init__(self, country_code, extra=None, *args, **kwargs):
         self.country_code = country_code
         self.extra = extra
+        self.zone = None
         super(Destination, self).__init__(*args, **kwargs)
+        if self.postal_index is not None:
+            area = self.postal_index.lookup(country_code, self.postal_code)
+            if area is not None:
+                self.zone = area.zone
+                if not self.province:
+                    self.province = area.region
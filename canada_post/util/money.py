@@ -1,20 +1,26 @@
 from decimal import Decimal
-from canada_post.util import InfoObject
+from canada_post.util import FrozenValueObject
+from canada_post.util.xpath import PRICE_QUOTES, first
 
 ZERO = Decimal("0.00")
 
 def get_decimal(source):
     return Decimal(source or ZERO)
 
-class Adjustment(InfoObject):
-    def __init__(self, xml_source=None, **kwargs):
+class Adjustment(FrozenValueObject):
+    __slots__ = ('code', 'name', 'cost', 'percent', '__dict__')
+
+    def __init__(self, xml_source=None, code=None, name=None, cost=None,
+                 percent=None, **kwargs):
         if xml_source is not None:
-            self.code = xml_source.find("adjustment-code").text
-            self.name = xml_source.find("adjustment-name").text
-            self.cost = get_decimal(xml_source.find("adjustment-cost").text)
-            percent = xml_source.find("qualifier/percent")
-            if percent is not None:
-                self.percent = xml_source.find("qualifier/percent").text
+            code = first(PRICE_QUOTES.adjustment_code(xml_source))
+            name = first(PRICE_QUOTES.adjustment_name(xml_source))
+            cost = get_decimal(first(PRICE_QUOTES.adjustment_cost(xml_source)))
+            percent = first(PRICE_QUOTES.adjustment_percent(xml_source))
+        self.code = code
+        self.name = name
+        self.cost = cost
+        self.percent = percent
         super(Adjustment, self).__init__(**kwargs)
 
     def __repr__(self):
@@ -22,9 +28,13 @@ class Adjustment(InfoObject):
                "percent={percent}".format(code=self.code, name=self.name,
                                           cost=self.cost, percent=self.percent)
 
-class Price(InfoObject):
+class Price(FrozenValueObject):
+    __slots__ = ('due', 'base', 'gst', 'gst_pc', 'pst', 'pst_pc', 'hst',
+                 'hst_pc', 'tax_total', 'adjustments', 'adjustment_total',
+                 '__dict__')
+
     def __init__(self, due=ZERO, base=ZERO, gst=ZERO, gst_pc=ZERO, pst=ZERO,
-                 pst_pc=ZERO, hst=ZERO, hst_pc=ZERO, adjustments=[],
+                 pst_pc=ZERO, hst=ZERO, hst_pc=ZERO, adjustments=(),
                  **kwargs):
 
         # due is the total value, will be the sum of everything else, the rest
@@ -45,11 +55,11 @@ class Price(InfoObject):
         # tax total
         self.tax_total = gst + pst + hst
 
-        ## adjustment
-        self.adjustments=adjustments
+        ## adjustment, a tuple since prices are read-only
+        self.adjustments = tuple(adjustments)
         # adjustment total
         self.adjustment_total = sum(adjustment.cost
-            for adjustment in adjustments)
+            for adjustment in self.adjustments)
 
         super(Price, self).__init__(**kwargs)
 
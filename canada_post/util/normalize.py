@@ -0,0 +1,191 @@
+"""
+Batch address normalization, for importing whole address books.
+
+AddressNormalizer takes columns of raw address fields (a dict of field name
+-> list of values, e.g. straight from a CSV reader or a dataframe) and turns
+every row into an Origin or Destination, the same as AddressBase would, but
+without stopping at the first bad row: the problems of every row are
+collected as AddressErrors. Postal codes are also checked against the
+country's pattern (see canada_post.util.address.POSTAL_CODE_PATTERNS).
+
+Very large imports can be split in chunks normalized by a pool of processes.
+Those open the postal index installed as Destination.postal_index in this
+process themselves, from its path, since spawned workers don't inherit it.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from canada_post.compat import text_type
+from canada_post.util import InfoObject
+from canada_post.util.address import (Origin, Destination,
+                                      POSTAL_CODE_PATTERNS,
+                                      normalize_postal_code, split_address,
+                                      check_city)
+from canada_post.zones import PostalIndex
+
+FIELDS = ('postal_code', 'name', 'company', 'phone', 'address', 'city',
+          'province', 'country_code')
+
+
+class AddressError(InfoObject):
+    """
+    A problem with field `field` of row number `row` (0 based)
+    """
+    def __init__(self, row, field, message, **kwargs):
+        self.row = row
+        self.field = field
+        self.message = message
+        super(AddressError, self).__init__(**kwargs)
+
+
+class NormalizedAddresses(InfoObject):
+    """
+    addresses holds an Origin/Destination per row, None for the invalid
+    ones, and errors the AddressErrors of all rows
+    """
+    def __init__(self, addresses, errors, **kwargs):
+        self.addresses = addresses
+        self.errors = errors
+        super(NormalizedAddresses, self).__init__(**kwargs)
+
+    def errors_by_row(self):
+        rows = {}
+        for error in self.errors:
+            rows.setdefault(error.row, []).append(error)
+        return rows
+
+
+def _clean(value):
+    if value is None:
+        return None
+    value = text_type(value).strip()
+    return value or None
+
+
+def normalize_chunk(kind, columns, default_country=None, offset=0,
+                    postal_index=None):
+    """
+    Normalize the rows of columns into `kind` (Origin or Destination)
+    objects. Rows are numbered from offset in the errors.
+
+    postal_index is the path of the kind's postal index, for worker
+    processes: it's opened and installed on kind unless it already has it
+    """
+    if postal_index is not None and \
+            getattr(kind.postal_index, 'path', None) != postal_index:
+        kind.postal_index = PostalIndex(postal_index)
+    size = max(len(values) for values in columns.values())
+    def column(name, clean=_clean):
+        values = columns.get(name) or [None] * size
+        return [clean(value) for value in values]
+    postal_codes = column('postal_code', lambda value: normalize_postal_code(
+        _clean(value) or u""))
+    countries = column('country_code', lambda value: (
+        _clean(value) or default_country or u"").upper() or None)
+    provinces = column('province')
+    names = column('name')
+    companies = column('company')
+    phones = column('phone')
+    addresses = column('address', lambda value: value if isinstance(
+        value, tuple) else _clean(value))
+    cities = column('city')
+    extras = [(name, values) for name, values in columns.items()
+              if name not in FIELDS]
+
+    result = NormalizedAddresses([], [])
+    for index in range(size):
+        row = offset + index
+        errors = []
+        country = countries[index]
+        if country is None:
+            errors.append(AddressError(row, 'country_code',
+                                       "Country code is required"))
+        elif len(country) != 2:
+            errors.append(AddressError(
+                row, 'country_code',
+                "Invalid country code {0!r}".format(country)))
+        postal_code = postal_codes[index]
+        pattern = POSTAL_CODE_PATTERNS.get(country)
+        if pattern is not None and pattern.match(postal_code) is None:
+            errors.append(AddressError(
+                row, 'postal_code',
+                "Invalid postal code {0!r} for {1}".format(postal_code,
+                                                           country)))
+        address = None
+        try:
+            address1, address2 = split_address(addresses[index])
+            if address1 is not None:
+                address = (address1, address2)
+        except ValueError as error:
+            errors.append(AddressError(row, 'address', text_type(error)))
+        try:
+            check_city(cities[index])
+        except ValueError as error:
+            errors.append(AddressError(row, 'city', text_type(error)))
+
+        if errors:
+            result.addresses.append(None)
+            result.errors.extend(errors)
+            continue
+        extra = dict((name, values[index]) for name, values in extras)
+        try:
+            result.addresses.append(kind(
+                country_code=country, postal_code=postal_code,
+                name=names[index], company=companies[index],
+                phone=phones[index], address=address, city=cities[index],
+                province=provinces[index], **extra))
+        except (ValueError, TypeError) as error:
+            result.addresses.append(None)
+            result.errors.append(AddressError(row, None, text_type(error)))
+    return result
+
+
+class AddressNormalizer(object):
+    """
+    :kind: Origin or Destination, the class to normalize rows into
+    :default_country: country code for rows without one. Defaults to "CA"
+        for origins
+    :processes: 0 normalizes in this process. Otherwise imports of more
+        than chunk_size rows are split in chunks of chunk_size rows,
+        normalized by a pool of that many processes (None for one per CPU)
+    """
+    def __init__(self, kind=Destination, default_country=None,
+                 processes=0, chunk_size=10000):
+        if default_country is None and issubclass(kind, Origin):
+            default_country = "CA"
+        self.kind = kind
+        self.default_country = default_country
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+    def __call__(self, columns):
+        """
+        Normalize columns, a dict of field name -> list of values, all of the
+        same length. Fields other than AddressBase's are passed on to the
+        objects as extra keyword arguments. Returns NormalizedAddresses
+        """
+        columns = dict((name, list(values)) for name, values in
+                       columns.items())
+        sizes = set(len(values) for values in columns.values())
+        if len(sizes) > 1:
+            raise ValueError("All address columns must have the same length")
+        size = sizes.pop() if sizes else 0
+        if not size:
+            return NormalizedAddresses([], [])
+        if self.processes == 0 or size <= self.chunk_size:
+            return normalize_chunk(self.kind, columns, self.default_country)
+
+        offsets = range(0, size, self.chunk_size)
+        chunks = [dict((name, values[offset:offset + self.chunk_size])
+                       for name, values in columns.items())
+                  for offset in offsets]
+        postal_index = getattr(getattr(self.kind, 'postal_index', None),
+                               'path', None)
+        result = NormalizedAddresses([], [])
+        with ProcessPoolExecutor(self.processes) as pool:
+            for chunk in pool.map(normalize_chunk,
+                                  [self.kind] * len(chunks), chunks,
+                                  [self.default_country] * len(chunks),
+                                  offsets,
+                                  [postal_index] * len(chunks)):
+                result.addresses.extend(chunk.addresses)
+                result.errors.extend(chunk.errors)
+        return result
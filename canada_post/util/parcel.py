@@ -1,13 +1,15 @@
 """
 Parcel module
 """
-from canada_post.util import InfoObject
+from canada_post.util import ValueObject
 
-class Item(InfoObject):
+class Item(ValueObject):
     """
     Represents a single Item in a parcel. It's required for international
     shipments
     """
+    __slots__ = ('amount', 'description', 'weight', 'price', '__dict__')
+
     def __init__(self, amount, description, weight, price,
                  **kwargs):
         self.amount = amount
@@ -16,11 +18,14 @@ class Item(InfoObject):
         self.price = price
         super(Item, self).__init__(**kwargs)
 
-class Parcel(InfoObject):
+class Parcel(ValueObject):
     """
     Represents a Canada Post parcel. Holds things as dimensions, weight,
     tracking number...
     """
+    __slots__ = ('weight', 'length', 'width', 'height', 'unpackaged', 'items',
+                 '__dict__')
+
     def __init__(self, weight=0, length=0, width=0, height=0, unpackaged=False,
                  items=None,
                  **kwargs):
@@ -0,0 +1,165 @@
+"""
+Lazy payload logging.
+
+The services log the XML they send and receive at debug level. Payload wraps
+such a body so that nothing is done with it unless the record is actually
+emitted: only then is it decoded, pretty printed (if asked and small enough),
+stripped of credentials and personal information, and truncated to
+MAX_SIZE characters. With debug logging off, logging a payload costs the
+creation of the wrapper, however big the body is.
+
+The elements whose text is redacted are listed in REDACTED; add to it (or
+set MAX_SIZE) at start up to change what gets logged.
+
+The parcels and addresses the services log at info level go through masked,
+which hides their MASKED_ATTRIBUTES the same way.
+"""
+import re
+from lxml import etree
+from canada_post.compat import text_type
+from canada_post.util import slot_names
+
+# maximum number of characters of a payload that get logged
+MAX_SIZE = 2048
+MASK = u"***"
+# elements holding credentials or personal information
+REDACTED = set([
+    'customer-number', 'contract-id', 'mobo', 'paid-by-customer',
+    'name', 'company', 'contact-phone', 'client-voice-number', 'email',
+    'address-line-1', 'address-line-2', 'cc-holder-name', 'cc-number',
+    'cc-expiry', 'account-number', 'manifest-company', 'manifest-name',
+    'phone-number',
+    ])
+# attributes of the logged objects holding personal information
+MASKED_ATTRIBUTES = set([
+    'name', 'company', 'phone', 'address1', 'address2', 'email',
+    ])
+
+_ELEMENT = re.compile(u'<([\\w:-]+)((?:\\s[^>]*)?)>([^<]*)</\\1>')
+# element cut by the truncation, with its closing tag gone
+_CUT_ELEMENT = re.compile(u'<([\\w:-]+)((?:\\s[^>]*)?)>([^<]*)$')
+
+
+def _local_name(tag):
+    return tag.rsplit(':', 1)[-1]
+
+
+def redact(text):
+    """
+    text with the content of the REDACTED elements masked
+    """
+    def mask(match):
+        tag, attributes, content = match.groups()
+        if _local_name(tag) not in REDACTED or not content.strip():
+            return match.group(0)
+        return u"<{0}{1}>{2}</{0}>".format(tag, attributes, MASK)
+    text = _ELEMENT.sub(mask, text)
+    match = _CUT_ELEMENT.search(text)
+    if match is not None and _local_name(match.group(1)) in REDACTED:
+        text = text[:match.start(3)] + MASK
+    return text
+
+
+class Payload(object):
+    """
+    A request or response body to log: `%s` formats it (see the module
+    docstring). data is the body, bytes or text, or a response, whose body is
+    only used if it was already read (a streamed response isn't consumed)
+    """
+    __slots__ = ('data', 'pretty', 'max_size')
+
+    def __init__(self, data, pretty=False, max_size=None):
+        self.data = data
+        self.pretty = pretty
+        self.max_size = max_size
+
+    def _body(self):
+        data = self.data
+        if hasattr(data, 'status_code'):
+            if getattr(data, '_content', None) is False:
+                # a streamed requests.Response that hasn't been read
+                return None
+            data = data.content
+        return data
+
+    def __unicode__(self):
+        data = self._body()
+        if data is None:
+            return u"<streamed body>"
+        max_size = MAX_SIZE if self.max_size is None else self.max_size
+        if isinstance(data, bytes):
+            if self.pretty and len(data) <= max_size:
+                try:
+                    data = etree.tostring(etree.fromstring(data),
+                                          pretty_print=True)
+                except etree.XMLSyntaxError:
+                    pass
+            # enough bytes for max_size characters
+            head = data[:max_size * 4]
+            try:
+                text = head.decode('utf-8')
+            except UnicodeDecodeError as error:
+                if error.start < len(head) - 3:
+                    return u"<{0} bytes of binary content>".format(len(data))
+                # a character cut at the end of head
+                text = head[:error.start].decode('utf-8')
+            truncated = len(text) > max_size or len(head) < len(data)
+            unit = u"bytes"
+        else:
+            text = data
+            truncated = len(text) > max_size
+            unit = u"characters"
+        text = redact(text[:max_size])
+        if truncated:
+            text += u"... ({0} {1} in all)".format(len(data), unit)
+        return text
+
+    def __str__(self):
+        text = self.__unicode__()
+        return text if str is text_type else text.encode('utf-8')
+
+
+def payload(data, pretty=False, max_size=None):
+    """
+    Wrap data for lazy logging: log.debug("Request xml: %s", payload(data))
+    """
+    return Payload(data, pretty, max_size)
+
+
+def _masked(obj):
+    if isinstance(obj, (list, tuple)):
+        return u"({0})".format(u", ".join(_masked(item) for item in obj))
+    attributes = [(name, getattr(obj, name, None))
+                  for name in slot_names(type(obj))]
+    attributes.extend(sorted(getattr(obj, '__dict__', {}).items()))
+    if not attributes:
+        return text_type(repr(obj))
+    return u"{0}({1})".format(obj.__class__.__name__, u", ".join(
+        u"{0}={1}".format(name, MASK if value and name in MASKED_ATTRIBUTES
+                          else repr(value))
+        for name, value in attributes))
+
+
+class Masked(object):
+    """
+    An object to log, with `%s`: its class and attributes, with the
+    MASKED_ATTRIBUTES masked. Lists and tuples are formatted item by item
+    """
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __unicode__(self):
+        return _masked(self.obj)
+
+    def __str__(self):
+        text = self.__unicode__()
+        return text if str is text_type else text.encode('utf-8')
+
+
+def masked(obj):
+    """
+    Wrap obj for lazy logging: log.info("Parcel from %s", masked(origin))
+    """
+    return Masked(obj)
@@ -0,0 +1,128 @@
+"""
+Response parsing for the Canada Post services and the objects they return
+
+Responses are parsed once, straight from the response bytes and keeping their
+namespaces. Every response type gets an XPathSet: the XPath expressions its
+parser needs, compiled once at import time against the response's namespace
+(bound to the `cp` prefix).
+"""
+from lxml import etree
+from canada_post.errors import CanadaPostError
+
+RATE_NS = "http://www.canadapost.ca/ws/ship/rate-v2"
+SHIPMENT_NS = "http://www.canadapost.ca/ws/shipment-v7"
+MANIFEST_NS = "http://www.canadapost.ca/ws/manifest-v7"
+MESSAGES_NS = "http://www.canadapost.ca/ws/messages"
+
+
+class XPathSet(object):
+    """
+    A set of precompiled XPath expressions over a single namespace, available
+    as attributes. Each one is called with the context element
+    """
+    def __init__(self, namespace, **paths):
+        self.namespace = namespace
+        namespaces = {'cp': namespace}
+        for name, path in paths.items():
+            setattr(self, name, etree.XPath(path, namespaces=namespaces,
+                                             smart_strings=False))
+
+
+def parse(content):
+    """
+    Parse the bytes of a response body into an lxml Element
+    """
+    return etree.fromstring(content)
+
+
+def first(result, default=None):
+    """
+    First item of an XPath result, or default if there's none
+    """
+    return result[0] if result else default
+
+
+def response_error(response):
+    """
+    The CanadaPostError for an error response: the code and description of
+    its <messages> body, or its status code and reason when it doesn't have
+    one (e.g. an HTML page from a proxy, or no body at all)
+    """
+    try:
+        restree = parse(response.content)
+    except (etree.XMLSyntaxError, ValueError):
+        restree = None
+    code = None
+    if restree is not None:
+        code = first(MESSAGES.code(restree))
+    if code is None:
+        error = CanadaPostError(response.status_code, response.reason)
+    else:
+        if code.isdigit():
+            code = int(code)
+        error = CanadaPostError(code, first(MESSAGES.description(restree)))
+    error.response = response
+    return error
+
+
+def links_dict(link_elements):
+    """
+    Turn a list of <link> elements into a dict of rel -> attributes dict
+    """
+    return dict((link.get('rel'), dict(link.attrib))
+                for link in link_elements)
+
+
+# <price-quotes>, returned by GetRates
+PRICE_QUOTES = XPathSet(
+    RATE_NS,
+    price_quotes="/cp:price-quotes/cp:price-quote",
+    service_code="cp:service-code/text()",
+    service_link="cp:service-link",
+    service_name="cp:service-name/text()",
+    price_details="cp:price-details",
+    transit_time="cp:service-standard/cp:expected-transit-time/text()",
+    due="cp:due/text()",
+    base="cp:base/text()",
+    gst="cp:taxes/cp:gst",
+    pst="cp:taxes/cp:pst",
+    hst="cp:taxes/cp:hst",
+    adjustments="cp:adjustments/cp:adjustment",
+    adjustment_code="cp:adjustment-code/text()",
+    adjustment_name="cp:adjustment-name/text()",
+    adjustment_cost="cp:adjustment-cost/text()",
+    adjustment_percent="cp:qualifier/cp:percent/text()",
+)
+
+# <shipment-info>, returned by CreateShipment and GetShipment
+SHIPMENT_INFO = XPathSet(
+    SHIPMENT_NS,
+    link="cp:link",
+)
+
+# <manifests>, returned by TransmitShipments, and <manifest>, by GetManifest
+MANIFESTS = XPathSet(
+    MANIFEST_NS,
+    links="/cp:manifests/cp:link",
+    po_number="cp:po-number/text()",
+    manifest_links="cp:links/cp:link",
+)
+
+# <shipments>, returned by GetManifestShipments
+SHIPMENTS = XPathSet(
+    SHIPMENT_NS,
+    links="/cp:shipments/cp:link",
+)
+
+# <groups>, returned by GetGroups
+GROUPS = XPathSet(
+    SHIPMENT_NS,
+    group_ids="/cp:groups/cp:group/cp:group-id/text()",
+)
+
+# <messages>, the body of error responses
+MESSAGES = XPathSet(
+    MESSAGES_NS,
+    code="//cp:message/cp:code/text()",
+    description="//cp:message/cp:description/text()",
+)
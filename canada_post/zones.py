@@ -0,0 +1,174 @@
+"""
+Postal code index: the province (or state) and rate zone of Canadian FSAs
+(the first three characters of a postal code) and US ZIP3s (the first three
+digits of a zip code).
+
+The index is a binary file of fixed size records sorted by key, built from a
+CSV file with `country,prefix,region,zone` rows:
+
+    python -m canada_post.zones build zones.csv zones.idx
+    python -m canada_post.zones lookup zones.idx CA "K1K 4T3"
+
+and read through a read-only memory map, so opening it is instantaneous and
+every process using it shares the same pages.
+
+Once installed as Destination.postal_index, destinations get their province
+(when not given) and zone filled in, and a RateCache created with
+by_zone=True keys quotes on the destination's zone instead of its postal
+code. Zones are only meaningful for one origin, so build the index from the
+zone chart of the place you ship from.
+"""
+from __future__ import print_function
+import csv
+import mmap
+import struct
+import sys
+from canada_post.util import FrozenValueObject
+
+MAGIC = b'CPZ1'
+HEADER = struct.Struct('<4sII')
+# key (country initial + prefix), region, zone
+RECORD = struct.Struct('<4s4s8s')
+COUNTRIES = {"CA": b"C", "US": b"U"}
+
+
+class PostalArea(FrozenValueObject):
+    __slots__ = ('region', 'zone')
+
+    def __init__(self, region, zone):
+        self.region = region
+        self.zone = zone
+
+
+def make_key(country_code, postal_code):
+    """
+    Index key for a postal code, None for countries the index doesn't cover
+    """
+    country = COUNTRIES.get(country_code)
+    if country is None or not postal_code:
+        return None
+    prefix = postal_code.replace(" ", "").upper()[:3]
+    if len(prefix) != 3:
+        return None
+    return country + prefix.encode('ascii', 'replace')
+
+
+def _field(value, size, name):
+    data = value.strip().encode('ascii')
+    if len(data) > size:
+        raise ValueError("{0} {1!r} is longer than {2} characters".format(
+            name, value, size))
+    return data
+
+
+def build(rows, path):
+    """
+    Write the index of rows, (country code, prefix, region, zone) tuples,
+    to path
+    """
+    records = {}
+    for country_code, prefix, region, zone in rows:
+        key = make_key(country_code.strip().upper(), prefix)
+        if key is None:
+            raise ValueError("Bad index row: {0!r}".format(
+                (country_code, prefix, region, zone)))
+        if key in records:
+            raise ValueError("Duplicate index key {0!r}".format(key))
+        records[key] = RECORD.pack(key,
+                                   _field(region.upper(), 4, "Region"),
+                                   _field(zone, 8, "Zone"))
+    with open(path, 'wb') as index:
+        index.write(HEADER.pack(MAGIC, len(records), RECORD.size))
+        for key in sorted(records):
+            index.write(records[key])
+    return len(records)
+
+
+class PostalIndex(object):
+    """
+    Read-only, memory-mapped postal code index. Lookups are a binary search
+    over the records
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index:
+            self._map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, record_size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or record_size != RECORD.size:
+            self._map.close()
+            raise ValueError("{0} is not a postal code index".format(path))
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, key):
+        data = self._map
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            found = data[offset:offset + 4]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return offset
+        return None
+
+    def lookup(self, country_code, postal_code):
+        """
+        The PostalArea of a postal code, None if it's not in the index
+        """
+        key = make_key(country_code, postal_code)
+        if key is None:
+            return None
+        offset = self._find(key)
+        if offset is None:
+            return None
+        _, region, zone = RECORD.unpack_from(self._map, offset)
+        return PostalArea(region.rstrip(b'\0').decode('ascii'),
+                          zone.rstrip(b'\0').decode('ascii'))
+
+    def close(self):
+        self._map.close()
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m canada_post.zones',
+                                     description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    build_parser = commands.add_parser(
+        'build', help="build an index from a country,prefix,region,zone CSV")
+    build_parser.add_argument('source')
+    build_parser.add_argument('index')
+    lookup_parser = commands.add_parser('lookup', help="look a postal code up")
+    lookup_parser.add_argument('index')
+    lookup_parser.add_argument('country_code')
+    lookup_parser.add_argument('postal_code')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        with open(args.source) as source:
+            rows = [row for row in csv.reader(source)
+                    if row and not row[0].startswith('#')]
+        if rows and rows[0][0].strip().lower() == 'country':
+            rows = rows[1:]
+        count = build((row[:4] for row in rows), args.index)
+        print("Wrote {0} entries to {1}".format(count, args.index))
+    elif args.command == 'lookup':
+        area = PostalIndex(args.index).lookup(args.country_code.upper(),
+                                              args.postal_code)
+        if area is None:
+            print("Not found")
+            return 1
+        print(area.region, area.zone)
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
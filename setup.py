@@ -15,5 +15,9 @@ setup(
     install_requires = [
         'requests>=0.8',
         "lxml",
+        'futures; python_version < "3"',
     ],
+    extras_require={
+        'async': ['aiohttp>=3.0'],
+    },
 )
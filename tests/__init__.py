@@ -0,0 +1,37 @@
+"""
+Tests of the services against the gateway simulator, benchmarks/gateway.py
+
+    python -m pytest tests
+    python -m unittest discover tests
+"""
+import os
+import sys
+
+from canada_post.util.address import Origin, Destination
+from canada_post.util.parcel import Parcel
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks')
+if BENCHMARKS not in sys.path:
+    sys.path.insert(0, BENCHMARKS)
+
+from gateway import Gateway, load_payload  # noqa: E402
+
+CREDENTIALS = ("1234567", "user", "password", "42")
+PARCEL = Parcel(weight=2, length=10, width=6, height=3)
+ORIGIN = Origin(postal_code="H2B1A0", company="ACME", phone="555-555-5555",
+                address="123 Main st", city="Montreal", province="QC")
+DESTINATION = Destination(country_code="CA", postal_code="K1K4T3",
+                          name="John Doe", address="456 Elm st",
+                          city="Ottawa", province="ON")
+GROUP = "bobo"
+
+
+def closed_port_url():
+    """
+    URL of a local port nothing listens on
+    """
+    gateway = Gateway()
+    url = gateway.url
+    gateway.server.server_close()
+    return url
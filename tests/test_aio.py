@@ -0,0 +1,195 @@
+"""
+The asyncio client against the gateway simulator (python 3.7+, aiohttp)
+"""
+import asyncio
+import hashlib
+import io
+import unittest
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from canada_post.errors import CanadaPostError
+from canada_post.retry import RetryPolicy
+from canada_post.service import Service
+from canada_post.service.contract_shipping import Shipment
+from tests import (Gateway, load_payload, CREDENTIALS, PARCEL, ORIGIN,
+                   DESTINATION, GROUP, closed_port_url)
+
+if aiohttp is not None:
+    from canada_post.aio import AsyncCanadaPostAPI, AsyncTransport
+
+
+@unittest.skipIf(aiohttp is None, "requires aiohttp")
+class AsyncGatewayTestCase(unittest.TestCase):
+    gateway_options = {}
+
+    def setUp(self):
+        self.gateway = Gateway(**self.gateway_options).start()
+        self.addCleanup(self.gateway.stop)
+
+    def run_with_api(self, test, **options):
+        """
+        Run the coroutine function test with an AsyncCanadaPostAPI pointed
+        at the gateway
+        """
+        options.setdefault('gateway', self.gateway.url)
+        async def run():
+            async with AsyncCanadaPostAPI(*CREDENTIALS, **options) as api:
+                return await test(api)
+        return asyncio.run(run())
+
+
+class AsyncServicesTest(AsyncGatewayTestCase):
+    def test_get_rates(self):
+        services = self.run_with_api(
+            lambda api: api.get_rates(PARCEL, ORIGIN, DESTINATION))
+        self.assertTrue(services)
+        for service in services:
+            self.assertIsInstance(service, Service)
+            self.assertGreater(service.price.due, 0)
+
+    def test_create_get_void_shipment(self):
+        async def test(api):
+            service = (await api.get_rates(PARCEL, ORIGIN, DESTINATION))[0]
+            shipment = await api.create_shipment(PARCEL, ORIGIN, DESTINATION,
+                                                 service, GROUP)
+            self.assertIsInstance(shipment, Shipment)
+            self.assertIn('label', shipment.links)
+            fetched = await api.get_shipment(shipment.id)
+            self.assertEqual(fetched.id, shipment.id)
+            response = await api.void_shipment(shipment)
+            self.assertEqual(response.status_code, 204)
+        self.run_with_api(test)
+
+    def test_get_artifact(self):
+        label = load_payload('label.pdf')
+        sink = io.BytesIO()
+        async def test(api):
+            shipment = await api.get_shipment('123')
+            return await api.get_artifact(shipment, sink=sink,
+                                          checksum='sha256')
+        transport = AsyncTransport(max_concurrency=2)
+        artifact = self.run_with_api(test, transport=transport)
+        self.assertEqual(sink.getvalue(), label)
+        self.assertEqual(artifact.size, len(label))
+        self.assertEqual(artifact.checksum,
+                         hashlib.sha256(label).hexdigest())
+        self.assertEqual(transport.in_flight, 0)
+
+    def test_http_cache(self):
+        from canada_post.httpcache import HTTPCache
+        cache = HTTPCache()
+        transport = AsyncTransport(cache=cache)
+        shipment_id = '347881315405043891'
+        async def test(api):
+            shipment = await api.get_shipment(shipment_id)
+            url = shipment.links['self']['href'].replace(
+                'https://ct.soa-gw.canadapost.ca', self.gateway.url)
+            fetched = await transport.request('GET', url, auth=('user', 'pw'))
+            revalidated = await transport.request('GET', url,
+                                                  auth=('user', 'pw'))
+            await api.void_shipment(shipment)
+            refetched = await transport.request('GET', url,
+                                                auth=('user', 'pw'))
+            return fetched, revalidated, refetched
+        fetched, revalidated, refetched = self.run_with_api(
+            test, transport=transport)
+        self.assertFalse(fetched.from_cache)
+        self.assertTrue(revalidated.from_cache)
+        self.assertEqual(revalidated.headers['etag'],
+                         fetched.headers['ETag'])
+        # the DELETE dropped it
+        self.assertFalse(refetched.from_cache)
+        self.assertEqual(cache.stats.revalidated, 1)
+
+    def test_concurrency_limit(self):
+        self.gateway.latency = 0.05
+        transport = AsyncTransport(max_concurrency=3)
+        seen = []
+        async def test(api):
+            calls = asyncio.gather(*[
+                api.get_rates(PARCEL, ORIGIN, DESTINATION)
+                for _ in range(10)])
+            while not calls.done():
+                seen.append(transport.in_flight)
+                await asyncio.sleep(0.005)
+            return await calls
+        results = self.run_with_api(test, transport=transport)
+        self.assertEqual(len(results), 10)
+        self.assertEqual(max(seen), 3)
+        self.assertEqual(transport.in_flight, 0)
+        self.assertEqual(self.gateway.requests, {'rating': 10})
+
+    def test_coalesced_rates(self):
+        self.gateway.latency = 0.05
+        async def test(api):
+            return await asyncio.gather(*[
+                api.get_rates(PARCEL, ORIGIN, DESTINATION)
+                for _ in range(5)])
+        results = self.run_with_api(test, coalesce_rates=True)
+        self.assertEqual(len(set(len(services) for services in results)), 1)
+        self.assertEqual(self.gateway.requests, {'rating': 1})
+
+    def test_cancelled_artifact_frees_its_slot(self):
+        self.gateway.latency = 0.05
+        transport = AsyncTransport(max_concurrency=1)
+        async def test(api):
+            shipment = await api.get_shipment('123')
+            download = asyncio.ensure_future(
+                api.get_artifact(shipment, sink=io.BytesIO()))
+            await asyncio.sleep(0.01)
+            download.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await download
+            # the only slot is free again
+            return await api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertTrue(self.run_with_api(test, transport=transport))
+        self.assertEqual(transport.in_flight, 0)
+
+
+class AsyncErrorsTest(AsyncGatewayTestCase):
+    gateway_options = {'error_rate': 1, 'errors': (500,)}
+
+    def test_get_rates_error(self):
+        with self.assertRaises(CanadaPostError) as raised:
+            self.run_with_api(
+                lambda api: api.get_rates(PARCEL, ORIGIN, DESTINATION))
+        self.assertEqual(raised.exception.code, 9999)
+
+    def test_get_shipment_error(self):
+        with self.assertRaises(requests.HTTPError) as raised:
+            self.run_with_api(lambda api: api.get_shipment('123'))
+        self.assertEqual(raised.exception.response.status_code, 500)
+
+    def test_artifact_error_frees_its_slot(self):
+        transport = AsyncTransport(max_concurrency=1)
+        shipment = Shipment(links={'label': {
+            'href': 'https://ct.soa-gw.canadapost.ca/ers/artifact/1/0'}})
+        async def test(api):
+            for _ in range(3):
+                with self.assertRaises(requests.HTTPError):
+                    await api.get_artifact(shipment, sink=io.BytesIO())
+        self.run_with_api(test, transport=transport)
+        self.assertEqual(transport.in_flight, 0)
+
+    def test_retries(self):
+        with self.assertRaises(CanadaPostError):
+            self.run_with_api(
+                lambda api: api.get_rates(PARCEL, ORIGIN, DESTINATION),
+                retry_policy=RetryPolicy(max_attempts=3, backoff=0.01))
+        self.assertEqual(self.gateway.requests, {'rating': 3})
+
+    def test_connection_refused(self):
+        with self.assertRaises(requests.ConnectionError):
+            self.run_with_api(
+                lambda api: api.get_rates(PARCEL, ORIGIN, DESTINATION),
+                gateway=closed_port_url())
+
+
+if __name__ == '__main__':
+    unittest.main()
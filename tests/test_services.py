@@ -0,0 +1,772 @@
+"""
+The synchronous client against the gateway simulator
+"""
+import fnmatch
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from canada_post import DEV
+from canada_post.api import CanadaPostAPI
+from canada_post.errors import CanadaPostError, InDoubt
+from canada_post.retry import RetryPolicy, CircuitBreaker, CircuitOpen
+from canada_post.service import Service
+from canada_post.service.contract_shipping import Shipment
+from canada_post.transport import Transport
+from canada_post.httpcache import HTTPCache
+from canada_post.util.address import Origin
+from canada_post.util.parcel import Parcel
+from tests import (Gateway, load_payload, CREDENTIALS, PARCEL, ORIGIN,
+                   DESTINATION, GROUP, closed_port_url)
+
+
+class FakeRedis(object):
+    """
+    The part of redis-py's client SharedBackend uses, over a dict
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match, count=None):
+        return [key for key in list(self.data)
+                if fnmatch.fnmatch(key, match)]
+
+
+def run_in_threads(count, func):
+    """
+    Call func from count threads at once, returning their results
+    """
+    barrier = threading.Barrier(count)
+    results = [None] * count
+    def run(index):
+        barrier.wait()
+        results[index] = func()
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class GatewayTestCase(unittest.TestCase):
+    gateway_options = {}
+
+    def setUp(self):
+        self.gateway = Gateway(**self.gateway_options).start()
+        self.addCleanup(self.gateway.stop)
+
+    def api(self, **options):
+        options.setdefault('gateway', self.gateway.url)
+        api = CanadaPostAPI(*CREDENTIALS, **options)
+        self.addCleanup(api.close)
+        return api
+
+
+class ServicesTest(GatewayTestCase):
+    def test_get_rates(self):
+        services = self.api().get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertTrue(services)
+        for service in services:
+            self.assertIsInstance(service, Service)
+            self.assertTrue(service.code)
+            self.assertGreater(service.price.due, 0)
+        self.assertEqual(self.gateway.requests, {'rating': 1})
+
+    def test_batch_rates(self):
+        other = Parcel(weight=5)
+        scenarios = [(PARCEL, ORIGIN, DESTINATION),
+                     (other, ORIGIN, DESTINATION),
+                     (PARCEL, ORIGIN, DESTINATION)]
+        for max_workers in (8, 0):
+            self.gateway.requests.clear()
+            results = self.api().get_rates.batch(scenarios,
+                                                 max_workers=max_workers)
+            self.assertEqual(len(results), 3)
+            for services in results:
+                self.assertTrue(services)
+                self.assertIsInstance(services[0], Service)
+            # identical scenarios are quoted once
+            self.assertEqual(self.gateway.requests, {'rating': 2})
+        self.assertEqual(self.api().get_rates.batch([]), [])
+
+    def test_rate_cache(self):
+        from canada_post.cache import RateCache
+        cache = RateCache(ttl=60)
+        api = self.api(rate_cache=cache)
+        services = api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        services.append('changed by the caller')
+        cached = api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertNotIn('changed by the caller', cached)
+        self.assertEqual(self.gateway.requests, {'rating': 1})
+        self.assertEqual((cache.stats.hits, cache.stats.misses), (1, 1))
+
+    def test_rate_cache_expires(self):
+        from canada_post.cache import RateCache
+        api = self.api(rate_cache=RateCache(ttl=0.05))
+        api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        time.sleep(0.1)
+        api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(self.gateway.requests, {'rating': 2})
+
+    def test_rate_cache_evicts_least_recently_used(self):
+        from canada_post.cache import RateCache
+        cache = RateCache(maxsize=2)
+        api = self.api(rate_cache=cache)
+        first, second, third = [Parcel(weight=weight) for weight in (1, 2, 3)]
+        for parcel in (first, second, first, third, first, second):
+            api.get_rates(parcel, ORIGIN, DESTINATION)
+        # third evicted second, the least recently used, and not first
+        self.assertEqual(self.gateway.requests, {'rating': 4})
+        self.assertEqual(cache.stats.hits, 2)
+        self.assertEqual(cache.stats.evictions, 2)
+
+    def test_rate_cache_by_zone(self):
+        from canada_post.cache import RateCache
+        from canada_post.util.address import Destination
+        from canada_post.zones import PostalIndex, build
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'zones.idx')
+        build([("CA", "K1K", "ON", "4"), ("CA", "K2P", "ON", "4"),
+               ("CA", "M5V", "ON", "5")], path)
+        index = PostalIndex(path)
+        self.addCleanup(index.close)
+        Destination.postal_index = index
+        self.addCleanup(setattr, Destination, 'postal_index', None)
+
+        destinations = [Destination("CA", postal_code=postal_code)
+                        for postal_code in ("K1K4T3", "K2P1A1", "M5V2T6",
+                                            "H2B1A0")]
+        self.assertEqual([destination.zone for destination in destinations],
+                         ["4", "4", "5", None])
+        self.assertEqual(destinations[0].province, "ON")
+        cache = RateCache(by_zone=True)
+        api = self.api(rate_cache=cache)
+        for destination in destinations:
+            api.get_rates(PARCEL, ORIGIN, destination)
+        # K2P is in K1K's zone, H2B isn't in the index at all
+        self.assertEqual(self.gateway.requests, {'rating': 3})
+        self.assertEqual(cache.stats.hits, 1)
+
+        # without by_zone, each postal code is quoted
+        self.gateway.requests.clear()
+        api = self.api(rate_cache=RateCache())
+        for destination in destinations:
+            api.get_rates(PARCEL, ORIGIN, destination)
+        self.assertEqual(self.gateway.requests, {'rating': 4})
+
+    def test_shared_rate_cache(self):
+        from canada_post.cache import RateCache, SharedBackend
+        server = FakeRedis()
+        api = self.api(rate_cache=RateCache(backend=SharedBackend(server)))
+        other = self.api(rate_cache=RateCache(backend=SharedBackend(server)))
+        services = api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(other.get_rates(PARCEL, ORIGIN, DESTINATION),
+                         services)
+        self.assertEqual(self.gateway.requests, {'rating': 1})
+        other.get_rates.cache.backend.clear()
+        self.assertEqual(server.data, {})
+
+    def test_coalesced_rates(self):
+        self.gateway.latency = 0.1
+        api = self.api(coalesce_rates=True)
+        results = run_in_threads(
+            5, lambda: api.get_rates(PARCEL, ORIGIN, DESTINATION))
+        self.assertEqual(len(set(id(services) for services in results)), 5)
+        self.assertEqual(len(set(len(services) for services in results)), 1)
+        self.assertEqual(self.gateway.requests, {'rating': 1})
+        stats = api.get_rates.single_flight.stats
+        self.assertEqual((stats.calls, stats.coalesced), (5, 4))
+        self.assertEqual(api.get_rates.single_flight.in_flight, 0)
+
+        # a later call makes its own request
+        api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(self.gateway.requests, {'rating': 2})
+
+    def test_rates_are_read_only_values(self):
+        service = self.api().get_rates(PARCEL, ORIGIN, DESTINATION)[0]
+        with self.assertRaises(AttributeError):
+            service.price = None
+        with self.assertRaises(TypeError):
+            service.link['href'] = 'changed by the caller'
+        self.assertEqual(len({service, service, PARCEL, ORIGIN,
+                              DESTINATION}), 4)
+
+    def test_rate_estimates(self):
+        from canada_post.estimate import RateEstimator
+        estimator = RateEstimator()
+        api = self.api(rate_estimator=estimator)
+        services = api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        estimates = api.get_rates.estimate(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(sorted(estimate.code for estimate in estimates),
+                         sorted(service.code for service in services))
+        self.assertTrue(all(estimate.confidence > 0.99
+                            for estimate in estimates))
+        # another account sharing the estimator has its own prices
+        other = CanadaPostAPI("7654321", "other", "password", "42",
+                              gateway=self.gateway.url,
+                              rate_estimator=estimator)
+        self.addCleanup(other.close)
+        self.assertEqual(other.get_rates.estimate(PARCEL, ORIGIN,
+                                                  DESTINATION), [])
+
+    def test_rate_estimates_forget_old_prices(self):
+        from decimal import Decimal
+        from canada_post.estimate import RateEstimator
+        from canada_post.util.money import Price
+        estimator = RateEstimator(window=2)
+        for due in ("5.00", "10.00", "10.00"):
+            service = Service(data={'code': 'DOM.EP',
+                                    'price': Price(due=Decimal(due))})
+            estimator.learn(PARCEL, ORIGIN, DESTINATION, [service])
+        estimate, = estimator.estimate(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(estimate.samples, 3)
+        self.assertGreater(estimate.confidence, 0.99)
+
+    def test_instrumentation(self):
+        from canada_post.instrument import Instrumentation, LoggingExporter
+        self.gateway.latency = 0.05
+        sent, finished = [], []
+        def pre_request(event):
+            sent.append((event.endpoint, event.method))
+        def broken(event):
+            raise RuntimeError("broken hook")
+        instrumentation = Instrumentation(
+            pre_request=[pre_request], post_response=[broken, finished.append],
+            exporters=[LoggingExporter()])
+        api = self.api(instrumentation=instrumentation)
+        for _ in range(3):
+            api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        with self.assertLogs('canada_post.instrument', 'ERROR'):
+            api.get_shipment('123')
+        self.assertEqual(sent, [('rating', 'POST')] * 3 +
+                         [('shipment', 'GET')])
+        self.assertEqual([event.status_code for event in finished],
+                         [200] * 4)
+        self.assertGreater(finished[0].request_size, 0)
+        self.assertGreater(finished[0].response_size, 0)
+
+        self.gateway.latency = 0
+        self.gateway.error_rate = 1
+        self.gateway.errors = (500,)
+        with self.assertRaises(CanadaPostError):
+            api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertIsInstance(finished[-1].error, CanadaPostError)
+
+        with self.assertLogs('canada_post.instrument', 'INFO') as logs:
+            snapshot = instrumentation.export()
+        self.assertTrue(any(line.startswith('INFO:canada_post.instrument.'
+                                            'LoggingExporter:rating total')
+                            for line in logs.output))
+        rating = snapshot['rating']
+        self.assertEqual((rating['requests'], rating['errors']), (4, 1))
+        self.assertEqual(rating['statuses'], {200: 3, 500: 1})
+        self.assertEqual(rating['latency']['total']['count'], 4)
+        for phase in ('server', 'parse', 'total'):
+            self.assertIn(phase, rating['latency'])
+        self.assertGreaterEqual(rating['latency']['server']['p50'], 0.045)
+        self.assertLessEqual(rating['latency']['server']['p50'],
+                             rating['latency']['total']['max'])
+        self.assertEqual(snapshot['shipment']['requests'], 1)
+
+    def test_registry(self):
+        from canada_post.cache import RateCache
+        from canada_post.registry import ClientRegistry
+        loads = []
+        def loader(key):
+            loads.append(key)
+            time.sleep(0.05)
+            if key == 'globex':
+                return {'customer_number': "7654321", 'username': "globex",
+                        'password': "password", 'contract_number': "42"}
+        cache = RateCache()
+        registry = ClientRegistry(loader=loader, rate_cache=cache,
+                                  gateway=self.gateway.url)
+        self.addCleanup(registry.close)
+        acme = registry.register('acme', *CREDENTIALS)
+        with self.assertRaises(KeyError):
+            registry.register('acme', *CREDENTIALS)
+
+        clients = run_in_threads(5, lambda: registry['globex'])
+        self.assertEqual(len(set(id(client) for client in clients)), 1)
+        globex = clients[0]
+        self.assertEqual(loads, ['globex'])
+        with self.assertRaises(KeyError):
+            registry['initech']
+        self.assertEqual(sorted(registry.keys()), ['acme', 'globex'])
+        self.assertIsNot(globex.transport, acme.transport)
+
+        # the shared rate cache keeps each account's quotes apart
+        for client in (acme, globex, acme, globex):
+            client.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(self.gateway.requests, {'rating': 2})
+        self.assertEqual(cache.stats.hits, 2)
+
+        registry.unregister('acme')
+        self.assertNotIn('acme', registry)
+        with self.assertRaises(KeyError):
+            registry['acme']
+        registry.close()
+        self.assertEqual(len(registry), 0)
+
+    def test_create_get_void_shipment(self):
+        api = self.api()
+        service = api.get_rates(PARCEL, ORIGIN, DESTINATION)[0]
+        shipment = api.create_shipment(PARCEL, ORIGIN, DESTINATION, service,
+                                       GROUP)
+        self.assertIsInstance(shipment, Shipment)
+        self.assertTrue(shipment.id)
+        self.assertIn('label', shipment.links)
+
+        fetched = api.get_shipment(shipment.id)
+        self.assertEqual(fetched.id, shipment.id)
+
+        response = api.void_shipment(shipment)
+        self.assertEqual(response.status_code, 204)
+
+    def test_create_shipment_is_validated(self):
+        service = self.api().get_rates(PARCEL, ORIGIN, DESTINATION)[0]
+        # no company nor phone
+        origin = Origin(postal_code="H2B1A0", city="Montreal", province="QC",
+                        address="123 Main st")
+        with self.assertRaises(AssertionError):
+            self.api().create_shipment(PARCEL, origin, DESTINATION, service,
+                                       GROUP)
+        self.assertEqual(self.gateway.requests, {'rating': 1})
+
+    def test_bulk_shipments_journal_requests_in_flight_when_closed(self):
+        from canada_post.service.bulk import ShipmentOrder, MemoryJournal
+        self.gateway.latency = 0.02
+        api = self.api()
+        service = api.get_rates(PARCEL, ORIGIN, DESTINATION)[0]
+        orders = [ShipmentOrder(str(key), PARCEL, ORIGIN, DESTINATION,
+                                service, GROUP) for key in range(10)]
+        journal = MemoryJournal()
+        results = api.create_shipments(orders, journal=journal)
+        self.assertTrue(next(results).ok)
+        results.close()
+        states = [entry['state'] for entry in journal.entries.values()]
+        self.assertEqual(set(states), {journal.CREATED})
+        self.assertEqual(self.gateway.requests['shipment'], len(states))
+
+        resumed = [result for result in
+                   api.create_shipments(orders, journal=journal)
+                   if result.resumed]
+        self.assertEqual(len(resumed), len(states))
+        self.assertTrue(all(result.ok for result in resumed))
+
+    def test_expand_manifests_resumes_from_journal(self):
+        from canada_post.service.bulk import JournalFile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'journal')
+        api = self.api()
+        expander = api.expand_manifests
+        failing = '347881315405043892'
+        def get_shipment(shipment_id):
+            if shipment_id == failing:
+                raise requests.ConnectionError("connection reset")
+            return api.get_shipment(shipment_id)
+        expander.get_shipment = get_shipment
+
+        journal = JournalFile(path)
+        graph = expander.transmit('2024-05-01', ORIGIN, [GROUP], journal,
+                                  name="Main warehouse")
+        journal.close()
+        self.assertFalse(graph.complete)
+        self.assertEqual(len(graph.manifests), 2)
+        self.assertEqual(set(error.key for error in graph.errors), {failing})
+        # transmit, then GetManifest and GetManifestShipments per manifest
+        self.assertEqual(self.gateway.requests, {'manifest': 5,
+                                                 'shipment': 2})
+
+        # a later run only makes the calls that failed
+        self.gateway.requests.clear()
+        expander.get_shipment = api.get_shipment
+        journal = JournalFile(path)
+        self.addCleanup(journal.close)
+        results = list(expander.stream(
+            [node.link for node in graph.manifests.values()], journal))
+        graph = expander.transmit('2024-05-01', ORIGIN, [GROUP], journal)
+        self.assertTrue(graph.complete)
+        self.assertEqual(len(list(graph.shipments())), 4)
+        self.assertEqual(sorted(result.key for result in results
+                                if not result.resumed), [failing] * 2)
+        self.assertEqual(self.gateway.requests, {'shipment': 2})
+
+    def test_get_artifact(self):
+        api = self.api()
+        shipment = api.get_shipment('123')
+        label = load_payload('label.pdf')
+
+        temporary = api.get_artifact(shipment)
+        self.addCleanup(os.remove, temporary.name)
+        temporary.seek(0)
+        self.assertEqual(temporary.read(), label)
+        temporary.close()
+
+        sink = io.BytesIO()
+        artifact = api.get_artifact(shipment, sink=sink, checksum='sha256')
+        self.assertEqual(sink.getvalue(), label)
+        self.assertEqual(artifact.size, len(label))
+        self.assertEqual(artifact.checksum,
+                         hashlib.sha256(label).hexdigest())
+
+    def test_get_artifact_from_store(self):
+        from canada_post.artifacts import ArtifactStore
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        api = self.api(artifact_store=ArtifactStore(directory))
+        shipment = api.get_shipment('123')
+        first, second = io.BytesIO(), io.BytesIO()
+        api.get_artifact(shipment, sink=first)
+        api.get_artifact(shipment, sink=second)
+        self.assertEqual(first.getvalue(), second.getvalue())
+        self.assertEqual(self.gateway.requests['artifact'], 1)
+
+    def test_get_artifacts(self):
+        label = load_payload('label.pdf')
+        shipments = [Shipment(id=str(number), links={'label': {
+            'href': 'https://ct.soa-gw.canadapost.ca/ers/artifact/{0}/0'
+                    .format(number)}}) for number in range(6)]
+        sinks = dict((shipment.id, io.BytesIO()) for shipment in shipments)
+        results = list(self.api().get_artifacts(
+            shipments, sink=lambda shipment: sinks[shipment.id],
+            checksum='sha256'))
+        self.assertEqual(sorted(result.obj.id for result in results),
+                         sorted(sinks))
+        for result in results:
+            self.assertTrue(result.ok)
+            self.assertEqual(result.attempts, 1)
+            self.assertEqual(result.artifact.checksum,
+                             hashlib.sha256(label).hexdigest())
+        self.assertTrue(all(sink.getvalue() == label
+                            for sink in sinks.values()))
+        self.assertEqual(self.gateway.requests, {'artifact': 6})
+
+    def test_get_artifacts_not_ready(self):
+        from canada_post.errors import Wait
+        self.gateway.artifact_pending = 2
+        shipments = [Shipment(id=str(number), links={'label': {
+            'href': 'https://ct.soa-gw.canadapost.ca/ers/artifact/{0}/0'
+                    .format(number)}}) for number in range(3)]
+        api = self.api()
+        results = list(api.get_artifacts(shipments))
+        for result in results:
+            self.addCleanup(os.remove, result.artifact.name)
+            result.artifact.close()
+        # each was tried again after its 202s, without giving up
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual([result.attempts for result in results], [3] * 3)
+        self.assertEqual(self.gateway.requests, {'artifact': 9})
+
+        # and given up on after max_attempts
+        self.gateway.pending.clear()
+        api.get_artifacts.max_attempts = 2
+        results = list(api.get_artifacts(shipments[:1]))
+        self.assertIsInstance(results[0].error, Wait)
+        self.assertEqual(results[0].attempts, 2)
+
+    def test_shipment_cache(self):
+        from canada_post.cache import ShipmentCache
+        cache = ShipmentCache(fresh=60)
+        api = self.api(shipment_cache=cache)
+        shipment = api.get_shipment('123')
+        shipment.links['label']['href'] = 'changed by the caller'
+        cached = api.get_shipment('123')
+        self.assertNotEqual(cached.links['label']['href'],
+                            'changed by the caller')
+        cached.status = 'changed by the caller'
+        self.assertNotEqual(api.get_shipment('123').status,
+                            'changed by the caller')
+        self.assertEqual(self.gateway.requests, {'shipment': 1})
+        self.assertEqual(cache.stats.hits, 2)
+
+        # the same account number in another environment has its own entries
+        dev = self.api(shipment_cache=cache, dev=DEV)
+        dev.get_shipment('123')
+        self.assertEqual(self.gateway.requests, {'shipment': 2})
+
+    def test_http_cache_revalidation(self):
+        cache = HTTPCache()
+        transport = Transport(cache=cache)
+        self.addCleanup(transport.close)
+        url = self.gateway.url + '/rs/1234567/1234567/group'
+        auth = CREDENTIALS[1:3]
+        transport.request('GET', url, auth=auth)
+        key = cache.key('GET', url, auth=auth)
+        stored = cache.lookup(key)
+        stored_headers = dict(stored.headers)
+        response = transport.request('GET', url, auth=auth)
+        self.assertTrue(response.from_cache)
+        self.assertEqual(response.headers['etag'], stored.etag)
+        self.assertEqual(cache.stats.revalidated, 1)
+        # a new entry replaced it, the one other threads may hold is intact
+        self.assertIsNot(cache.lookup(key), stored)
+        self.assertEqual(stored.headers, stored_headers)
+
+    def test_http_cache_is_invalidated_by_void(self):
+        cache = HTTPCache(default_ttl=60)
+        api = self.api(transport=Transport(cache=cache))
+        shipment_id = '347881315405043891'
+        shipment = api.get_shipment(shipment_id)
+        api.get_shipment(shipment_id)
+        self.assertEqual(cache.stats.hits, 1)
+        api.void_shipment(shipment)
+        api.get_shipment(shipment_id)
+        self.assertEqual(cache.stats.hits, 1)
+        # GET, DELETE and GET again
+        self.assertEqual(self.gateway.requests, {'shipment': 3})
+
+    def test_http_cache(self):
+        cache = HTTPCache(default_ttl=60)
+        api = self.api(transport=Transport(cache=cache))
+        groups = api.get_groups()
+        groups.append('changed by the caller')
+        self.assertNotIn('changed by the caller', api.get_groups())
+        self.assertEqual(self.gateway.requests, {'shipment': 1})
+        self.assertEqual(cache.stats.hits, 1)
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# drains the outbox at argv[1] and exits as soon as a request is sent
+CRASHING_OUTBOX = """
+import os, sys, time
+from canada_post.api import CanadaPostAPI
+from canada_post.outbox import Outbox
+from canada_post.transport import Transport
+from tests import CREDENTIALS
+
+class CrashingTransport(Transport):
+    def send(self, method, url, **kwargs):
+        os._exit(3)
+
+api = CanadaPostAPI(*CREDENTIALS, gateway=sys.argv[2],
+                    transport=CrashingTransport())
+Outbox(sys.argv[1], api).start()
+time.sleep(30)
+"""
+
+
+class OutboxTest(GatewayTestCase):
+    def setUp(self):
+        super(OutboxTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'outbox.db')
+        self.service = self.api().get_rates(PARCEL, ORIGIN, DESTINATION)[0]
+        self.gateway.requests.clear()
+
+    def outbox(self, api=None, **options):
+        from canada_post.outbox import Outbox
+        outbox = Outbox(self.path, api or self.api(), **options)
+        self.addCleanup(outbox.close)
+        return outbox
+
+    def enqueue(self, outbox, keys):
+        return [outbox.create_shipment(key, PARCEL, ORIGIN, DESTINATION,
+                                       self.service, GROUP) for key in keys]
+
+    def test_enqueue(self):
+        outbox = self.outbox()
+        finished = []
+        outbox.subscribe(finished.append)
+        entry, = self.enqueue(outbox, ['order-1'])
+        self.assertEqual(entry.state, outbox.PENDING)
+        # enqueueing doesn't wait for the gateway, nor enqueues twice
+        self.assertEqual(self.gateway.requests, {})
+        self.assertEqual(self.enqueue(outbox, ['order-1'])[0].id, entry.id)
+
+        outbox.start()
+        entry = outbox.wait('order-1', timeout=10)
+        self.assertEqual(entry.state, outbox.DONE)
+        self.assertIsInstance(entry.get_result(), Shipment)
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual([done.key for done in finished], ['order-1'])
+        self.assertEqual(self.gateway.requests, {'shipment': 1})
+
+    def test_crash_mid_send_is_in_doubt(self):
+        outbox = self.outbox()
+        self.enqueue(outbox, ['order-1'])
+        outbox.close()
+        # another process starts sending it, and dies before an answer
+        crash = subprocess.Popen([sys.executable, '-c', CRASHING_OUTBOX,
+                                  self.path, self.gateway.url],
+                                 cwd=ROOT)
+        self.assertEqual(crash.wait(30), 3)
+
+        resumed = self.outbox()
+        entry = resumed.get('order-1')
+        self.assertEqual(entry.state, resumed.IN_DOUBT)
+        self.assertEqual(entry.attempts, 1)
+        with self.assertRaises(InDoubt):
+            entry.get_result()
+        # it's not sent again until told to
+        resumed.start()
+        self.assertEqual(resumed.wait('order-1', timeout=0.2).state,
+                         resumed.IN_DOUBT)
+        resumed.retry('order-1')
+        self.assertEqual(resumed.wait('order-1', timeout=10).state,
+                         resumed.DONE)
+        self.assertEqual(self.gateway.requests, {'shipment': 1})
+
+    def test_resume(self):
+        keys = ['order-{0}'.format(number) for number in range(5)]
+        self.enqueue(self.outbox(), keys)
+        resumed = self.outbox().start()
+        for key in keys:
+            self.assertEqual(resumed.wait(key, timeout=10).state,
+                             resumed.DONE)
+        self.assertEqual(resumed.stats(), {resumed.DONE: len(keys)})
+        self.assertEqual(self.gateway.requests, {'shipment': len(keys)})
+
+    def test_entries_are_claimed_once(self):
+        keys = ['order-{0}'.format(number) for number in range(50)]
+        first = self.outbox(workers=4)
+        self.enqueue(first, keys)
+        # two outboxes draining the same database race for every entry
+        second = self.outbox(workers=4)
+        first.start()
+        second.start()
+        deadline = time.time() + 10
+        # neither outbox is told about the entries the other one finishes
+        while first.stats().get(first.DONE) != len(keys) and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        for entry in first.entries():
+            self.assertEqual(entry.state, first.DONE)
+            self.assertEqual(entry.attempts, 1)
+        self.assertEqual(self.gateway.requests, {'shipment': len(keys)})
+
+
+class LoggingTest(GatewayTestCase):
+    def assertRedacted(self, logs):
+        text = u"\n".join(logs.output)
+        for personal in (ORIGIN.company, ORIGIN.phone, ORIGIN.address1,
+                         DESTINATION.name, DESTINATION.address1,
+                         "Main warehouse"):
+            self.assertNotIn(personal, text)
+
+    def test_transmit_shipments_body_is_redacted(self):
+        api = self.api()
+        with self.assertLogs('canada_post', 'DEBUG') as logs:
+            api.transmit_shipments(ORIGIN, [GROUP], name="Main warehouse")
+        self.assertRedacted(logs)
+        self.assertTrue(any('<manifest-company>***</manifest-company>' in line
+                            for line in logs.output))
+
+    def test_addresses_are_masked(self):
+        api = self.api()
+        with self.assertLogs('canada_post', 'DEBUG') as logs:
+            service = api.get_rates(PARCEL, ORIGIN, DESTINATION)[0]
+            api.create_shipment(PARCEL, ORIGIN, DESTINATION, service, GROUP)
+        self.assertRedacted(logs)
+        self.assertTrue(any(DESTINATION.postal_code in line
+                            for line in logs.output))
+
+
+class ErrorsTest(GatewayTestCase):
+    gateway_options = {'error_rate': 1, 'errors': (500,)}
+
+    def test_get_rates_error(self):
+        with self.assertRaises(CanadaPostError) as raised:
+            self.api().get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(raised.exception.code, 9999)
+        self.assertEqual(raised.exception.response.status_code, 500)
+
+    def test_batch_rates_errors(self):
+        results = self.api().get_rates.batch([(PARCEL, ORIGIN, DESTINATION)])
+        self.assertIsInstance(results[0], CanadaPostError)
+        self.assertEqual(results[0].code, 9999)
+
+    def test_coalesced_rates_error(self):
+        self.gateway.latency = 0.1
+        api = self.api(coalesce_rates=True)
+        def get_rates():
+            try:
+                api.get_rates(PARCEL, ORIGIN, DESTINATION)
+            except CanadaPostError as error:
+                return error
+        errors = run_in_threads(3, get_rates)
+        self.assertTrue(all(isinstance(error, CanadaPostError)
+                            for error in errors))
+        self.assertEqual(self.gateway.requests, {'rating': 1})
+
+    def test_get_shipment_error(self):
+        with self.assertRaises(requests.HTTPError) as raised:
+            self.api().get_shipment('123')
+        self.assertEqual(raised.exception.response.status_code, 500)
+
+    def test_retries(self):
+        api = self.api(retry_policy=RetryPolicy(max_attempts=3, backoff=0.01))
+        with self.assertRaises(CanadaPostError):
+            api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(self.gateway.requests, {'rating': 3})
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        api = self.api(retry_policy=RetryPolicy(max_attempts=1,
+                                                breaker=breaker))
+        for _ in range(2):
+            with self.assertRaises(CanadaPostError):
+                api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        with self.assertRaises(CircuitOpen):
+            api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(self.gateway.requests, {'rating': 2})
+
+    def test_throttled(self):
+        from canada_post.ratelimit import RateLimits
+        self.gateway.errors = (429,)
+        limits = RateLimits(rate=10)
+        api = self.api(rate_limits=limits)
+        with self.assertRaises(CanadaPostError) as raised:
+            api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertEqual(raised.exception.response.status_code, 429)
+        rating = limits.get('rating')
+        self.assertEqual((rating.rate, rating.throttled), (5, 1))
+
+        # the next request waits out the Retry-After of 1s, and its success
+        # brings the rate back up
+        self.gateway.error_rate = 0
+        start = time.time()
+        api.get_rates(PARCEL, ORIGIN, DESTINATION)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+        self.assertGreater(rating.rate, 5)
+        self.assertEqual(rating.queue_depth, 0)
+
+        # other endpoint families aren't held back
+        start = time.time()
+        api.get_shipment('123')
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(limits.get('shipment').rate, 10)
+
+    def test_connection_refused(self):
+        api = self.api(gateway=closed_port_url())
+        with self.assertRaises(requests.ConnectionError):
+            api.get_rates(PARCEL, ORIGIN, DESTINATION)
+
+
+if __name__ == '__main__':
+    unittest.main()